@@ -6,6 +6,13 @@ here = os.path.abspath(os.path.dirname(__file__))
 with open(os.path.join(here, "requirements.txt")) as f:
     install_requires = f.read().strip().split("\n")
 
+# Optional dependencies: the Blosc and Zstd HDF5 filters, and the Zarr backend, which overrides private methods of
+# hdmf-zarr 0.2.0 (the version compatible with hdmf)
+extras_require = dict(
+    compression=["hdf5plugin>=4.0"],
+    zarr=["hdmf-zarr==0.2.0", "zarr>=2.11.0,<3", "numcodecs>=0.9.1,<0.14"],
+)
+
 with open("README.md", "r") as f:
     long_description = f.read()
 
@@ -23,4 +30,5 @@ setup(
     include_package_data=True,
     python_requires=">=3.7",
     install_requires=install_requires,
+    extras_require=extras_require,
 )
@@ -1,2 +1,3 @@
 from .embargo22abehaviorinterface import Embargo22ABehaviorInterface
+from .embargo22asuite2pinterface import Embargo22ASuite2pSegmentationInterface
 from .embargo22anwbconverter import Embargo22ANWBConverter
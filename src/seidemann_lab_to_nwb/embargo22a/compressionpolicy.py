@@ -0,0 +1,364 @@
+"""Choose the compression and chunking of every dataset written by the conversion from a single policy."""
+import importlib
+import time
+import uuid
+import warnings
+from copy import deepcopy
+from fnmatch import fnmatchcase
+from typing import Optional
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator
+
+backends = ["hdf5", "zarr"]
+codecs = ["none", "gzip", "lzf", "blosc-lz4", "blosc-lz4hc", "blosc-zstd", "zstd", "auto"]
+plugin_codecs = ["blosc-lz4", "blosc-lz4hc", "blosc-zstd", "zstd"]
+default_levels = {"gzip": 4, "blosc-lz4": 5, "blosc-lz4hc": 5, "blosc-zstd": 5, "zstd": 3}
+
+default_settings = dict(codec="gzip", level=None, shuffle=False, chunk_shape=None, min_compressed_bytes=65536)
+default_auto_candidates = [
+    dict(codec="none"),
+    dict(codec="lzf", shuffle=True),
+    dict(codec="gzip", level=1, shuffle=True),
+    dict(codec="gzip", level=4, shuffle=True),
+    dict(codec="blosc-lz4", level=5, shuffle=True),
+    dict(codec="blosc-zstd", level=5, shuffle=True),
+]
+
+settings_schema = dict(
+    type="object",
+    properties=dict(
+        codec=dict(type="string", enum=codecs),
+        level=dict(type=["integer", "null"]),
+        shuffle=dict(type="boolean"),
+        chunk_shape=dict(type=["array", "null"], items=dict(type="integer")),
+        min_compressed_bytes=dict(type="integer"),
+    ),
+    additionalProperties=False,
+)
+
+
+def get_compression_policy_schema() -> dict:
+    """Schema of the `Compression` section of the metadata, see `CompressionPolicy.from_dict`."""
+    schema = deepcopy(settings_schema)
+    schema["properties"].update(
+        overrides=dict(type="object", additionalProperties=settings_schema),
+        auto=dict(
+            type="object",
+            properties=dict(
+                candidates=dict(type="array", items=settings_schema),
+                sample_mb=dict(type="number"),
+                io_mb_per_second=dict(type="number"),
+            ),
+            additionalProperties=False,
+        ),
+    )
+    return schema
+
+
+def _import_hdf5plugin():
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(
+            "The Blosc and Zstd codecs are provided by hdf5plugin, install the `compression` extra with "
+            "`pip install seidemann-lab-to-nwb[compression]`. hdf5plugin must also be imported before reading the file."
+        )
+    return hdf5plugin
+
+
+def _import_zarr_module(module_name: str):
+    """Import numcodecs, zarr or hdmf_zarr, which the Zarr backend needs."""
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImportError(
+            f"The Zarr backend needs {module_name}, install the `zarr` extra with "
+            "`pip install seidemann-lab-to-nwb[zarr]`."
+        )
+
+
+def is_codec_available(codec: str) -> bool:
+    if codec not in plugin_codecs:
+        return True
+    try:
+        _import_hdf5plugin()
+    except ImportError:
+        return False
+    return True
+
+
+def get_filter_options(settings: dict, dtype: Optional[np.dtype] = None) -> dict:
+    """
+    The `compression`, `compression_opts` and `shuffle` arguments of h5py (and H5DataIO) for `settings`.
+
+    The HDF5 plugin filters do not handle variable-length data, so strings are compressed with gzip instead.
+    """
+    codec = settings["codec"]
+    level = settings.get("level")
+    shuffle = settings.get("shuffle", False)
+    if codec == "none":
+        return dict()
+    if codec in plugin_codecs and dtype is not None and np.dtype(dtype).kind in "OSU":
+        codec, level = "gzip", None
+    level = default_levels.get(codec) if level is None else level
+
+    if codec == "gzip":
+        return dict(compression="gzip", compression_opts=level, shuffle=shuffle)
+    if codec == "lzf":
+        return dict(compression="lzf", shuffle=shuffle)
+
+    hdf5plugin = _import_hdf5plugin()
+    if codec == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=level), shuffle=shuffle)
+    blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE  # Blosc shuffles internally
+    return dict(hdf5plugin.Blosc(cname=codec.split("-")[1], clevel=level, shuffle=blosc_shuffle))
+
+
+def get_zarr_codec_options(settings: dict, dtype: Optional[np.dtype] = None) -> dict:
+    """
+    The `compressor` and `filters` arguments of ZarrDataIO for `settings`, with the numcodecs equivalents of the codecs.
+
+    There is no LZF codec in numcodecs, LZ4 is used instead. Object (string) arrays are compressed without filters.
+    """
+    numcodecs = _import_zarr_module("numcodecs")
+
+    codec = settings["codec"]
+    level = settings.get("level")
+    is_object = dtype is not None and np.dtype(dtype).kind in "OSU"
+    shuffle = settings.get("shuffle", False) and not is_object
+    if codec == "none":
+        return dict(compressor=False)
+    level = default_levels.get(codec) if level is None else level
+
+    filters = [numcodecs.Shuffle(elementsize=np.dtype(dtype).itemsize)] if shuffle and dtype is not None else None
+    if codec == "gzip":
+        return dict(compressor=numcodecs.Zlib(level=level), filters=filters)
+    if codec == "lzf":
+        return dict(compressor=numcodecs.LZ4(), filters=filters)
+    if codec == "zstd":
+        return dict(compressor=numcodecs.Zstd(level=level), filters=filters)
+    blosc_shuffle = numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE
+    return dict(compressor=numcodecs.Blosc(cname=codec.split("-")[1], clevel=level, shuffle=blosc_shuffle))
+
+
+def get_data_nbytes(data) -> Optional[int]:
+    """Size in bytes of in-memory data or of the data produced by an iterator, None when it is not known."""
+    if isinstance(data, AbstractDataChunkIterator):
+        if data.maxshape is None or None in data.maxshape:
+            return None
+        return int(np.prod(data.maxshape)) * np.dtype(data.dtype).itemsize
+    return np.asarray(data).nbytes
+
+
+def get_data_sample(data, sample_bytes: int) -> Optional[np.ndarray]:
+    """
+    The first rows of `data`, about `sample_bytes` in size.
+
+    Iterators are sampled with `_get_data`, which reads a selection without advancing them. None is returned for
+    iterators that can only be consumed.
+    """
+    if isinstance(data, AbstractDataChunkIterator):
+        if not hasattr(data, "_get_data") or data.maxshape is None or None in data.maxshape:
+            return None
+        shape, dtype = data.maxshape, np.dtype(data.dtype)
+    else:
+        data = np.asarray(data)
+        shape, dtype = data.shape, data.dtype
+
+    if len(shape) == 0 or shape[0] == 0:
+        return None
+    bytes_per_row = dtype.itemsize * int(np.prod(shape[1:]))
+    num_rows = int(min(shape[0], max(1, sample_bytes // max(1, bytes_per_row))))
+    selection = (slice(0, num_rows),) + tuple(slice(0, length) for length in shape[1:])
+    return np.asarray(data._get_data(selection) if isinstance(data, AbstractDataChunkIterator) else data[selection])
+
+
+def benchmark_codec(
+    sample: np.ndarray, settings: dict, chunk_shape: Optional[tuple] = None, backend: str = "hdf5"
+) -> dict:
+    """Write `sample` to an in-memory HDF5 file (or Zarr array) with `settings` and measure the time and stored size."""
+    if chunk_shape is not None:
+        chunk_shape = tuple(min(chunk, length) for chunk, length in zip(chunk_shape, sample.shape))
+    if backend == "zarr":
+        zarr = _import_zarr_module("zarr")
+
+        codec_options = get_zarr_codec_options(settings, dtype=sample.dtype)
+        codec_options["compressor"] = codec_options["compressor"] or None
+        start_time = time.perf_counter()
+        array = zarr.array(sample, chunks=chunk_shape or True, store=zarr.MemoryStore(), **codec_options)
+        seconds = time.perf_counter() - start_time
+        return dict(settings, seconds=seconds, logical_bytes=sample.nbytes, stored_bytes=array.nbytes_stored)
+
+    filter_options = get_filter_options(settings, dtype=sample.dtype)
+    if filter_options and chunk_shape is None:
+        chunk_shape = True
+
+    with h5py.File(f"{uuid.uuid4()}.h5", mode="w", driver="core", backing_store=False) as file:
+        start_time = time.perf_counter()
+        dataset = file.create_dataset("sample", data=sample, chunks=chunk_shape, **filter_options)
+        file.flush()
+        seconds = time.perf_counter() - start_time
+        stored_bytes = dataset.id.get_storage_size()
+
+    return dict(settings, seconds=seconds, logical_bytes=sample.nbytes, stored_bytes=stored_bytes)
+
+
+class CompressionPolicy:
+    """
+    Compression and chunking of the datasets of a conversion.
+
+    Datasets are named by the interfaces that write them, e.g. `TwoPhotonSeries/data`, `pupil_position/timestamps` or
+    `trials/outcome`. Every dataset gets the default settings (`codec`, `level`, `shuffle` and `chunk_shape`) updated
+    by the `overrides` whose pattern (shell-style, e.g. `trials/*`) matches its name, in order; a `chunk_shape` only
+    applies to the datasets with as many dimensions, clipped to their shape, the others keep the default chunking.
+    Datasets smaller than `min_compressed_bytes` are written contiguous and uncompressed: for short trial columns, the
+    chunk index and filter pipeline cost more than compression saves.
+
+    Codecs are `none`, `gzip` (levels 0-9), `lzf`, `blosc-lz4`, `blosc-lz4hc`, `blosc-zstd` and `zstd`; the Blosc
+    and Zstd codecs need `hdf5plugin` (the `compression` extra), which must also be imported before the file is read.
+    With `auto`, the `auto_candidates` are benchmarked on a sample of the dataset and the one that minimizes the time
+    to compress the data plus the time to write the compressed bytes at `auto_io_mb_per_second` is used. The measures
+    are kept in `auto_report`.
+
+    The datasets are wrapped in H5DataIO for the HDF5 backend and in ZarrDataIO, with the equivalent numcodecs codecs
+    (see `get_zarr_codec_options`), for the Zarr backend, which needs the `zarr` extra.
+    """
+
+    def __init__(
+        self,
+        codec: str = "gzip",
+        level: Optional[int] = None,
+        shuffle: bool = False,
+        chunk_shape: Optional[list] = None,
+        min_compressed_bytes: int = 65536,
+        overrides: Optional[dict] = None,
+        auto_candidates: Optional[list] = None,
+        auto_sample_mb: float = 4.0,
+        auto_io_mb_per_second: float = 100.0,
+        backend: str = "hdf5",
+    ):
+        if backend not in backends:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {backends}.")
+        self.backend = backend
+        self.settings = dict(
+            codec=codec,
+            level=level,
+            shuffle=shuffle,
+            chunk_shape=chunk_shape,
+            min_compressed_bytes=min_compressed_bytes,
+        )
+        self.overrides = overrides or dict()
+        for settings in [self.settings, *self.overrides.values()]:
+            if settings.get("codec", "gzip") not in codecs:
+                raise ValueError(f"Unknown codec '{settings['codec']}', expected one of {codecs}.")
+
+        candidates = default_auto_candidates if auto_candidates is None else auto_candidates
+        self.auto_candidates = [
+            dict(default_settings, **candidate) for candidate in candidates if is_codec_available(candidate["codec"])
+        ]
+        self.auto_sample_mb = auto_sample_mb
+        self.auto_io_mb_per_second = auto_io_mb_per_second
+        self.auto_report = dict()
+
+    @classmethod
+    def from_dict(cls, policy: Optional[dict] = None, backend: str = "hdf5") -> "CompressionPolicy":
+        """
+        Build the policy from the `Compression` section of the metadata or from the conversion options, e.g.
+
+            codec: gzip
+            level: 4
+            overrides:
+              TwoPhotonSeries/data: {codec: blosc-zstd, shuffle: true, chunk_shape: [1, 512, 512]}
+              trials/*: {codec: none}
+            auto: {sample_mb: 4.0, io_mb_per_second: 100.0}
+        """
+        policy = dict(policy or dict())
+        auto = policy.pop("auto", dict())
+        return cls(
+            **policy,
+            auto_candidates=auto.get("candidates"),
+            auto_sample_mb=auto.get("sample_mb", 4.0),
+            auto_io_mb_per_second=auto.get("io_mb_per_second", 100.0),
+            backend=backend,
+        )
+
+    def get_settings(self, name: str, num_dimensions: Optional[int] = None) -> dict:
+        """
+        The settings of the dataset `name`: the defaults updated by every matching override.
+
+        The `chunk_shape` is None when it does not have `num_dimensions` dimensions, the number of dimensions of the
+        data of the dataset.
+        """
+        settings = dict(self.settings)
+        for pattern, override in self.overrides.items():
+            if fnmatchcase(name, pattern):
+                settings.update(override)
+        if num_dimensions is not None and settings["chunk_shape"] is not None:
+            if len(settings["chunk_shape"]) != num_dimensions:
+                settings.update(chunk_shape=None)
+        return settings
+
+    def choose_codec(self, name: str, data, settings: dict) -> dict:
+        """Benchmark the candidate codecs on a sample of `data` and return the settings of the best one."""
+        sample = get_data_sample(data, sample_bytes=int(self.auto_sample_mb * 1e6))
+        if sample is None:  # The data cannot be sampled, the default codec is used
+            return dict(settings, codec=default_settings["codec"])
+
+        chunk_shape = settings["chunk_shape"]
+        if chunk_shape is None and isinstance(data, AbstractDataChunkIterator):
+            chunk_shape = data.recommended_chunk_shape()
+        results = [
+            benchmark_codec(sample, candidate, chunk_shape=chunk_shape, backend=self.backend)
+            for candidate in self.auto_candidates
+        ]
+        for result in results:
+            io_seconds = result["stored_bytes"] / (self.auto_io_mb_per_second * 1e6)
+            result.update(cost_seconds=result["seconds"] + io_seconds)
+
+        best_result = min(results, key=lambda result: result["cost_seconds"])
+        self.auto_report[name] = dict(chosen=best_result["codec"], candidates=results)
+        return dict(settings, codec=best_result["codec"], level=best_result["level"], shuffle=best_result["shuffle"])
+
+    def wrap(self, name: str, data):
+        """
+        Wrap `data` in an H5DataIO (or ZarrDataIO) with the compression and chunking of the dataset `name`.
+
+        Data smaller than the `min_compressed_bytes` of the dataset, and data without compression nor chunk shape, are
+        returned as they are.
+        """
+        shape = data.maxshape if isinstance(data, AbstractDataChunkIterator) else np.shape(data)
+        settings = self.get_settings(name, num_dimensions=len(shape))
+        if settings["chunk_shape"] is not None:  # A chunk larger than a dataset of fixed shape cannot be created
+            chunk_shape = [
+                chunk if length is None else max(1, min(chunk, length))
+                for chunk, length in zip(settings["chunk_shape"], shape)
+            ]
+            settings.update(chunk_shape=chunk_shape)
+        nbytes = get_data_nbytes(data)
+        if nbytes is not None and nbytes < settings["min_compressed_bytes"]:
+            return data
+
+        if settings["codec"] == "auto":
+            settings = self.choose_codec(name, data, settings)
+
+        dtype = data.dtype if isinstance(data, AbstractDataChunkIterator) else np.asarray(data).dtype
+        if self.backend == "zarr":
+            ZarrDataIO = _import_zarr_module("hdmf_zarr.utils").ZarrDataIO
+
+            data_io_kwargs = get_zarr_codec_options(settings, dtype=dtype)
+            if settings["chunk_shape"] is not None:
+                data_io_kwargs.update(chunks=list(settings["chunk_shape"]))
+            return ZarrDataIO(data, **data_io_kwargs)
+
+        data_io_kwargs = get_filter_options(settings, dtype=dtype)
+        if settings["chunk_shape"] is not None:
+            data_io_kwargs.update(chunks=tuple(settings["chunk_shape"]))
+        if not data_io_kwargs:
+            return data
+
+        with warnings.catch_warnings():  # The choice of a codec other than gzip is deliberate
+            warnings.filterwarnings("ignore", message=".*compression may not be available on all installations")
+            return H5DataIO(data, allow_plugin_filters=True, **data_io_kwargs)
@@ -0,0 +1,340 @@
+"""Record the progress of a conversion to resume it after a failure, and replace the objects of single interfaces."""
+import hashlib
+import json
+import os
+import time
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import h5py
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk, DataIO
+from pynwb import NWBFile, NWBHDF5IO, get_manager
+
+from neuroconv.tools.nwb_helpers import make_nwbfile_from_metadata
+from neuroconv.utils import FilePathType
+
+
+def get_checkpoint_path(nwbfile_path: FilePathType) -> Path:
+    """The checkpoint of `session.nwb` is saved next to it as `session.checkpoint.json`."""
+    return Path(nwbfile_path).with_suffix(".checkpoint.json")
+
+
+def get_interface_fingerprint(source_data: dict, conversion_options: dict, compression: dict) -> str:
+    """Digest of everything an interface writes depends on, except its code and the metadata."""
+    options = json.dumps(
+        dict(source_data=source_data, conversion_options=conversion_options, compression=compression),
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(options.encode(), digest_size=16).hexdigest()
+
+
+def get_object_paths(nwbfile_path: FilePathType) -> Dict[str, str]:
+    """The path in the file of every NWB object, by object ID."""
+    object_paths = dict()
+
+    def add_object_path(name: str, node):
+        object_id = node.attrs.get("object_id")
+        if object_id is not None:
+            object_paths[object_id] = f"/{name}"
+
+    with h5py.File(nwbfile_path, mode="r") as file:
+        file.visititems(add_object_path)
+    return object_paths
+
+
+def _get_complete_rows(selection, shape: tuple) -> Optional[int]:
+    """
+    Number of leading rows of a dataset complete once the chunk at `selection` is written.
+
+    hdmf iterates the chunks with the first axis outermost, so the rows before the chunk are complete, and the rows of
+    the chunk too if it spans every other axis.
+    """
+    selection = selection if isinstance(selection, tuple) else (selection,)
+    if not all(isinstance(axis_selection, slice) for axis_selection in selection):
+        return None
+    spans_sample = all(
+        (axis_selection.start or 0) == 0 and (axis_selection.stop is None or axis_selection.stop >= length)
+        for axis_selection, length in zip(selection[1:], shape[1:])
+    )
+    rows = selection[0].stop if spans_sample else selection[0].start
+    return shape[0] if rows is None else int(rows)
+
+
+class ConversionCheckpoint:
+    """
+    Progress of the conversion of the NWB file at `nwbfile_path`, saved next to it (see `get_checkpoint_path`).
+
+    For every interface, the checkpoint keeps a fingerprint of its source data and options and the paths of the
+    objects it added to the file. While a file is written, the number of complete rows of every dataset written from a
+    DataChunkIterator is recorded; every `checkpoint_interval` seconds the file is flushed and the checkpoint saved, so
+    that an interrupted write can be completed from the last rows saved.
+    """
+
+    def __init__(self, nwbfile_path: FilePathType, checkpoint_interval: float = 30.0):
+        self.nwbfile_path = Path(nwbfile_path)
+        self.path = get_checkpoint_path(nwbfile_path)
+        self.checkpoint_interval = checkpoint_interval
+
+        self.status = "new"  # "writing" while interfaces are written, then "complete"
+        self.interfaces: Dict[str, dict] = dict()
+        self.written_interfaces: List[str] = []
+        self.structure_written = False  # Every group and dataset of the written interfaces exists in the file
+        self.datasets: Dict[str, dict] = dict()
+        self._last_save_time = 0.0
+
+    @classmethod
+    def load(cls, nwbfile_path: FilePathType, checkpoint_interval: float = 30.0) -> "ConversionCheckpoint":
+        """The checkpoint saved next to `nwbfile_path`, or a new one."""
+        checkpoint = cls(nwbfile_path=nwbfile_path, checkpoint_interval=checkpoint_interval)
+        if checkpoint.path.is_file():
+            with open(checkpoint.path, "r") as file:
+                state = json.load(file)
+            checkpoint.status = state["status"]
+            checkpoint.interfaces = state["interfaces"]
+            checkpoint.written_interfaces = state["written_interfaces"]
+            checkpoint.structure_written = state["structure_written"]
+            checkpoint.datasets = state["datasets"]
+        return checkpoint
+
+    def save(self):
+        """Save the checkpoint; a checkpoint interrupted while it is saved keeps its previous state."""
+        state = dict(
+            status=self.status,
+            interfaces=self.interfaces,
+            written_interfaces=self.written_interfaces,
+            structure_written=self.structure_written,
+            datasets=self.datasets,
+        )
+        partial_path = self.path.with_name(self.path.name + ".part")
+        with open(partial_path, "w") as file:
+            json.dump(state, file, indent=2)
+        os.replace(partial_path, self.path)
+        self._last_save_time = time.perf_counter()
+
+    def get_interfaces_to_write(self, fingerprints: Dict[str, str], replace_interfaces: List[str]) -> List[str]:
+        """The interfaces that are not in the complete file, whose fingerprint changed or that must be replaced."""
+        return [
+            interface_name
+            for interface_name, fingerprint in fingerprints.items()
+            if interface_name in replace_interfaces
+            or self.interfaces.get(interface_name, dict()).get("fingerprint") != fingerprint
+        ]
+
+    def can_resume(self, fingerprints: Dict[str, str]) -> bool:
+        """Whether the interrupted write of the file can be completed with interfaces of these fingerprints."""
+        if self.status != "writing" or not self.structure_written:
+            return False
+        if any(self.interfaces[name]["fingerprint"] != fingerprints.get(name) for name in self.written_interfaces):
+            return False
+        try:
+            with h5py.File(self.nwbfile_path, mode="r"):
+                return True
+        except OSError:  # The file was left unreadable
+            return False
+
+    def begin(self, interface_names: List[str], fingerprints: Dict[str, str]):
+        """Record that the objects of `interface_names` are (re)written, before the file is modified."""
+        self.status = "writing"
+        self.written_interfaces = list(interface_names)
+        self.structure_written = False
+        self.datasets = dict()
+        for interface_name in interface_names:
+            self.interfaces[interface_name] = dict(fingerprint=fingerprints[interface_name], object_ids=[])
+        self.save()
+
+    def set_interface_objects(self, object_ids_by_interface: Dict[str, set]):
+        """Record the objects added by the written interfaces, before the file is written."""
+        for interface_name in self.written_interfaces:
+            self.interfaces[interface_name]["object_ids"] = sorted(object_ids_by_interface.get(interface_name, set()))
+        self.save()
+
+    def complete(self):
+        """Record that the file is complete, with the paths of the objects of every written interface."""
+        object_paths = get_object_paths(self.nwbfile_path)
+        for interface_name in self.written_interfaces:
+            interface = self.interfaces[interface_name]
+            interface["object_paths"] = sorted(
+                object_paths[object_id] for object_id in interface["object_ids"] if object_id in object_paths
+            )
+        self.status = "complete"
+        self.datasets = dict()
+        self.save()
+
+    def add_chunk_write(
+        self, dataset: h5py.Dataset, chunk: Optional[DataChunk], read_seconds: float = 0.0, write_seconds: float = 0.0
+    ):
+        """Record the rows written by a chunk of a DataChunkIterator, a chunk callback of `HDF5WriteHooks`."""
+        progress = self.datasets.setdefault(dataset.name, dict(rows_written=0, complete=False))
+        if chunk is None:  # The iterator is exhausted
+            progress.update(rows_written=int(dataset.shape[0]), complete=True)
+        else:
+            complete_rows = _get_complete_rows(chunk.selection, dataset.shape)
+            if complete_rows is not None:
+                progress["rows_written"] = max(progress["rows_written"], complete_rows)
+
+        # The groups and datasets are all created before the first chunk is written
+        if not self.structure_written or time.perf_counter() - self._last_save_time >= self.checkpoint_interval:
+            self.structure_written = True
+            dataset.file.flush()
+            self.save()
+
+
+@contextmanager
+def make_or_load_checkpointed_nwbfile(
+    checkpoint: ConversionCheckpoint,
+    metadata: Optional[dict] = None,
+    append: bool = False,
+    verbose: bool = True,
+):
+    """
+    Same as `neuroconv.tools.nwb_helpers.make_or_load_nwbfile`, but the file is written so that it can be resumed.
+
+    Every group and dataset is created before the data chunks are written, so that a write interrupted while the
+    chunks are written leaves a file that only misses data. The progress of the write is saved in `checkpoint` when
+    `checkpoint.add_chunk_write` is a chunk callback of the `HDF5WriteHooks` installed around the context, as
+    `Embargo22ANWBConverter.run_conversion` does. With `append`, the file is opened to add objects to it.
+    """
+    io = NWBHDF5IO(str(checkpoint.nwbfile_path), mode="a" if append else "w", load_namespaces=append)
+    try:
+        nwbfile = io.read() if append else make_nwbfile_from_metadata(metadata=metadata)
+        yield nwbfile
+
+        io.write(nwbfile, exhaust_dci=False)
+        if verbose:
+            print(f"NWB file saved at {checkpoint.nwbfile_path}!")
+    finally:
+        io.close()
+
+
+def get_iterator_datasets(nwbfile: NWBFile) -> Dict[str, AbstractDataChunkIterator]:
+    """
+    The DataChunkIterators of an in-memory NWBFile, by the path of the dataset they are written to.
+
+    The datasets are in the order the HDF5 backend writes them, since an iterator may summarize the data read by an
+    earlier one (see `ImagingSummaryDataChunkIterator`).
+    """
+    iterator_datasets = dict()
+    builders = [("", get_manager().build(nwbfile))]
+    while builders:
+        path, builder = builders.pop()
+        for name, group_builder in reversed(builder.groups.items()):
+            builders.append((f"{path}/{name}", group_builder))
+        for name, dataset_builder in builder.datasets.items():
+            data = dataset_builder.data.data if isinstance(dataset_builder.data, DataIO) else dataset_builder.data
+            if isinstance(data, AbstractDataChunkIterator):
+                iterator_datasets[f"{path}/{name}"] = data
+    return iterator_datasets
+
+
+def fill_dataset(dataset: h5py.Dataset, data: AbstractDataChunkIterator, rows_written: int, buffer_mb: float = 64.0):
+    """
+    Write the rows of `data` after the first `rows_written` to `dataset`.
+
+    Iterators that can read a selection (`_get_data`) only read the missing rows; the chunks of other iterators are
+    read in order and those before `rows_written` are skipped.
+    """
+    num_rows = data.maxshape[0] if data.maxshape is not None and data.maxshape[0] is not None else None
+    if not hasattr(data, "_get_data") or num_rows is None:
+        for chunk in data:
+            selection = chunk.selection if isinstance(chunk.selection, tuple) else (chunk.selection,)
+            if selection[0].stop is not None and selection[0].stop <= rows_written:
+                continue
+            dataset.id.extend(chunk.get_min_bounds())
+            dataset[chunk.selection] = chunk.data
+        return
+
+    if dataset.shape[0] < num_rows:
+        dataset.resize(num_rows, axis=0)
+    bytes_per_row = np.dtype(data.dtype).itemsize * int(np.prod(data.maxshape[1:]))
+    rows_per_buffer = max(1, int(buffer_mb * 1e6 // max(1, bytes_per_row)))
+    if dataset.chunks is not None:  # Whole chunks are written at once
+        rows_per_buffer = max(dataset.chunks[0], rows_per_buffer // dataset.chunks[0] * dataset.chunks[0])
+        rows_written = rows_written // dataset.chunks[0] * dataset.chunks[0]
+    for start in range(rows_written, num_rows, rows_per_buffer):
+        selection = (slice(start, min(start + rows_per_buffer, num_rows)),)
+        selection += tuple(slice(0, length) for length in data.maxshape[1:])
+        dataset[selection] = data._get_data(selection)
+
+
+def resume_write(checkpoint: ConversionCheckpoint, nwbfile: NWBFile, verbose: bool = True):
+    """
+    Complete the write of the file of `checkpoint` from `nwbfile`, an in-memory copy of its written interfaces.
+
+    The rows of the datasets written from DataChunkIterators that the checkpoint does not record as written are
+    written, then the namespaces, cached at the end of a complete write, are written too.
+    """
+    with h5py.File(checkpoint.nwbfile_path, mode="a") as file:
+        for path, data in get_iterator_datasets(nwbfile).items():
+            progress = checkpoint.datasets.get(path, dict(rows_written=0, complete=False))
+            if path not in file or progress["complete"]:
+                continue
+            if verbose:
+                print(f"Resuming the write of {path} from row {progress['rows_written']}")
+            fill_dataset(dataset=file[path], data=data, rows_written=progress["rows_written"])
+
+    with warnings.catch_warnings():  # The namespaces were not cached yet
+        warnings.filterwarnings("ignore", message="No cached namespaces found")
+        io = NWBHDF5IO(str(checkpoint.nwbfile_path), mode="a", load_namespaces=True)
+    with io:
+        io.write(io.read())
+    checkpoint.complete()
+    if verbose:
+        print(f"NWB file saved at {checkpoint.nwbfile_path}!")
+
+
+def _get_soft_links(group: h5py.Group) -> List[tuple]:
+    """The (parent, name, target path) of every soft link under `group`."""
+    soft_links = []
+    for name in group:
+        link = group.get(name, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            soft_links.append((group, name, link.path))
+        elif isinstance(link, h5py.HardLink) and isinstance(group[name], h5py.Group):
+            soft_links.extend(_get_soft_links(group[name]))
+    return soft_links
+
+
+def remove_objects(nwbfile_path: FilePathType, object_paths: List[str]):
+    """
+    Delete the objects at `object_paths` from the NWB file, e.g. to replace the objects of an interface.
+
+    The metadata in `/general` (devices, imaging planes) is shared by the interfaces and kept; it is reused by name
+    when the objects are added again. Groups that contain objects not in `object_paths` are kept too, only their
+    listed objects are deleted. Datasets linked from the objects kept, such as shared timestamps, are copied to the
+    links. The space of the deleted objects is only reclaimed by repacking the file (`h5repack`).
+    """
+    object_paths = sorted(
+        {path for path in object_paths if not path.startswith("/general/")}, key=lambda path: path.count("/")
+    )
+    with h5py.File(nwbfile_path, mode="a") as file:
+
+        def is_removable(path: str) -> bool:
+            nested_object_paths = []
+            file[path].visititems(
+                lambda name, node: nested_object_paths.append(f"{path}/{name}") if "object_id" in node.attrs else None
+            )
+            return set(nested_object_paths) <= set(object_paths)
+
+        removed_paths = []
+        for path in object_paths:
+            is_nested = any(path.startswith(removed_path + "/") for removed_path in removed_paths)
+            if is_nested or path not in file or (isinstance(file[path], h5py.Group) and not is_removable(path)):
+                continue
+            removed_paths.append(path)
+
+        def is_removed(path: str) -> bool:
+            return any(path == removed_path or path.startswith(removed_path + "/") for removed_path in removed_paths)
+
+        for parent, name, target_path in _get_soft_links(file):
+            if is_removed(target_path) and not is_removed(f"{parent.name}/{name}"):
+                if not isinstance(file[target_path], h5py.Dataset):
+                    raise ValueError(f"'{parent.name}/{name}' links to '{target_path}', which cannot be removed.")
+                del parent[name]
+                file.copy(file[target_path], parent, name=name)
+
+        for path in removed_paths:
+            del file[path]
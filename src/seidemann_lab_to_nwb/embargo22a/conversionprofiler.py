@@ -0,0 +1,351 @@
+"""Opt-in instrumentation of a conversion: time, memory and I/O of every stage and statistics of every dataset."""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import h5py
+from hdmf.data_utils import DataChunk
+
+from neuroconv.utils import FilePathType
+
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of the process so far in MB, or None where `resource` is not available (Windows)."""
+    try:
+        import resource  # Not available on Windows
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3  # In bytes on macOS and KB elsewhere
+
+
+def read_io_counters() -> Optional[dict]:
+    """
+    Bytes read and written by the process so far, from `/proc/self/io` (Linux only, None elsewhere).
+
+    `read_bytes` and `written_bytes` count the storage I/O, so reads served from the page cache are not included.
+    `read_syscall_bytes` and `written_syscall_bytes` count the bytes passed to read and write calls, which do not
+    include the pages of memory-mapped files.
+    """
+    try:
+        with open("/proc/self/io", "r") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+    except OSError:
+        return None
+    return dict(
+        read_bytes=int(counters["read_bytes"]),
+        written_bytes=int(counters["write_bytes"]),
+        read_syscall_bytes=int(counters["rchar"]),
+        written_syscall_bytes=int(counters["wchar"]),
+    )
+
+
+def read_rss_bytes() -> Optional[int]:
+    """Current resident memory of the process (Linux only, None elsewhere)."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * page_size
+    except OSError:
+        return None
+
+
+def get_profile_report_path(nwbfile_path: FilePathType) -> Path:
+    """The report of `session.nwb` is saved next to it as `session.profile.json`."""
+    return Path(nwbfile_path).with_suffix(".profile.json")
+
+
+def get_nwbfile_bytes(nwbfile_path: FilePathType) -> int:
+    """Size of an HDF5 file, or of all the files of a Zarr store (a directory)."""
+    nwbfile_path = Path(nwbfile_path)
+    if nwbfile_path.is_dir():
+        return sum(path.stat().st_size for path in nwbfile_path.rglob("*") if path.is_file())
+    return nwbfile_path.stat().st_size
+
+
+class ConversionProfiler:
+    """
+    Record the wall time, CPU time, peak resident memory and I/O of named stages of a conversion.
+
+    Stages are opened with `stage(name)` and can be nested; a nested stage is recorded as `parent/name`, e.g.
+    `Behavior/trials`. A stage run more than once accumulates its measures. While a stage is open, the resident
+    memory is sampled every `sampling_interval` seconds in a background thread to find its peak.
+
+    `add_chunk_write` and `add_list_fill`, callbacks of `HDF5WriteHooks`, time the reads and the writes of every
+    dataset while an NWB file is written, and `get_report` combines the stages with the storage statistics of the
+    datasets in the written file (an HDF5 file or a Zarr store, whose writes are not timed).
+
+    A disabled profiler does nothing, so instrumented code does not need to check whether profiling is on.
+    """
+
+    def __init__(self, enabled: bool = True, sampling_interval: float = 0.05):
+        self.enabled = enabled
+        self.sampling_interval = sampling_interval
+        self.stages: Dict[str, dict] = dict()
+        self.dataset_writes: Dict[str, dict] = dict()
+        self.interface_object_ids: Dict[str, set] = dict()
+
+        self._open_stages = []
+        self._lock = threading.Lock()
+        self._stop_sampling = threading.Event()
+        self._sampling_thread = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure the code run inside the context as the stage `name`."""
+        if not self.enabled:
+            yield
+            return
+
+        full_name = "/".join([open_stage["name"] for open_stage in self._open_stages] + [name])
+        start_rss = read_rss_bytes()
+        open_stage = dict(
+            name=name,
+            start_time=time.perf_counter(),
+            start_cpu_time=time.process_time(),
+            start_rss=start_rss,
+            start_io=read_io_counters(),
+            peak_rss=start_rss or 0,
+        )
+        with self._lock:
+            self._open_stages.append(open_stage)
+        if len(self._open_stages) == 1:
+            self._start_sampling()
+
+        try:
+            yield
+        finally:
+            wall_seconds = time.perf_counter() - open_stage["start_time"]
+            cpu_seconds = time.process_time() - open_stage["start_cpu_time"]
+            end_rss = read_rss_bytes()
+            end_io = read_io_counters()
+            with self._lock:
+                self._open_stages.pop()
+            if not self._open_stages:
+                self._stop_sampling_thread()
+
+            if end_rss is None:  # Without /proc, only the peak of the whole process is known
+                peak_rss_mb = read_peak_rss_mb()
+                rss_increase_mb = None
+            else:
+                peak_rss_mb = max(open_stage["peak_rss"], end_rss) / 1e6
+                rss_increase_mb = (end_rss - open_stage["start_rss"]) / 1e6
+            measures = dict(
+                wall_seconds=wall_seconds,
+                cpu_seconds=cpu_seconds,
+                peak_rss_mb=peak_rss_mb,
+                rss_increase_mb=rss_increase_mb,
+            )
+            if end_io is not None:
+                measures.update({key: end_io[key] - open_stage["start_io"][key] for key in end_io})
+            self._add_stage_measures(full_name, measures)
+
+    def _add_stage_measures(self, name: str, measures: dict):
+        if name not in self.stages:
+            self.stages[name] = dict(calls=1, **measures)
+            return
+
+        stage = self.stages[name]
+        stage["calls"] += 1
+        for key, value in measures.items():
+            if value is None or stage.get(key) is None:
+                stage[key] = value
+            elif key == "peak_rss_mb":
+                stage[key] = max(stage[key], value)
+            else:
+                stage[key] += value
+
+    def _start_sampling(self):
+        self._stop_sampling.clear()
+        self._sampling_thread = threading.Thread(target=self._sample_memory, daemon=True)
+        self._sampling_thread.start()
+
+    def _stop_sampling_thread(self):
+        self._stop_sampling.set()
+        self._sampling_thread.join()
+        self._sampling_thread = None
+
+    def _sample_memory(self):
+        while not self._stop_sampling.wait(self.sampling_interval):
+            rss = read_rss_bytes()
+            if rss is None:
+                return
+            with self._lock:
+                for open_stage in self._open_stages:
+                    open_stage["peak_rss"] = max(open_stage["peak_rss"], rss)
+
+    def add_interface_objects(self, interface_name: str, object_ids: set):
+        """Attribute the NWB objects with `object_ids` (and their datasets) to the interface `interface_name`."""
+        if self.enabled:
+            self.interface_object_ids.setdefault(interface_name, set()).update(object_ids)
+
+    def _add_dataset_write(self, path: str, read_seconds: float, write_seconds: float, source_bytes: int):
+        dataset_write = self.dataset_writes.setdefault(path, dict(read_seconds=0.0, write_seconds=0.0, source_bytes=0))
+        dataset_write["read_seconds"] += read_seconds
+        dataset_write["write_seconds"] += write_seconds
+        dataset_write["source_bytes"] += source_bytes
+
+    def add_chunk_write(
+        self, dataset: h5py.Dataset, chunk: Optional[DataChunk], read_seconds: float, write_seconds: float
+    ):
+        """
+        Time a chunk of a DataChunkIterator written by the HDF5 backend, a chunk callback of `HDF5WriteHooks`.
+
+        The time spent producing the chunk (reading the source) is separated from the time spent writing it, which
+        includes the compression done by the HDF5 filters.
+        """
+        if self.enabled and chunk is not None:
+            self._add_dataset_write(dataset.name, read_seconds, write_seconds, chunk.data.nbytes)
+
+    def add_list_fill(self, dataset: h5py.Dataset, write_seconds: float):
+        """Time a dataset written at once by the HDF5 backend, a list fill callback of `HDF5WriteHooks`."""
+        if self.enabled:
+            self._add_dataset_write(dataset.name, 0.0, write_seconds, 0)
+
+    def get_dataset_statistics(self, nwbfile_path: FilePathType) -> List[dict]:
+        """Storage statistics of every dataset of the written file, with the write timings when they were recorded."""
+        interface_by_object_id = {
+            object_id: interface_name
+            for interface_name, object_ids in self.interface_object_ids.items()
+            for object_id in object_ids
+        }
+
+        def get_interface_name(dataset: h5py.Dataset) -> Optional[str]:
+            node = dataset
+            while node.name != "/":
+                object_id = node.attrs.get("object_id")
+                if object_id in interface_by_object_id:
+                    return interface_by_object_id[object_id]
+                node = node.parent
+            return None
+
+        statistics = []
+
+        def add_dataset_statistics(name: str, node):
+            if not isinstance(node, h5py.Dataset):
+                return
+            # The size of variable-length data (strings, ragged arrays) is not known without reading it
+            is_variable_length = h5py.check_vlen_dtype(node.dtype) is not None
+            logical_bytes = None if is_variable_length else int(node.size) * node.dtype.itemsize
+            stored_bytes = int(node.id.get_storage_size())
+            create_property_list = node.id.get_create_plist()  # Lists plugin filters too, unlike `compression`
+            filters = [
+                create_property_list.get_filter(index)[3].decode()
+                for index in range(create_property_list.get_nfilters())
+            ]
+            dataset_statistics = dict(
+                path=node.name,
+                interface=get_interface_name(node),
+                shape=list(node.shape),
+                dtype=str(node.dtype),
+                chunks=list(node.chunks) if node.chunks else None,
+                compression=node.compression,
+                compression_opts=node.compression_opts,
+                shuffle=node.shuffle,
+                filters=filters,
+                logical_bytes=logical_bytes,
+                stored_bytes=stored_bytes,
+                compression_ratio=logical_bytes / stored_bytes if logical_bytes and stored_bytes else None,
+            )
+            dataset_write = self.dataset_writes.get(node.name)
+            if dataset_write is not None and logical_bytes is not None:
+                total_seconds = dataset_write["read_seconds"] + dataset_write["write_seconds"]
+                dataset_statistics.update(
+                    dataset_write,
+                    throughput_mb_per_second=logical_bytes / 1e6 / total_seconds if total_seconds else None,
+                    write_throughput_mb_per_second=(
+                        logical_bytes / 1e6 / dataset_write["write_seconds"] if dataset_write["write_seconds"] else None
+                    ),
+                )
+            statistics.append(dataset_statistics)
+
+        if Path(nwbfile_path).is_dir():
+            return self._get_zarr_dataset_statistics(nwbfile_path, interface_by_object_id)
+        with h5py.File(nwbfile_path, mode="r") as file:
+            file.visititems(add_dataset_statistics)
+        return statistics
+
+    @staticmethod
+    def _get_zarr_dataset_statistics(nwbfile_path: FilePathType, interface_by_object_id: dict) -> List[dict]:
+        """Storage statistics of every array of a Zarr store, see `zarrbackend`."""
+        import zarr
+
+        root = zarr.open_group(str(nwbfile_path), mode="r")
+
+        def get_interface_name(path: str) -> Optional[str]:
+            parts = path.split("/")
+            for depth in range(len(parts), 0, -1):
+                object_id = root["/".join(parts[:depth])].attrs.get("object_id")
+                if object_id in interface_by_object_id:
+                    return interface_by_object_id[object_id]
+            return None
+
+        statistics = []
+
+        def add_array_statistics(path: str, node):
+            if not isinstance(node, zarr.Array):
+                return
+            logical_bytes = None if node.dtype.kind == "O" else int(node.nbytes)
+            stored_bytes = int(node.nbytes_stored)
+            statistics.append(
+                dict(
+                    path=f"/{path}",
+                    interface=get_interface_name(path),
+                    shape=list(node.shape),
+                    dtype=str(node.dtype),
+                    chunks=list(node.chunks),
+                    compression=node.compressor.codec_id if node.compressor is not None else None,
+                    filters=[codec.codec_id for codec in node.filters or []],
+                    logical_bytes=logical_bytes,
+                    stored_bytes=stored_bytes,
+                    compression_ratio=logical_bytes / stored_bytes if logical_bytes and stored_bytes else None,
+                )
+            )
+
+        root.visititems(add_array_statistics)
+        return statistics
+
+    def get_report(self, nwbfile_path: Optional[FilePathType] = None) -> dict:
+        """
+        The measures of every stage and, if the file at `nwbfile_path` was written, of every dataset.
+
+        Datasets are summed per interface: bytes read from the source by their iterators, bytes stored in the file
+        and the time spent reading and writing them.
+        """
+        datasets = self.get_dataset_statistics(nwbfile_path) if nwbfile_path is not None else []
+
+        interfaces = dict()
+        for interface_name in self.interface_object_ids:
+            interface_datasets = [dataset for dataset in datasets if dataset["interface"] == interface_name]
+            interfaces[interface_name] = dict(
+                stage=self.stages.get(interface_name),
+                num_datasets=len(interface_datasets),
+                source_bytes=sum(dataset.get("source_bytes", 0) for dataset in interface_datasets),
+                logical_bytes=sum(dataset["logical_bytes"] or 0 for dataset in interface_datasets),
+                stored_bytes=sum(dataset["stored_bytes"] for dataset in interface_datasets),
+                read_seconds=sum(dataset.get("read_seconds", 0.0) for dataset in interface_datasets),
+                write_seconds=sum(dataset.get("write_seconds", 0.0) for dataset in interface_datasets),
+            )
+
+        return dict(
+            created=datetime.now().isoformat(),
+            nwbfile_path=str(nwbfile_path) if nwbfile_path is not None else None,
+            nwbfile_bytes=get_nwbfile_bytes(nwbfile_path) if nwbfile_path is not None else None,
+            stages=self.stages,
+            interfaces=interfaces,
+            datasets=datasets,
+        )
+
+    def save_report(self, nwbfile_path: FilePathType) -> dict:
+        """Save the report of the conversion to `nwbfile_path` next to it, see `get_profile_report_path`."""
+        report = self.get_report(nwbfile_path=nwbfile_path)
+        with open(get_profile_report_path(nwbfile_path), "w") as file:
+            json.dump(report, file, indent=2, default=str)
+        return report
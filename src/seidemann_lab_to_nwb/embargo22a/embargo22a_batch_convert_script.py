@@ -0,0 +1,203 @@
+"""Convert every session found under a root folder (or listed in a manifest) in parallel."""
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional
+
+from seidemann_lab_to_nwb.embargo22a.conversioncheckpoint import get_checkpoint_path
+from seidemann_lab_to_nwb.embargo22a.sessionscanner import find_sessions, scan_session
+from embargo22a_convert_script import session_to_nwb
+
+
+def get_nwbfile_names(session_paths: List[Path], root_path: Optional[Path] = None) -> List[str]:
+    """
+    Names of the NWB files of the sessions, which must be unique.
+
+    A session under `root_path` is named by its path relative to it, with `_` between the folders (e.g.
+    `monkey1_2022-05-03.nwb`), so that sessions whose folders have the same name under different parents are kept
+    apart; other sessions (e.g. listed in a manifest) are named by their folder.
+    """
+    nwbfile_names = []
+    for session_path in session_paths:
+        session_path = Path(session_path)
+        name_parts = [session_path.name]
+        if root_path is not None:
+            try:
+                name_parts = session_path.resolve().relative_to(Path(root_path).resolve()).parts or name_parts
+            except ValueError:  # Not under the root
+                pass
+        nwbfile_names.append("_".join(name_parts) + ".nwb")
+
+    duplicate_names = sorted(name for name in set(nwbfile_names) if nwbfile_names.count(name) > 1)
+    if duplicate_names:
+        raise ValueError(f"Sessions would be written to the same NWB files: {duplicate_names}.")
+    return nwbfile_names
+
+
+def _remove_file(file_path: Path):
+    """Remove a file that may not exist (`Path.unlink(missing_ok=True)` needs Python 3.8)."""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def _limit_worker_memory(max_memory_gb: Optional[float]):
+    """Cap the address space of a worker process so a single session cannot exhaust the memory of the machine."""
+    if max_memory_gb is None:
+        return
+    import resource  # Not available on Windows
+
+    max_memory_bytes = int(max_memory_gb * 1e9)
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def _convert_session(data_path: Path, nwbfile_path: Path, stub_test: bool, checkpoint: bool = False) -> dict:
+    """
+    Convert one session to a temporary file that is only moved in place once the conversion succeeded.
+
+    With `checkpoint`, the temporary file of a failed conversion is kept with its checkpoint, and resumed by the next
+    conversion of the session.
+    """
+    start_time = time.perf_counter()
+    partial_nwbfile_path = nwbfile_path.with_name(nwbfile_path.name + ".part")
+    if not (checkpoint and get_checkpoint_path(partial_nwbfile_path).is_file()):
+        _remove_file(partial_nwbfile_path)  # Left by a worker that was killed, it cannot be resumed
+    try:
+        session_to_nwb(
+            data_path=data_path, nwbfile_path=partial_nwbfile_path, stub_test=stub_test, checkpoint=checkpoint
+        )
+        os.replace(partial_nwbfile_path, nwbfile_path)
+        if checkpoint:
+            os.replace(get_checkpoint_path(partial_nwbfile_path), get_checkpoint_path(nwbfile_path))
+        status, error = "converted", None
+    except Exception:
+        if not checkpoint:
+            _remove_file(partial_nwbfile_path)
+        status, error = "failed", traceback.format_exc()
+
+    return dict(
+        session_path=str(data_path),
+        nwbfile_path=str(nwbfile_path),
+        status=status,
+        error=error,
+        seconds=time.perf_counter() - start_time,
+    )
+
+
+def batch_convert(
+    session_paths: List[Path],
+    output_folder_path: Path,
+    max_workers: Optional[int] = None,
+    max_memory_gb_per_worker: Optional[float] = None,
+    stub_test: bool = False,
+    overwrite: bool = False,
+    checkpoint: bool = False,
+    preflight: bool = False,
+    root_path: Optional[Path] = None,
+) -> dict:
+    """
+    Convert sessions in a process pool and write `conversion_summary.json` to `output_folder_path`.
+
+    Outputs are written under a temporary name and renamed once complete, so an existing NWB file is always complete
+    and is skipped unless `overwrite` is True. With `checkpoint`, interrupted conversions are resumed. With
+    `preflight`, every session is first checked with `scan_session`, and the sessions with errors are not converted.
+    The NWB files are named by `get_nwbfile_names`, from the path of the sessions relative to `root_path`.
+    """
+    nwbfile_names = get_nwbfile_names(session_paths, root_path=root_path)
+    output_folder_path = Path(output_folder_path)
+    output_folder_path.mkdir(parents=True, exist_ok=True)
+    start_time = time.perf_counter()
+
+    results = []
+    sessions_to_convert = []
+    for session_path, nwbfile_name in zip(session_paths, nwbfile_names):
+        nwbfile_path = output_folder_path / nwbfile_name
+        if nwbfile_path.exists() and not overwrite:
+            results.append(dict(session_path=str(session_path), nwbfile_path=str(nwbfile_path), status="skipped"))
+            continue
+        problems = scan_session(session_path)["problems"] if preflight else []
+        if any(problem["severity"] == "error" for problem in problems):
+            results.append(
+                dict(
+                    session_path=str(session_path), nwbfile_path=str(nwbfile_path), status="invalid", problems=problems
+                )
+            )
+            print(f"invalid: {session_path}")
+        else:
+            sessions_to_convert.append((Path(session_path), nwbfile_path))
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_limit_worker_memory, initargs=(max_memory_gb_per_worker,)
+    ) as executor:
+        futures = [
+            executor.submit(
+                _convert_session,
+                data_path=data_path,
+                nwbfile_path=nwbfile_path,
+                stub_test=stub_test,
+                checkpoint=checkpoint,
+            )
+            for data_path, nwbfile_path in sessions_to_convert
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"{result['status']}: {result['session_path']} ({result['seconds']:.1f} s)")
+
+    summary = dict(
+        total_seconds=time.perf_counter() - start_time,
+        max_workers=max_workers or os.cpu_count(),
+        num_converted=sum(result["status"] == "converted" for result in results),
+        num_skipped=sum(result["status"] == "skipped" for result in results),
+        num_failed=sum(result["status"] == "failed" for result in results),
+        num_invalid=sum(result["status"] == "invalid" for result in results),
+        sessions=sorted(results, key=lambda result: result["session_path"]),
+    )
+    with open(output_folder_path / "conversion_summary.json", "w") as file:
+        json.dump(summary, file, indent=2)
+
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", type=Path, help="Folder searched recursively for sessions.")
+    parser.add_argument("--manifest", type=Path, help="Text file with one session folder per line.")
+    parser.add_argument("--output", type=Path, required=True, help="Folder where the NWB files are written.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--max-memory-gb", type=float, default=None, help="Address space limit per worker.")
+    parser.add_argument("--stub-test", action="store_true")
+    parser.add_argument("--overwrite", action="store_true", help="Convert sessions that already have an output.")
+    parser.add_argument(
+        "--checkpoint", action="store_true", help="Save the progress of the conversions to resume the failed ones."
+    )
+    parser.add_argument(
+        "--preflight", action="store_true", help="Check the sessions first and only convert those without errors."
+    )
+    args = parser.parse_args()
+
+    if args.root is None and args.manifest is None:
+        parser.error("one of --root or --manifest is required")
+
+    session_paths = find_sessions(root_path=args.root, manifest_path=args.manifest)
+    print(f"Found {len(session_paths)} sessions")
+    summary = batch_convert(
+        session_paths=session_paths,
+        output_folder_path=args.output,
+        max_workers=args.workers,
+        max_memory_gb_per_worker=args.max_memory_gb,
+        stub_test=args.stub_test,
+        overwrite=args.overwrite,
+        checkpoint=args.checkpoint,
+        preflight=args.preflight,
+        root_path=args.root,
+    )
+    print(
+        f"Converted {summary['num_converted']}, skipped {summary['num_skipped']}, failed {summary['num_failed']}, "
+        f"invalid {summary['num_invalid']}"
+    )
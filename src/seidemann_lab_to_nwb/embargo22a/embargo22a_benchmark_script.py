@@ -0,0 +1,230 @@
+"""Time and memory-profile every stage of the conversion on synthetic sessions of increasing size."""
+import argparse
+import json
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from seidemann_lab_to_nwb.embargo22a.conversionprofiler import read_peak_rss_mb
+from seidemann_lab_to_nwb.embargo22a.syntheticsession import generate_session, raw_file_name
+from conversion_parameters import num_channels, rows_axis, columns_axis, num_channels_axis, frame_axis
+
+session_sizes = dict(
+    small=dict(num_trials=20, num_rows=64, num_columns=64, num_rois=50),
+    medium=dict(num_trials=100, num_rows=256, num_columns=256, num_rois=200),
+    large=dict(num_trials=400, num_rows=512, num_columns=512, num_rois=500),
+)
+stages = ["metadata", "imaging_timestamps", "imaging", "segmentation", "trials", "events", "continuous_behavior"]
+
+
+class StageMeasurement:
+    """Measure the wall time, CPU time and peak resident memory of the code run inside the context."""
+
+    def __enter__(self):
+        self.start_rss_mb = read_peak_rss_mb()
+        self.start_cpu_time = time.process_time()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.wall_seconds = time.perf_counter() - self.start_time
+        self.cpu_seconds = time.process_time() - self.start_cpu_time
+        self.peak_rss_mb = read_peak_rss_mb()
+
+    def to_dict(self) -> dict:
+        return dict(
+            wall_seconds=self.wall_seconds,
+            cpu_seconds=self.cpu_seconds,
+            peak_rss_mb=self.peak_rss_mb,
+            rss_increase_mb=None if self.peak_rss_mb is None else max(0.0, self.peak_rss_mb - self.start_rss_mb),
+        )
+
+
+def get_source_data(stream_path: Path, num_rows: int, num_columns: int) -> dict:
+    return dict(
+        Imaging=dict(
+            file_path=str(stream_path / raw_file_name),
+            num_rows=num_rows,
+            num_columns=num_columns,
+            num_channels=num_channels,
+            rows_axis=rows_axis,
+            columns_axis=columns_axis,
+            channels_axis=num_channels_axis,
+            frame_axis=frame_axis,
+            sampling_frequency=30.0,
+            dtype="uint16",
+        ),
+        Suit2P=dict(folder_path=str(stream_path / "suite2p")),
+        Behavior=dict(session_path=str(stream_path)),
+    )
+
+
+def run_stage(stage: str, source_data: dict, cache_folder_path: Path, nwbfile_path: Path) -> dict:
+    """Run a single stage in the current process; the session cache is warm for every stage but `metadata`."""
+    from pynwb import NWBHDF5IO
+    from neuroconv.tools.nwb_helpers import make_nwbfile_from_metadata
+
+    from seidemann_lab_to_nwb.embargo22a import embargo22asessionloader, Embargo22ANWBConverter
+
+    embargo22asessionloader.default_cache_folder_path = Path(cache_folder_path)
+
+    if stage == "metadata":  # Cold start: the MAT file and the events are parsed
+        shutil.rmtree(cache_folder_path, ignore_errors=True)
+        with StageMeasurement() as measurement:
+            converter = Embargo22ANWBConverter(source_data=source_data)
+            converter.get_metadata()
+        return measurement.to_dict()
+
+    converter = Embargo22ANWBConverter(source_data=source_data)
+    converter.verbose = False
+    metadata = converter.get_metadata()
+    imaging_interface = converter.data_interface_objects["Imaging"]
+    imaging_interface.verbose = False
+    segmentation_interface = converter.data_interface_objects["Suit2P"]
+    behavior_interface = converter.data_interface_objects["Behavior"]
+
+    if stage == "imaging_timestamps":
+        with StageMeasurement() as measurement:
+            converter.add_time_stamps_to_imaging_extractor()
+        return measurement.to_dict()
+
+    # The other stages add their objects to an empty file and write it, iterators are only consumed on write
+    nwbfile = make_nwbfile_from_metadata(metadata=metadata)
+    with StageMeasurement() as measurement:
+        if stage == "imaging":
+            imaging_interface.run_conversion(nwbfile=nwbfile, metadata=metadata)
+        elif stage == "segmentation":
+            segmentation_interface.run_conversion(nwbfile=nwbfile, metadata=metadata)
+        elif stage == "trials":
+            behavior_interface.add_trials(nwbfile)
+        elif stage == "events":
+            behavior_interface.add_events(nwbfile)
+        elif stage == "continuous_behavior":
+            time_base = behavior_interface.add_eye_tracking(nwbfile)
+            behavior_interface.add_photodiode(nwbfile, timestamps=time_base)
+        else:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {stages}.")
+
+        with NWBHDF5IO(str(nwbfile_path), mode="w") as io:
+            io.write(nwbfile)
+
+    result = measurement.to_dict()
+    result.update(output_mb=nwbfile_path.stat().st_size / 1e6)
+    nwbfile_path.unlink()
+    return result
+
+
+def run_benchmark(
+    sizes: List[str], working_folder_path: Path, stages_to_run: Optional[List[str]] = None, repeats: int = 1
+) -> List[dict]:
+    """
+    Generate a session of every size and run each stage `repeats` times, keeping the fastest run.
+
+    Every run happens in a fresh process so the peak memory of a stage does not include the other stages.
+    """
+    stages_to_run = stages_to_run or stages
+    spawn_context = multiprocessing.get_context("spawn")
+
+    results = []
+    for size in sizes:
+        session_parameters = session_sizes[size]
+        session_path = working_folder_path / size
+        start_time = time.perf_counter()
+        stream_path = generate_session(data_path=session_path, **session_parameters)
+        print(f"Generated the {size} session in {time.perf_counter() - start_time:.1f} s")
+
+        source_data = get_source_data(stream_path, session_parameters["num_rows"], session_parameters["num_columns"])
+        cache_folder_path = working_folder_path / f"{size}_cache"
+
+        # The cache must exist for the warm stages, even when the metadata stage is not benchmarked
+        stages_in_order = stages_to_run if "metadata" in stages_to_run else ["metadata"] + stages_to_run
+        for stage in stages_in_order:
+            runs = []
+            for _ in range(repeats):
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                    future = executor.submit(
+                        run_stage, stage, source_data, cache_folder_path, working_folder_path / f"{stage}.nwb"
+                    )
+                    runs.append(future.result())
+            if stage not in stages_to_run:
+                continue
+
+            result = min(runs, key=lambda run: run["wall_seconds"])
+            result.update(size=size, stage=stage, **session_parameters)
+            results.append(result)
+            print(
+                f"{size:>8} {stage:>20}: {result['wall_seconds']:8.2f} s wall, {result['cpu_seconds']:8.2f} s CPU, "
+                f"{result['peak_rss_mb'] or float('nan'):8.1f} MB peak"
+            )
+
+        shutil.rmtree(session_path)
+        shutil.rmtree(cache_folder_path, ignore_errors=True)
+
+    return results
+
+
+def find_regressions(
+    results: List[dict], baseline_results: List[dict], tolerance: float = 1.5, min_wall_seconds: float = 1.0
+) -> List[str]:
+    """
+    Stages whose wall time or peak memory grew by more than `tolerance` times their value in the baseline.
+
+    Wall times are compared to at least `min_wall_seconds`, so that the noise of the stages that take a few
+    milliseconds is not reported.
+    """
+    baseline = {(result["size"], result["stage"]): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get((result["size"], result["stage"]))
+        if baseline_result is None:
+            continue
+        for measure in ["wall_seconds", "peak_rss_mb"]:
+            if result[measure] is None or baseline_result[measure] is None:  # Memory is not measured on Windows
+                continue
+            baseline_value = baseline_result[measure]
+            if measure == "wall_seconds":
+                baseline_value = max(baseline_value, min_wall_seconds)
+            if result[measure] > tolerance * baseline_value:
+                regressions.append(
+                    f"{result['size']} {result['stage']}: {measure} {result[measure]:.2f} "
+                    f"(baseline {baseline_result[measure]:.2f})"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", choices=list(session_sizes), default=["small"])
+    parser.add_argument("--stages", nargs="+", choices=stages, default=None, help="Stages to run (default: all).")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs of every stage; the fastest is kept.")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--working-folder", type=Path, default=None, help="Where sessions are generated.")
+    parser.add_argument("--baseline", type=Path, default=None, help="Results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed ratio to the baseline.")
+    parser.add_argument(
+        "--min-wall-seconds", type=float, default=1.0, help="Shorter baseline wall times are compared as this value."
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.working_folder) as working_folder:
+        results = run_benchmark(
+            sizes=args.sizes, working_folder_path=Path(working_folder), stages_to_run=args.stages, repeats=args.repeats
+        )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved at {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline_results = json.load(file)
+        regressions = find_regressions(
+            results, baseline_results, tolerance=args.tolerance, min_wall_seconds=args.min_wall_seconds
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
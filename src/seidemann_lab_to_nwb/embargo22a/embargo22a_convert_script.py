@@ -1,68 +1,111 @@
 """Primary script to run to convert an entire session of data using the NWBConverter."""
+import shutil
 from pathlib import Path
+from typing import List, Optional
 from datetime import datetime
 from dateutil import tz
 
 from neuroconv.utils import load_dict_from_file, dict_deep_update
 
 from seidemann_lab_to_nwb.embargo22a import Embargo22ANWBConverter
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
 from conversion_parameters import rows, columns, num_channels, rows_axis, columns_axis, num_channels_axis, frame_axis
 
-data_path = Path("/home/heberto/seidemann/loki20210127/")
-output_path = Path("/home/heberto/nwb/")
-stub_test = True
-
-
-if stub_test:
-    output_path = output_path.parent / "nwb_stub"
-
-session_id = data_path.stem
-
-
-source_data = dict()
-conversion_options = dict()
-
-# Imaging
-sampling_frequency = 30.0
-dtype = "uint16"
-file_path = data_path / "stream" / "Image_001_001.raw"
-imaging_parameters = dict(
-    file_path=str(file_path),
-    num_rows=rows,
-    num_columns=columns,
-    num_channels=num_channels,
-    rows_axis=rows_axis,
-    columns_axis=columns_axis,
-    channels_axis=num_channels_axis,
-    frame_axis=frame_axis,
-    sampling_frequency=sampling_frequency,
-    dtype=dtype,
-)
-source_data.update(Imaging=imaging_parameters)
-conversion_options.update(Imaging=dict(stub_test=stub_test))
-
-# Suite2P
-plane_no = 0
-folder_path = data_path / "stream" / "suite2p"
-source_data.update(Suit2P=dict(file_path=str(folder_path), plane_no=plane_no))
-
-# Behavior
-session_path = data_path / "stream"
-source_data.update(Behavior=dict(session_path=str(session_path)))
-
-converter = Embargo22ANWBConverter(source_data=source_data)
-
-# Metadata
-metadata = converter.get_metadata()
-metadata_path = Path(__file__).parent / "embargo22a_metadata.yml"
-metadata_from_yaml = load_dict_from_file(metadata_path)
-metadata = dict_deep_update(metadata, metadata_from_yaml, append_list=False)
-
-nwb_file_name = f"{session_id}.nwb"
-nwbfile_path = output_path / nwb_file_name
-converter.run_conversion(
-    nwbfile_path=str(nwbfile_path),
-    metadata=metadata,
-    conversion_options=conversion_options,
-    overwrite=True,
-)
+
+def session_to_nwb(
+    data_path: Path,
+    nwbfile_path: Path,
+    stub_test: bool = False,
+    stub_trials: int = 3,
+    profile: bool = False,
+    backend: str = "hdf5",
+    number_of_jobs: Optional[int] = None,
+    checkpoint: bool = False,
+    replace_interfaces: Optional[List[str]] = None,
+):
+    """
+    Convert the session stored in `data_path` to the NWB file at `nwbfile_path`.
+
+    With `stub_test`, only the first `stub_trials` trials of every interface are written.
+    With `profile`, a report of the time, memory and I/O of every stage is saved next to the NWB file.
+    With `backend="zarr"`, the session is written in parallel by `number_of_jobs` threads to a Zarr store next to the
+    NWB file, which is then consolidated into the HDF5 file at `nwbfile_path` and removed. With the HDF5 backend,
+    `number_of_jobs` threads compress the chunks of the imaging data.
+    With `checkpoint`, the progress of the conversion is saved next to the NWB file: an interrupted conversion is
+    resumed, and an existing file only gets the objects of the interfaces that changed or are listed in
+    `replace_interfaces` rewritten.
+    """
+    data_path = Path(data_path)
+
+    source_data = dict()
+    conversion_options = dict()
+
+    # Imaging
+    sampling_frequency = 30.0
+    dtype = "uint16"
+    file_path = data_path / "stream" / "Image_001_001.raw"
+    imaging_parameters = dict(
+        file_path=str(file_path),
+        num_rows=rows,
+        num_columns=columns,
+        num_channels=num_channels,
+        rows_axis=rows_axis,
+        columns_axis=columns_axis,
+        channels_axis=num_channels_axis,
+        frame_axis=frame_axis,
+        sampling_frequency=sampling_frequency,
+        dtype=dtype,
+    )
+    source_data.update(Imaging=imaging_parameters)
+    conversion_options.update(Imaging=dict(write_trial_summaries=True))
+
+    # Suite2P, every plane of the folder is converted
+    folder_path = data_path / "stream" / "suite2p"
+    source_data.update(Suit2P=dict(folder_path=str(folder_path)))
+
+    # Behavior
+    session_path = data_path / "stream"
+    source_data.update(Behavior=dict(session_path=str(session_path)))
+
+    converter = Embargo22ANWBConverter(source_data=source_data, profile=profile)
+
+    # Metadata
+    metadata = converter.get_metadata()
+    metadata_path = Path(__file__).parent / "embargo22a_metadata.yml"
+    metadata_from_yaml = load_dict_from_file(metadata_path)
+    metadata = dict_deep_update(metadata, metadata_from_yaml, append_list=False)
+
+    nwbfile_path = Path(nwbfile_path)
+    zarr_path = nwbfile_path.with_suffix(".nwb.zarr")
+    converter.run_conversion(
+        nwbfile_path=str(zarr_path if backend == "zarr" else nwbfile_path),
+        metadata=metadata,
+        conversion_options=conversion_options,
+        overwrite=not checkpoint,
+        preview_trials=stub_trials if stub_test else None,
+        backend=backend,
+        number_of_jobs=number_of_jobs,
+        checkpoint=checkpoint,
+        replace_interfaces=replace_interfaces,
+    )
+
+    if backend == "zarr":
+        from seidemann_lab_to_nwb.embargo22a.zarrbackend import consolidate_to_hdf5
+
+        compression_policy = CompressionPolicy.from_dict(metadata.get("Compression"))
+        consolidate_to_hdf5(zarr_path=zarr_path, nwbfile_path=nwbfile_path, compression_policy=compression_policy)
+        shutil.rmtree(zarr_path)
+
+
+if __name__ == "__main__":
+    data_path = Path("/home/heberto/seidemann/loki20210127/")
+    output_path = Path("/home/heberto/nwb/")
+    stub_test = True
+
+    if stub_test:
+        output_path = output_path.parent / "nwb_stub"
+
+    session_id = data_path.stem
+    nwb_file_name = f"{session_id}.nwb"
+    nwbfile_path = output_path / nwb_file_name
+    session_to_nwb(data_path=data_path, nwbfile_path=nwbfile_path, stub_test=stub_test)
@@ -0,0 +1,49 @@
+"""Check the layout and consistency of sessions before converting them, in seconds per session."""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from seidemann_lab_to_nwb.embargo22a.sessionscanner import find_sessions, scan_session
+
+
+def print_report(report: dict):
+    problems = report["problems"]
+    status = "error" if any(problem["severity"] == "error" for problem in problems) else "ok"
+    status = "warning" if status == "ok" and problems else status
+    print(f"{status}: {report['session_path']} ({report['seconds']:.2f} s)")
+    for problem in problems:
+        print(f"  {problem['severity']} [{problem['check']}] {problem['message']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", type=Path, nargs="+", help="Session folders, or folders searched for sessions.")
+    parser.add_argument("--rows", type=int, default=None, help="Rows of the imaging frames.")
+    parser.add_argument("--columns", type=int, default=None, help="Columns of the imaging frames.")
+    parser.add_argument("--dtype", default=None, help="Data type of the raw imaging file, e.g. uint16.")
+    parser.add_argument("--frames-per-trial", type=int, default=75)
+    parser.add_argument("--output", type=Path, default=None, help="JSON file where the reports are written.")
+    args = parser.parse_args()
+
+    imaging_parameters = dict(num_rows=args.rows, num_columns=args.columns, dtype=args.dtype)
+    imaging_parameters = {key: value for key, value in imaging_parameters.items() if value is not None}
+
+    session_paths = []
+    for path in args.paths:
+        session_paths += [path] if (path / "stream").is_dir() else find_sessions(root_path=path, complete_only=False)
+
+    reports = []
+    for session_path in dict.fromkeys(session_paths):
+        report = scan_session(
+            session_path, imaging_parameters=imaging_parameters, frames_per_trial=args.frames_per_trial
+        )
+        print_report(report)
+        reports.append(report)
+
+    num_failed = sum(any(problem["severity"] == "error" for problem in report["problems"]) for report in reports)
+    print(f"Scanned {len(reports)} sessions, {num_failed} with errors")
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+    sys.exit(1 if num_failed else 0)
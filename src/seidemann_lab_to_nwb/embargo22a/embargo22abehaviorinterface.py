@@ -1,32 +1,40 @@
 """Primary class defining conversion of experiment-specific behavior."""
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
-import pandas as pd
-import scipy.io as sio
-from pymatreader import read_mat
 
 from pynwb import NWBFile, TimeSeries
+from pynwb.device import Device
+from pynwb.epoch import TimeIntervals
 from pynwb.ecephys import ElectricalSeries, LFP, ElectrodeGroup
 from pynwb.behavior import EyeTracking, SpatialSeries
 from neuroconv.basedatainterface import BaseDataInterface
 from neuroconv.utils.types import FolderPathType
 from ndx_events import LabeledEvents
 from neuroconv.tools.nwb_helpers import get_module
-from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.common import VectorData
+
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
+from seidemann_lab_to_nwb.embargo22a.conversionprofiler import ConversionProfiler
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import get_session_loader
+from seidemann_lab_to_nwb.embargo22a.trialdatachunkiterator import TrialDataChunkIterator
 
 
 class Embargo22ABehaviorInterface(BaseDataInterface):
     """My behavior interface docstring"""
 
+    profiler = ConversionProfiler(enabled=False)  # Replaced by the profiler of the converter
+    compression_policy = CompressionPolicy()  # Replaced by the policy of the conversion
+
     def __init__(self, session_path: FolderPathType):
         super().__init__(session_path=session_path)
 
         self.session_path = Path(self.source_data["session_path"])
+        self.session_loader = get_session_loader(session_path=self.session_path)
 
         # Get the smallest timestamp
-        file_path_events = self.session_path / "events.csv"
-        self.smallest_timestamp = pd.read_csv(file_path_events).Timestamp.min()  # In seconds
+        self.smallest_timestamp = self.session_loader.smallest_timestamp  # In seconds
 
     def get_metadata(self):
         # Automatically retrieve as much metadata as possible
@@ -34,39 +42,130 @@ class Embargo22ABehaviorInterface(BaseDataInterface):
         empty_metadata = dict()
         return empty_metadata
 
-    def run_conversion(self, nwbfile: NWBFile, metadata: dict):
-        file_path = self.session_path / "M22D20210127R0Data2P20201001.mat"
-        data_simple = read_mat(str(file_path), variable_names=["TS"], ignore_fields=["nTrial", "FileName", "Sync"])
-        trial_structure = data_simple["TS"]
-
-        self.add_trials(nwbfile, trial_structure)
-        self.add_events(nwbfile, trial_structure)
-
-        # Add extra signals
-        trial_data = trial_structure["Trial"]
-        df_trial_data = pd.DataFrame(trial_data)
-        timestamps = np.concatenate([row["Timestamp"] for row in df_trial_data["Database"]])
-        timestamps -= self.smallest_timestamp
+    def run_conversion(
+        self,
+        nwbfile: NWBFile,
+        metadata: dict,
+        trials_per_block: int = 10,
+        add_lfp: bool = False,
+        add_ekg: bool = False,
+        stop_time: Optional[float] = None,
+    ):
+        """
+        Add trials, events and the continuous signals of the Database structure to the nwbfile.
+
+        The continuous signals are written one block of `trials_per_block` trials at a time.
+        LFP and EKG are junk data for these recordings and are only written on request.
+        If `stop_time` is given (in seconds), only the trials that start, the events and the samples that occur before
+        it are written, e.g. to preview a session.
+        """
+        with self.profiler.stage("trials"):
+            self.add_trials(nwbfile, stop_time=stop_time)
+        with self.profiler.stage("events"):
+            self.add_events(nwbfile, stop_time=stop_time)
+
+        # Add extra signals, all sampled on the Database time base which is only written once
+        with self.profiler.stage("trial_offsets"):
+            trial_offsets = self.get_trial_offsets(stop_time=stop_time)
+        with self.profiler.stage("eye_tracking"):
+            time_base = self.add_eye_tracking(nwbfile, trials_per_block=trials_per_block, trial_offsets=trial_offsets)
+        with self.profiler.stage("photodiode"):
+            self.add_photodiode(
+                nwbfile, timestamps=time_base, trials_per_block=trials_per_block, trial_offsets=trial_offsets
+            )
+        if add_lfp:
+            with self.profiler.stage("lfp"):
+                self.add_lfp(
+                    nwbfile, timestamps=time_base, trials_per_block=trials_per_block, trial_offsets=trial_offsets
+                )
+        if add_ekg:
+            with self.profiler.stage("ekg"):
+                self.add_ekg(
+                    nwbfile, timestamps=time_base, trials_per_block=trials_per_block, trial_offsets=trial_offsets
+                )
+
+    def get_trial_offsets(self, stop_time: Optional[float] = None) -> np.ndarray:
+        """
+        Sample index where the Database signals of each trial start, with the number of samples to write appended.
+
+        If `stop_time` is given (in seconds), the offsets are cut at the first sample at or after it.
+        """
+        trial_offsets = self.session_loader.database_offsets
+        if stop_time is None:
+            return trial_offsets
+
+        database_timestamps = self.session_loader.database["Timestamp"]
+        stop_sample = int(np.searchsorted(database_timestamps, stop_time + self.smallest_timestamp, side="left"))
+        num_trials = int(np.searchsorted(trial_offsets, stop_sample, side="left"))
+        return np.append(trial_offsets[:num_trials], stop_sample)
+
+    def get_database_iterator(
+        self, signal_name: str, columns=None, trials_per_block: int = 10, trial_offsets: Optional[np.ndarray] = None
+    ) -> TrialDataChunkIterator:
+        """Iterator over a Database signal that only holds `trials_per_block` trials in memory."""
+        return TrialDataChunkIterator(
+            data=self.session_loader.database[signal_name],
+            trial_offsets=self.session_loader.database_offsets if trial_offsets is None else trial_offsets,
+            columns=columns,
+            trials_per_block=trials_per_block,
+        )
 
+    def get_timestamps(
+        self,
+        timestamps: Optional[TimeSeries] = None,
+        trials_per_block: int = 10,
+        trial_offsets: Optional[np.ndarray] = None,
+        series_name: str = "Database",
+    ):
+        """
+        Timestamps for a series on the Database time base.
+
+        If `timestamps` is a TimeSeries already holding them, it is returned so the new series links to its
+        timestamps. Otherwise an iterator over the Database timestamps relative to the smallest timestamp of the
+        session is returned, compressed as the `{series_name}/timestamps` dataset.
+        """
+        if timestamps is not None:
+            return timestamps
+
+        iterator = TrialDataChunkIterator(
+            data=self.session_loader.database["Timestamp"],
+            trial_offsets=self.session_loader.database_offsets if trial_offsets is None else trial_offsets,
+            subtract=self.smallest_timestamp,
+            trials_per_block=trials_per_block,
+        )
+        return self.compression_policy.wrap(f"{series_name}/timestamps", iterator)
+
+    def add_eye_tracking(
+        self,
+        nwbfile: NWBFile,
+        timestamps: Optional[TimeSeries] = None,
+        trials_per_block: int = 10,
+        trial_offsets: Optional[np.ndarray] = None,
+    ) -> SpatialSeries:
         # Eye tracking
         # [x,y,pupil size]
-        eye_tracking_data = np.concatenate([row["Eyes"] for row in df_trial_data["Database"]])
         spatial_series_eyes = SpatialSeries(
             name="pupil_position",
             description="(x, y)",
-            data=H5DataIO(eye_tracking_data[:, [0, 1]], compression="gzip"),
+            data=self.compression_policy.wrap(
+                "pupil_position/data", self.get_database_iterator("Eyes", [0, 1], trials_per_block, trial_offsets)
+            ),
             reference_frame="unknown",
             unit="degrees",
-            timestamps=timestamps,
+            timestamps=self.get_timestamps(
+                timestamps, trials_per_block=trials_per_block, trial_offsets=trial_offsets, series_name="pupil_position"
+            ),
         )
 
         spatial_series_pupil_size = SpatialSeries(
             name="pupil_size",
             description="the size of the pupils.",
-            data=H5DataIO(eye_tracking_data[:, 2], compression="gzip"),
+            data=self.compression_policy.wrap(
+                "pupil_size/data", self.get_database_iterator("Eyes", 2, trials_per_block, trial_offsets)
+            ),
             reference_frame="unknown",
             unit="arbitrary",
-            timestamps=timestamps,
+            timestamps=spatial_series_eyes,
         )
 
         name = "EyeTracking"
@@ -75,116 +174,147 @@ class Embargo22ABehaviorInterface(BaseDataInterface):
         behavior_module = get_module(nwbfile, "behavior")
         behavior_module.add(eye_tracking_object)
 
+        return spatial_series_eyes
+
+    def add_photodiode(
+        self,
+        nwbfile: NWBFile,
+        timestamps: Optional[TimeSeries] = None,
+        trials_per_block: int = 10,
+        trial_offsets: Optional[np.ndarray] = None,
+    ):
         # Photo-Diodes
-        photodiode_data = np.concatenate([row["Photodiode"] for row in df_trial_data["Database"]])
         photodiode_unit = "arbitrary"  # To ask authors
         name = "TimeSeriesPhotodiode"
         photodiode_time_series = TimeSeries(
-            name=name, data=H5DataIO(photodiode_data, compression="gzip"), unit=photodiode_unit, timestamps=timestamps
+            name=name,
+            data=self.compression_policy.wrap(
+                f"{name}/data", self.get_database_iterator("Photodiode", None, trials_per_block, trial_offsets)
+            ),
+            unit=photodiode_unit,
+            timestamps=self.get_timestamps(
+                timestamps, trials_per_block=trials_per_block, trial_offsets=trial_offsets, series_name=name
+            ),
         )
 
         nwbfile.add_acquisition(photodiode_time_series)
 
-        # LFP AND EKG are junk data for these recordings
-        # LFP
-        # name = "LFP"
-        # location = "Left visual cortex"
-
-        # lfp_device = "LFP_device"  # To find out
-        # lfp_device_description = "TBD"
-        # lfp_manufacturer = "TBD"
-        # device = Device(name=lfp_device, description=lfp_device_description, manufacturer=lfp_manufacturer)
-        # nwbfile.add_device(devices=[device])
-
-        # lfp_electrode_group_name = "LFP_electrodes"
-        # lfp_electrode_group = ElectrodeGroup(
-        #     name=lfp_electrode_group_name, description="LFP Electrodes", location=location, device=device
-        # )
-        # nwbfile.add_electrode_group(electrode_groups=[lfp_electrode_group])
-
-        # nwbfile.add_electrode(
-        #     x=np.nan, y=np.nan, z=np.nan, imp=-1.0, location=location, filtering="none", group=lfp_electrode_group
-        # )
-        # nwbfile.add_electrode(
-        #     x=np.nan, y=np.nan, z=np.nan, imp=-1.0, location=location, filtering="none", group=lfp_electrode_group
-        # )
-
-        # region = [0, 1]
-        # electrode_table_region = nwbfile.create_electrode_table_region(region=region, description="LFP table region")
-
-        # LFP_data = np.concatenate([row["LFP"] for row in df_trial_data["Database"]])
-        # electrical_series = ElectricalSeries(
-        #     name="ElectricalSeriesLFP",
-        #     data=H5DataIO(LFP_data, compression="gzip"),
-        #     electrodes=electrode_table_region,
-        #     timestamps=timestamps,
-        # )
-
-        # LFP_object = LFP(electrical_series=electrical_series, name="LFP")
-        # nwbfile.add_acquisition(LFP_object)
-
-        # # EKG
-        # ekg_unit = "V"  # To ask authors
-        # name = "EKG"
-        # ekg_data = np.concatenate([row["EKG"] for row in df_trial_data["Database"]])
-
-        # ekg_time_series = TimeSeries(
-        #     name=name, data=H5DataIO(ekg_data, compression="gzip"), unit=ekg_unit, timestamps=timestamps
-        # )
-        # nwbfile.add_acquisition(ekg_time_series)
-
-    def add_trials(self, nwbfile, trial_structure):
-        # Mappings
-        header = trial_structure["Header"]
+    def add_lfp(
+        self,
+        nwbfile: NWBFile,
+        timestamps: Optional[TimeSeries] = None,
+        trials_per_block: int = 10,
+        trial_offsets: Optional[np.ndarray] = None,
+    ):
+        location = "Left visual cortex"
+
+        lfp_device = "LFP_device"  # To find out
+        lfp_device_description = "TBD"
+        lfp_manufacturer = "TBD"
+        device = Device(name=lfp_device, description=lfp_device_description, manufacturer=lfp_manufacturer)
+        nwbfile.add_device(device)
+
+        lfp_electrode_group_name = "LFP_electrodes"
+        lfp_electrode_group = ElectrodeGroup(
+            name=lfp_electrode_group_name, description="LFP Electrodes", location=location, device=device
+        )
+        nwbfile.add_electrode_group(lfp_electrode_group)
+
+        num_channels = self.session_loader.database["LFP"].shape[1]
+        for _ in range(num_channels):
+            nwbfile.add_electrode(
+                x=np.nan, y=np.nan, z=np.nan, imp=-1.0, location=location, filtering="none", group=lfp_electrode_group
+            )
+
+        region = list(range(num_channels))
+        electrode_table_region = nwbfile.create_electrode_table_region(region=region, description="LFP table region")
+
+        electrical_series = ElectricalSeries(
+            name="ElectricalSeriesLFP",
+            data=self.compression_policy.wrap(
+                "ElectricalSeriesLFP/data", self.get_database_iterator("LFP", None, trials_per_block, trial_offsets)
+            ),
+            electrodes=electrode_table_region,
+            timestamps=self.get_timestamps(
+                timestamps,
+                trials_per_block=trials_per_block,
+                trial_offsets=trial_offsets,
+                series_name="ElectricalSeriesLFP",
+            ),
+        )
+
+        LFP_object = LFP(electrical_series=electrical_series, name="LFP")
+        nwbfile.add_acquisition(LFP_object)
+
+    def add_ekg(
+        self,
+        nwbfile: NWBFile,
+        timestamps: Optional[TimeSeries] = None,
+        trials_per_block: int = 10,
+        trial_offsets: Optional[np.ndarray] = None,
+    ):
+        ekg_unit = "V"  # To ask authors
+        name = "EKG"
+        ekg_time_series = TimeSeries(
+            name=name,
+            data=self.compression_policy.wrap(
+                f"{name}/data", self.get_database_iterator("EKG", None, trials_per_block, trial_offsets)
+            ),
+            unit=ekg_unit,
+            timestamps=self.get_timestamps(
+                timestamps, trials_per_block=trials_per_block, trial_offsets=trial_offsets, series_name=name
+            ),
+        )
+        nwbfile.add_acquisition(ekg_time_series)
+
+    def get_trial_numbers(self, stop_time: Optional[float] = None) -> np.ndarray:
+        """The TrialNum of the rows of the trials table, which holds the trials that start before `stop_time`."""
+        df_trial_data = self.session_loader.trials.sort_values(by="TrialNum")
+        trial_numbers = df_trial_data["TrialNum"].to_numpy()
+        if stop_time is None:
+            return trial_numbers
+        trial_start_times = df_trial_data["TimeTrialStart"].replace(-1, np.nan).to_numpy() / 1e3
+        return trial_numbers[trial_start_times - self.smallest_timestamp < stop_time]
+
+    def add_trials(self, nwbfile, stop_time: Optional[float] = None):
+        # Mappings from the MATLAB codes to a fixed vocabulary of labels
+        header = self.session_loader.header
         definitions = header["DEF"]
+        outcome_numbers = np.array(sorted(definitions["OUTCOME"].values()))
         number_to_outcome_map = {number: outcome for outcome, number in definitions["OUTCOME"].items()}
+        outcome_labels = np.array([number_to_outcome_map[number].lower() for number in outcome_numbers])
 
-        type_condition_to_description = {0: "blank", 1: "target", 2: "visual_stimulus"}
-        conditions = header["Conditions"]
-        conditions_type = [type_condition_to_description[type_cond] for type_cond in conditions["TypeCond"]]
-        current_condition_to_description = {cond + 1: description for cond, description in enumerate(conditions_type)}
-
-        # Trial data
-        trial_data = trial_structure["Trial"]
-        df_trial_data = pd.DataFrame(trial_data)
-        columns_with_structure = [
-            "Database",
-            "Graphics",
-            "Events",
-            "ServerParams",
-            "TTLCfg",
-            "FPPos",
-            "BKColor",
-            "FPColor",
-        ]
+        type_condition_labels = np.array(self.session_loader.condition_type_labels)  # Indexed by TypeCond
+
+        # Trial data, the session loader only keeps the columns with scalar values
+        df_trial_data = self.session_loader.trials
         df_trial_data = (
-            df_trial_data.drop(columns=columns_with_structure)  # Drop columns with complex structure
-            .replace(-1, np.nan)  # Replace -1 by NaN
+            df_trial_data.replace(-1, np.nan)  # Replace -1 by NaN
             .dropna(axis=1, how="all")  # Drop columns with only NaN
             .sort_values(by="TrialNum")  # Sort by the trial number
             .drop(columns=["TrialNum"])  # Drop trial number
         )
 
+        # Trials that start before `stop_time`; columns are selected on the whole session so the layout does not change
+        trial_start_times = df_trial_data["TimeTrialStart"].to_numpy() / 1e3 - self.smallest_timestamp
+        trials_to_write = slice(None) if stop_time is None else trial_start_times < stop_time
+
+        # Categorical columns as codes into the vocabularies above
+        outcome_codes = self.get_definition_codes(outcome_numbers, df_trial_data["Outcome"].to_numpy(), "outcome")
+        condition_type_codes = self.session_loader.get_condition_types(df_trial_data["CurrCond"].to_numpy())
+
         # Remove columns with only one value
-        all_columns = set(df_trial_data.columns.values)
-        single_value_columns = [c for c in all_columns if len(df_trial_data[c].unique()) == 1]
+        single_value_columns = [column for column in df_trial_data.columns if df_trial_data[column].nunique() == 1]
         df_trial_data = df_trial_data.drop(columns=single_value_columns)
 
-        # Add information to trial data
-        df_trial_data["outcome"] = [number_to_outcome_map[outcome].lower() for outcome in df_trial_data["Outcome"]]
-        df_trial_data["condition_type"] = [
-            current_condition_to_description[CurrCond] for CurrCond in df_trial_data["CurrCond"]
-        ]
-
         # Drop redundant columns
-        df_trial_data.drop(columns=["OIStimID", "CurrCond", "TimeNow", "Outcome"], inplace=True)
+        df_trial_data = df_trial_data.drop(columns=["OIStimID", "CurrCond", "TimeNow", "Outcome"], errors="ignore")
 
         # Time in seconds
         time_columns = [column for column in df_trial_data.columns if "Time" in column and "Now" not in column]
-        df_trial_data[time_columns] = df_trial_data[time_columns] / 1e3
-        df_trial_data[time_columns] = df_trial_data[time_columns] - self.smallest_timestamp
+        df_trial_data[time_columns] = df_trial_data[time_columns] / 1e3 - self.smallest_timestamp
 
-        # Re-name for complying with `add_trial` function and snake_case convention
+        # Re-name for the trials table and snake_case convention
         df_trial_data = df_trial_data.rename(
             columns={
                 "TimeTrialStart": "start_time",
@@ -201,13 +331,9 @@ class Embargo22ABehaviorInterface(BaseDataInterface):
             },
         )
 
-        basic_columns = ["start_time", "stop_time"]
-        # Add the basic values to the trials table
-        rows_as_dicts = df_trial_data[basic_columns].T.to_dict().values()
-        [nwbfile.add_trial(**row_dict) for row_dict in rows_as_dicts]
-
-        # Add extra columns
         trial_columns_descriptions = {
+            "start_time": "Start time of the trial, in seconds",
+            "stop_time": "Stop time of the trial, in seconds",
             "oi_trigger_time": "time to triger imaging system",
             "oils_start_time": "time to turn on light shutter",
             "oils_end_time": "time to turn off light shutter",
@@ -221,29 +347,45 @@ class Embargo22ABehaviorInterface(BaseDataInterface):
             "condition_type": "Experimental condition (visual stimulus vs blank)",
         }
 
-        for column, description in trial_columns_descriptions.items():
-            data = df_trial_data[column].to_list()
-            data = H5DataIO(data, compression="gzip")
-            nwbfile.add_trial_column(name=column, data=data, description=description)
+        # Build the whole table in one step from the column arrays
+        columns_data = {column: df_trial_data[column].to_numpy() for column in df_trial_data.columns}
+        columns_data.update(
+            outcome=outcome_labels[outcome_codes],  # Labels are gathered from the vocabulary by code
+            condition_type=type_condition_labels[condition_type_codes],
+        )
+        columns_data = {column: data[trials_to_write] for column, data in columns_data.items()}
+        basic_columns = ["start_time", "stop_time"]
+        columns = [
+            VectorData(
+                name=column,
+                description=description,
+                data=columns_data[column]
+                if column in basic_columns
+                else self.compression_policy.wrap(f"trials/{column}", columns_data[column]),
+            )
+            for column, description in trial_columns_descriptions.items()
+        ]
+        trials = TimeIntervals(
+            name="trials",
+            description="experimental trials",
+            id=np.arange(len(columns_data["start_time"])),
+            columns=columns,
+        )
+        nwbfile.trials = trials
 
-    def add_events(self, nwbfile, trial_structure):
-        # Mappings
-        header = trial_structure["Header"]
-        definitions = header["DEF"]
-        number_to_event_definition_map = {number: outcome for outcome, number in definitions["EVENT"].items()}
+    def add_events(self, nwbfile, stop_time: Optional[float] = None):
+        # Vocabulary of the event definitions, the events are kept as integer codes into it
+        event_definitions = self.session_loader.header["DEF"]["EVENT"]
+        definition_numbers = np.array(sorted(event_definitions.values()))
+        number_to_event_definition_map = {number: definition for definition, number in event_definitions.items()}
+        definition_labels = np.array([number_to_event_definition_map[number].lower() for number in definition_numbers])
 
-        # Extract and process the data.
-        file_path_events = self.session_path / "events.csv"
-        df_events = pd.read_csv(file_path_events)
-        df_events["event_type"] = [number_to_event_definition_map[number].lower() for number in df_events["Type"]]
-        df_events["event"] = [number_to_event_definition_map[number].lower() for number in df_events["EventID"]]
-        df_events.drop(columns=["EventID", "Type", "TrialNum"], inplace=True)
-        df_events.rename(columns={"Timestamp": "timestamps"}, inplace=True)
+        event_columns = self.session_loader.event_columns
+        type_codes = self.get_definition_codes(definition_numbers, event_columns["Type"])
+        event_codes = self.get_definition_codes(definition_numbers, event_columns["EventID"])
 
         # For this conversion the types of events are the following
         # ["type_eye_state", "type_protocol_state", "type_new_trial", "type_oi_state", "type_reward_state"]
-        event_type_array = list(df_events.event_type.unique())
-        event_type_array.remove("type_new_trial")  # Redundant information
         behavior_module = get_module(nwbfile, "behavior")  # Not clear yet if all those types should go into behavior
 
         event_descriptions_map = {
@@ -259,20 +401,59 @@ class Embargo22ABehaviorInterface(BaseDataInterface):
             "type_reward_state": "reward_events",
         }
 
-        for event_type in event_type_array:
-            df_event_type = df_events.query(f"event_type=='{event_type}'")
-            timestamps = df_event_type.timestamps.to_numpy()
-            timestamps -= self.smallest_timestamp
-            labels = df_event_type.event.unique()
-            labels.sort()
-            label_to_postion = {label: position for position, label in enumerate(labels)}
-            data = [label_to_postion[label] for label in df_event_type.event]
-
+        # A stable sort groups the events of each type and keeps them in time order
+        event_order = np.argsort(type_codes, kind="stable")
+        type_bounds = np.searchsorted(type_codes[event_order], np.arange(len(definition_numbers) + 1))
+        present_types = np.flatnonzero(np.diff(type_bounds))
+        present_types = present_types[np.argsort(event_order[type_bounds[present_types]])]  # In order of appearance
+
+        for type_code in present_types:
+            event_type = definition_labels[type_code]
+            if event_type == "type_new_trial":  # Redundant information
+                continue
+            event_indices = event_order[type_bounds[type_code] : type_bounds[type_code + 1]]
+            type_event_codes = event_codes[event_indices]
+            timestamps = event_columns["Timestamp"][event_indices] - self.smallest_timestamp
+
+            # Labels in alphabetical order, from the whole session so they do not change with stop_time
+            label_codes = np.unique(type_event_codes)
+            label_codes = label_codes[np.argsort(definition_labels[label_codes], kind="stable")]
+            code_to_position = np.zeros(len(definition_numbers), dtype=np.min_scalar_type(max(1, len(label_codes) - 1)))
+            code_to_position[label_codes] = np.arange(len(label_codes))
+
+            if stop_time is not None:
+                is_before_stop = timestamps < stop_time
+                timestamps, type_event_codes = timestamps[is_before_stop], type_event_codes[is_before_stop]
+
+            name = event_name_map[event_type]
             events = LabeledEvents(
-                name=event_name_map[event_type],
+                name=name,
                 description=event_descriptions_map[event_type],  # Look for descriptions
-                timestamps=timestamps,
-                data=data,
-                labels=labels,
+                timestamps=self.compression_policy.wrap(f"{name}/timestamps", timestamps),
+                data=self.compression_policy.wrap(f"{name}/data", code_to_position[type_event_codes]),
+                labels=definition_labels[label_codes],
             )
             behavior_module.add(events)
+
+    @staticmethod
+    def get_definition_codes(
+        definition_numbers: np.ndarray, numbers: np.ndarray, definition_name: str = "event"
+    ) -> np.ndarray:
+        """
+        Positions of `numbers` in the sorted `definition_numbers`, read one block at a time from memory maps.
+
+        A ValueError naming the `definition_name` numbers that are not defined is raised.
+        """
+        codes = np.empty(len(numbers), dtype=np.min_scalar_type(max(1, len(definition_numbers) - 1)))
+        block_size = 2**22
+        for start in range(0, len(numbers), block_size):
+            block = np.asarray(numbers[start : start + block_size])
+            block_codes = np.minimum(np.searchsorted(definition_numbers, block), len(definition_numbers) - 1)
+            unknown_numbers = block[definition_numbers[block_codes] != block]
+            if len(unknown_numbers):
+                raise ValueError(
+                    f"The {definition_name} numbers {np.unique(unknown_numbers)} are not in the {definition_name} "
+                    "definitions."
+                )
+            codes[start : start + block_size] = block_codes
+        return codes
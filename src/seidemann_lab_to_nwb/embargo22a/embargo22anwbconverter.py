@@ -1,16 +1,37 @@
 """Primary NWBConverter class for this dataset."""
+from contextlib import ExitStack
 from pathlib import Path
+from typing import List, Optional
 from dateutil import parser
 from zoneinfo import ZoneInfo
 
 import numpy as np
-import pandas as pd
-from pymatreader import read_mat
 
+from pynwb import NWBFile
 from neuroconv import NWBConverter
-from neuroconv.datainterfaces import Suite2pSegmentationInterface
+from neuroconv.tools.nwb_helpers import make_nwbfile_from_metadata, make_or_load_nwbfile
+from neuroconv.utils import dict_deep_update
 
-from seidemann_lab_to_nwb.embargo22a import Embargo22ABehaviorInterface
+from seidemann_lab_to_nwb.embargo22a import Embargo22ABehaviorInterface, Embargo22ASuite2pSegmentationInterface
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy, get_compression_policy_schema
+from seidemann_lab_to_nwb.embargo22a.conversioncheckpoint import (
+    ConversionCheckpoint,
+    get_interface_fingerprint,
+    make_or_load_checkpointed_nwbfile,
+    remove_objects,
+    resume_write,
+)
+from seidemann_lab_to_nwb.embargo22a.conversionprofiler import ConversionProfiler
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import get_session_loader
+from seidemann_lab_to_nwb.embargo22a.embargo22asuite2pinterface import (
+    extracted_trace_descriptions,
+    get_plane_name,
+    trace_file_names,
+)
+from seidemann_lab_to_nwb.embargo22a.hdf5writehooks import HDF5WriteHooks
+from seidemann_lab_to_nwb.embargo22a.parallelcompression import write_compressed_chunk
+from seidemann_lab_to_nwb.embargo22a.timestampdeduplication import deduplicate_timestamps
+from seidemann_lab_to_nwb.embargo22a.trialalignment import add_trial_frame_index
 from numpymemmapimaginginterface import NumpyMemmapImagingInterface
 
 
@@ -19,34 +40,39 @@ class Embargo22ANWBConverter(NWBConverter):
 
     data_interface_classes = dict(
         Imaging=NumpyMemmapImagingInterface,
-        Suit2P=Suite2pSegmentationInterface,
+        Suit2P=Embargo22ASuite2pSegmentationInterface,
         Behavior=Embargo22ABehaviorInterface,
     )
+    frames_per_trial = 75  # Imaging frames of every trial flagged for imaging (FlagOIBLK)
+
+    def __init__(self, source_data: dict, profile: bool = False):
+        """
+        With `profile`, the time, memory and I/O of every stage of the conversion are measured and the report is
+        saved next to the NWB file, see `ConversionProfiler`.
+        """
+        self.profiler = ConversionProfiler(enabled=profile)
+        with self.profiler.stage("initialization"):
+            super().__init__(source_data=source_data)
+        for data_interface in self.data_interface_objects.values():
+            data_interface.profiler = self.profiler
 
-    def __init__(self, source_data: dict):
-        super().__init__(source_data=source_data)
         self.session_path = Path(self.data_interface_objects["Behavior"].source_data["session_path"])
-        self.add_time_stamps_to_imaging_extractor()
+        self.session_loader = get_session_loader(session_path=self.session_path)
+        with self.profiler.stage("imaging_timestamps"):
+            self.add_time_stamps_to_imaging_extractor()
 
     def add_time_stamps_to_imaging_extractor(self):
         # Get the smallest timestamp
-        file_path_events = self.session_path / "events.csv"
-        smallest_timestamp = pd.read_csv(file_path_events).Timestamp.min()
-
-        file_path = self.session_path / "M22D20210127R0Data2P20201001.mat"
-        data_simple = read_mat(
-            str(file_path), variable_names=["TS"], ignore_fields=["Events", "nTrial", "FileName", "Sync", "Header"]
-        )
-        trial_structure = data_simple["TS"]
+        smallest_timestamp = self.session_loader.smallest_timestamp
 
         # Trial data
-        trial_data = trial_structure["Trial"]
-        df_valid_trials = pd.DataFrame(trial_data)
+        df_valid_trials = self.session_loader.trials
         df_valid_trials = df_valid_trials.query("FlagOIBLK == 1")  # Flag indicating imaging extraction
 
         optical_imaging_trigger_time = df_valid_trials["TimeOITrigger"]  # time to triger imaging system
+        self.imaging_trial_numbers = df_valid_trials["TrialNum"].to_numpy()  # Trial of each block of frames
 
-        frames_per_trial = 75
+        frames_per_trial = self.frames_per_trial
         sampling_frequency = 30.0
         sampling_period = 1.0 / sampling_frequency
 
@@ -66,21 +92,69 @@ class Embargo22ANWBConverter(NWBConverter):
         imaging_extractor = imaging_interface.imaging_extractor
         imaging_extractor.set_times(times=timestamps)
 
-        del data_simple
+        # Conditions of the imaged trials, for the trial-averaged summaries of the imaging data
+        imaging_interface.set_trial_conditions(
+            trial_conditions=self.session_loader.get_condition_types(df_valid_trials["CurrCond"].to_numpy()),
+            condition_labels=self.session_loader.condition_type_labels,
+            frames_per_trial=frames_per_trial,
+        )
 
-    def get_metadata(self):
-        metadata = super().get_metadata()
+        # The segmentation is computed from the same frames, from which its traces can be extracted again
+        if "Suit2P" in self.data_interface_objects:
+            self.data_interface_objects["Suit2P"].set_times(times=timestamps)
+            self.data_interface_objects["Suit2P"].set_imaging_interface(imaging_interface)
+
+    def add_trial_frame_index(self, nwbfile: NWBFile, metadata: dict, stop_time: Optional[float] = None):
+        """
+        Add the imaging frames of every trial to the trials table, as references to the samples of the TwoPhotonSeries
+        and of the RoiResponseSeries of every plane in the `timeseries` column (see `trialalignment`).
+        """
+        series_frames = []
+        two_photon_series_name = metadata["Ophys"]["TwoPhotonSeries"][0]["name"]
+        if two_photon_series_name in nwbfile.acquisition:
+            series_frames.append((nwbfile.acquisition[two_photon_series_name], slice(0, None, 1)))
 
-        # Only the more complicated file has the datetime
-        file_path = self.session_path / "M22D20210127R0Data2P20201001.mat"
+        fluorescence_name = metadata["Ophys"].get("Fluorescence", dict()).get("name", "Fluorescence")
+        if "Suit2P" in self.data_interface_objects and "ophys" in nwbfile.processing:
+            segmentation_interface = self.data_interface_objects["Suit2P"]
+            fluorescence = nwbfile.processing["ophys"].data_interfaces.get(fluorescence_name)
+            for plane_index in range(len(segmentation_interface.plane_folder_paths)):
+                plane_frames = segmentation_interface.get_plane_frames(plane_index)
+                if fluorescence is None or plane_frames is None:
+                    continue
+                for trace_name in [*trace_file_names, *extracted_trace_descriptions]:
+                    series_name = get_plane_name(trace_name, plane_index)
+                    if series_name in fluorescence.roi_response_series:
+                        series_frames.append((fluorescence.roi_response_series[series_name], plane_frames))
 
-        data_simple = read_mat(
-            str(file_path),
-            variable_names=["TS"],
-            ignore_fields=["Events", "nTrial", "FileName", "Trial", "Sync", "Header"],
+        # Rows of the trials table, and the position of their block of frames among the imaged trials
+        trial_numbers = self.data_interface_objects["Behavior"].get_trial_numbers(stop_time=stop_time)
+        imaging_trial_positions = {
+            trial_number: position for position, trial_number in enumerate(self.imaging_trial_numbers)
+        }
+        trial_start_frames = np.array(
+            [imaging_trial_positions.get(trial_number, -1) for trial_number in trial_numbers], dtype="int64"
         )
-        trial_structure = data_simple["TS"]
-        experiment_information = trial_structure["Expt"]
+        trial_start_frames = np.where(trial_start_frames >= 0, trial_start_frames * self.frames_per_trial, -1)
+
+        add_trial_frame_index(
+            trials=nwbfile.trials,
+            trial_start_frames=trial_start_frames,
+            frames_per_trial=self.frames_per_trial,
+            series_frames=series_frames,
+        )
+
+    def get_metadata_schema(self):
+        metadata_schema = super().get_metadata_schema()
+        metadata_schema["properties"]["Compression"] = get_compression_policy_schema()
+        return metadata_schema
+
+    def get_metadata(self):
+        with self.profiler.stage("metadata"):
+            metadata = super().get_metadata()
+
+            # Only the more complicated file has the datetime
+            experiment_information = self.session_loader.expt
         datetime_string = experiment_information["ThorImageExperiment"]["Date"]["Attributes"]["date"]
         session_start_time = parser.parse(datetime_string)
         session_start_time = session_start_time.replace(tzinfo=ZoneInfo("America/Chicago"))
@@ -88,3 +162,249 @@ class Embargo22ANWBConverter(NWBConverter):
         metadata["NWBFile"].update(session_start_time=session_start_time)
 
         return metadata
+
+    def get_preview_stop_time(
+        self, preview_trials: Optional[int] = None, preview_duration: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        End of the preview window in seconds relative to the smallest timestamp of the session.
+
+        The window ends with the `preview_trials`-th trial or after `preview_duration` seconds, whichever comes first.
+        Returns None when neither budget is given.
+        """
+        stop_times = []
+        if preview_trials is not None:
+            df_trials = self.session_loader.trials.sort_values(by="TrialNum").head(preview_trials)
+            stop_times.append(df_trials["TimeTrialEnd"].max() / 1e3 - self.session_loader.smallest_timestamp)
+        if preview_duration is not None:
+            stop_times.append(preview_duration)
+        return min(stop_times) if stop_times else None
+
+    def run_conversion(
+        self,
+        nwbfile_path: Optional[str] = None,
+        nwbfile: Optional[NWBFile] = None,
+        metadata: Optional[dict] = None,
+        overwrite: bool = False,
+        conversion_options: Optional[dict] = None,
+        link_shared_timestamps: bool = True,
+        preview_trials: Optional[int] = None,
+        preview_duration: Optional[float] = None,
+        compression: Optional[dict] = None,
+        backend: str = "hdf5",
+        number_of_jobs: Optional[int] = None,
+        checkpoint: bool = False,
+        replace_interfaces: Optional[List[str]] = None,
+    ) -> Optional[NWBFile]:
+        """
+        Run the NWB conversion over all the instantiated data interfaces.
+
+        Same as `NWBConverter.run_conversion`, except that once every interface has added its objects, series that
+        share a time base are linked to a single copy of their timestamps before the file is written (unless
+        `link_shared_timestamps` is False). The report of the deduplication is stored in
+        `timestamp_deduplication_report`. The imaging frames of every trial are indexed in the trials table, see
+        `add_trial_frame_index`.
+
+        When the converter profiles the conversion, the report is stored in `profile_report` and saved next to the
+        file at `nwbfile_path`.
+
+        Every dataset is compressed and chunked by the `CompressionPolicy` built from the `Compression` section of the
+        metadata, updated by `compression`; the policy of the last conversion is kept in `compression_policy`.
+
+        With `backend="zarr"`, `nwbfile_path` is a Zarr store whose chunks are compressed and written by
+        `number_of_jobs` threads (all the cores by default); see `zarrbackend.consolidate_to_hdf5` to archive it as
+        a single HDF5 file. With the HDF5 backend, `number_of_jobs` threads compress the chunks of the imaging data,
+        which are written with direct chunk writes, see `parallelcompression.ParallelCompressionDataChunkIterator`.
+
+        A preview of the session is written when `preview_trials` (number of trials) or `preview_duration` (seconds)
+        is given: every interface is cut to the same window at the start of the session, see `get_preview_stop_time`.
+
+        With `checkpoint`, the progress of the conversion is saved next to the file, see `ConversionCheckpoint`. Unless
+        `overwrite` is True, a conversion interrupted while the data was written is then completed from the last rows
+        saved, and the file of a complete conversion is updated in place: only the objects of the interfaces whose
+        source data or options changed, or that are listed in `replace_interfaces` (e.g. after a change of the trial
+        column descriptions), are removed and written again. None is returned when no NWBFile was built.
+        """
+        if metadata is None:
+            metadata = self.get_metadata()
+        with self.profiler.stage("validation"):
+            self.validate_metadata(metadata=metadata)
+
+            if conversion_options is None:
+                conversion_options = dict()
+            default_conversion_options = self.get_conversion_options()
+            conversion_options_to_run = dict_deep_update(default_conversion_options, conversion_options)
+            self.validate_conversion_options(conversion_options=conversion_options_to_run)
+
+        compression_policy_options = dict_deep_update(
+            metadata.get("Compression", dict()), compression or dict(), append_list=False
+        )
+        self.compression_policy = CompressionPolicy.from_dict(compression_policy_options, backend=backend)
+        for data_interface in self.data_interface_objects.values():
+            data_interface.compression_policy = self.compression_policy
+
+        stop_time = self.get_preview_stop_time(preview_trials=preview_trials, preview_duration=preview_duration)
+        if stop_time is not None:
+            for interface_name in self.data_interface_objects:
+                conversion_options_to_run.setdefault(interface_name, dict()).update(stop_time=stop_time)
+        if backend == "hdf5" and number_of_jobs is not None and "Imaging" in self.data_interface_objects:
+            conversion_options_to_run.setdefault("Imaging", dict()).setdefault("number_of_jobs", number_of_jobs)
+
+        interface_names = list(self.data_interface_objects)
+        conversion_checkpoint = None
+        if checkpoint or replace_interfaces:
+            if nwbfile_path is None or nwbfile is not None or backend != "hdf5":
+                raise ValueError("A checkpointed conversion writes an HDF5 file at 'nwbfile_path' and only there.")
+            unknown_interfaces = set(replace_interfaces or []) - set(interface_names)
+            if unknown_interfaces:
+                raise ValueError(f"Cannot replace the unknown interfaces {sorted(unknown_interfaces)}.")
+
+            fingerprints = {
+                interface_name: get_interface_fingerprint(
+                    source_data=data_interface.source_data,
+                    conversion_options=conversion_options_to_run.get(interface_name, dict()),
+                    compression=compression_policy_options,
+                )
+                for interface_name, data_interface in self.data_interface_objects.items()
+            }
+            conversion_checkpoint = ConversionCheckpoint.load(nwbfile_path=nwbfile_path)
+            append = Path(nwbfile_path).is_file() and not overwrite
+            if append and conversion_checkpoint.status == "new":
+                raise ValueError(f"'{nwbfile_path}' has no checkpoint to update it from, pass 'overwrite=True'.")
+
+            if append and conversion_checkpoint.can_resume(fingerprints=fingerprints):
+                with self.profiler.stage("resume"):
+                    self.resume_conversion(
+                        conversion_checkpoint=conversion_checkpoint,
+                        metadata=metadata,
+                        conversion_options=conversion_options_to_run,
+                    )
+                self._save_profile_report(nwbfile_path=nwbfile_path)
+                return None
+
+            object_paths_to_remove = []
+            if append and conversion_checkpoint.status == "complete":
+                interface_names = conversion_checkpoint.get_interfaces_to_write(
+                    fingerprints=fingerprints, replace_interfaces=replace_interfaces or []
+                )
+                if not interface_names:
+                    if self.verbose:
+                        print(f"NWB file at {nwbfile_path} is up to date!")
+                    return None
+                if "Behavior" not in interface_names and {"Imaging", "Suit2P"} & set(interface_names):
+                    # The trial frame index of the trials table references the imaging series that are replaced
+                    interface_names = [
+                        name for name in self.data_interface_objects if name in interface_names + ["Behavior"]
+                    ]
+                object_paths_to_remove = [
+                    object_path
+                    for interface_name in interface_names
+                    for object_path in conversion_checkpoint.interfaces.get(interface_name, dict()).get(
+                        "object_paths", []
+                    )
+                ]
+            else:  # The interrupted write cannot be completed, the conversion is restarted
+                append = False
+
+            conversion_checkpoint.begin(interface_names=interface_names, fingerprints=fingerprints)
+            if object_paths_to_remove:
+                remove_objects(nwbfile_path=nwbfile_path, object_paths=object_paths_to_remove)
+            nwbfile_context = make_or_load_checkpointed_nwbfile(
+                checkpoint=conversion_checkpoint, metadata=metadata, append=append, verbose=self.verbose
+            )
+        elif backend == "zarr":
+            from seidemann_lab_to_nwb.embargo22a.zarrbackend import make_or_load_zarr_nwbfile  # Needs hdmf-zarr
+
+            nwbfile_context = make_or_load_zarr_nwbfile(
+                nwbfile_path=nwbfile_path,
+                nwbfile=nwbfile,
+                metadata=metadata,
+                overwrite=overwrite,
+                number_of_jobs=number_of_jobs,
+                verbose=self.verbose,
+            )
+        else:
+            nwbfile_context = make_or_load_nwbfile(
+                nwbfile_path=nwbfile_path, nwbfile=nwbfile, metadata=metadata, overwrite=overwrite, verbose=self.verbose
+            )
+
+        # The file is written when the nwbfile context exits, the write stage is closed right after
+        with ExitStack() as write_stage, nwbfile_context as nwbfile_out:
+            object_ids_by_interface = dict()
+            for interface_name in interface_names:
+                object_ids = {child.object_id for child in nwbfile_out.all_children()}
+                with self.profiler.stage(interface_name):
+                    self.data_interface_objects[interface_name].run_conversion(
+                        nwbfile=nwbfile_out, metadata=metadata, **conversion_options_to_run.get(interface_name, dict())
+                    )
+                if self.profiler.enabled or conversion_checkpoint is not None:
+                    added_object_ids = {child.object_id for child in nwbfile_out.all_children()} - object_ids
+                    self.profiler.add_interface_objects(interface_name, added_object_ids)
+                    object_ids_by_interface[interface_name] = added_object_ids
+
+            # The frame index is part of the trials table, so it belongs to the objects of the behavior interface
+            if "Behavior" in interface_names and nwbfile_out.trials is not None:
+                object_ids = {child.object_id for child in nwbfile_out.all_children()}
+                with self.profiler.stage("trial_frame_index"):
+                    self.add_trial_frame_index(nwbfile=nwbfile_out, metadata=metadata, stop_time=stop_time)
+                if self.profiler.enabled or conversion_checkpoint is not None:
+                    added_object_ids = {child.object_id for child in nwbfile_out.all_children()} - object_ids
+                    self.profiler.add_interface_objects("Behavior", added_object_ids)
+                    object_ids_by_interface["Behavior"] |= added_object_ids
+
+            if self.verbose:
+                for dataset_name, auto_report in self.compression_policy.auto_report.items():
+                    print(f"Compression of {dataset_name} chosen by benchmark: {auto_report['chosen']}")
+
+            if link_shared_timestamps:
+                with self.profiler.stage("timestamp_deduplication"):
+                    report = deduplicate_timestamps(nwbfile_out)
+                if self.verbose:
+                    for link in report["links"]:
+                        print(f"Timestamps of {link['series']} linked to {link['linked_to']}")
+                    print(f"Timestamp deduplication saved {report['bytes_saved'] / 1e6:.2f} MB")
+                self.timestamp_deduplication_report = report
+
+            if conversion_checkpoint is not None:
+                conversion_checkpoint.set_interface_objects(object_ids_by_interface=object_ids_by_interface)
+            # A single hook on the HDF5 writes: the imaging chunks are compressed, then timed, then recorded as written
+            write_hooks = HDF5WriteHooks()
+            if backend == "hdf5":
+                imaging_options = conversion_options_to_run.get("Imaging", dict())
+                if "Imaging" in interface_names and imaging_options.get("number_of_jobs", 1) != 1:
+                    write_hooks.chunk_writers.append(write_compressed_chunk)
+                if self.profiler.enabled:
+                    write_hooks.chunk_callbacks.append(self.profiler.add_chunk_write)
+                    write_hooks.list_fill_callbacks.append(self.profiler.add_list_fill)
+                if conversion_checkpoint is not None:
+                    write_hooks.chunk_callbacks.append(conversion_checkpoint.add_chunk_write)
+            write_stage.enter_context(self.profiler.stage("write"))
+            if write_hooks.has_callbacks:  # The backend is left untouched otherwise
+                write_stage.enter_context(write_hooks.install())
+
+        if conversion_checkpoint is not None:
+            conversion_checkpoint.complete()
+        self._save_profile_report(nwbfile_path=nwbfile_path)
+
+        return nwbfile_out
+
+    def resume_conversion(self, conversion_checkpoint: ConversionCheckpoint, metadata: dict, conversion_options: dict):
+        """
+        Complete the write of the file of `conversion_checkpoint`, interrupted while the data was written.
+
+        The interfaces that were written run again on an in-memory NWBFile to recreate the iterators of their datasets,
+        and only the rows that the checkpoint does not record as written are read and written to the file.
+        """
+        nwbfile = make_nwbfile_from_metadata(metadata=metadata)
+        for interface_name in conversion_checkpoint.written_interfaces:
+            self.data_interface_objects[interface_name].run_conversion(
+                nwbfile=nwbfile, metadata=metadata, **conversion_options.get(interface_name, dict())
+            )
+        resume_write(checkpoint=conversion_checkpoint, nwbfile=nwbfile, verbose=self.verbose)
+
+    def _save_profile_report(self, nwbfile_path: Optional[str] = None):
+        if self.profiler.enabled:
+            if nwbfile_path is not None:
+                self.profile_report = self.profiler.save_report(nwbfile_path=nwbfile_path)
+            else:
+                self.profile_report = self.profiler.get_report()
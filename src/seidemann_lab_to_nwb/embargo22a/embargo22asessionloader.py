@@ -0,0 +1,411 @@
+"""Session-level loader that parses the TS MATLAB struct and the events table once per session."""
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+from pymatreader import read_mat
+
+from neuroconv.utils.types import FolderPathType, OptionalFolderPathType
+
+from seidemann_lab_to_nwb.embargo22a.lazymatreader import LazyMatReader, table_decode_errors
+
+default_cache_folder_path = Path.home() / ".cache" / "seidemann_lab_to_nwb" / "embargo22a"
+mat_file_pattern = "*Data2P*.mat"
+
+
+def to_jsonable(value):
+    """Recursively convert the output of `read_mat` to objects that `json` can serialize."""
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return to_jsonable(value.tolist()) if value.dtype == object else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def to_scalar(value):
+    """Reduce a MATLAB value to a Python scalar, using NaN for empty arrays. Raise ValueError if it is not scalar."""
+    if isinstance(value, (dict, str, bytes)):
+        raise ValueError("Not a numeric scalar.")
+    array = np.asarray(value)
+    if array.dtype.kind not in "biuf":
+        raise ValueError("Not a numeric scalar.")
+    if array.size == 0:
+        return np.nan
+    if array.size == 1:
+        return array.item()
+    raise ValueError("Not a scalar.")
+
+
+def _file_key(file_path: Path) -> str:
+    """Identify a file by its path, size and modification time."""
+    file_stat = file_path.stat()
+    identity = f"{file_path.resolve()}|{file_stat.st_size}|{file_stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+
+def find_mat_file_path(session_path: FolderPathType) -> Path:
+    """
+    Locate the TS MAT file of a session: the only `.mat` file in the session folder, or else the only one whose name
+    matches `mat_file_pattern` (e.g. `M22D20210127R0Data2P20201001.mat`).
+    """
+    mat_file_paths = sorted(Path(session_path).glob("*.mat"))
+    if len(mat_file_paths) > 1:  # Other MAT files, e.g. analyses, can be saved next to the TS file
+        mat_file_paths = sorted(Path(session_path).glob(mat_file_pattern))
+    if len(mat_file_paths) != 1:
+        raise ValueError(
+            f"Expected exactly one .mat file, or one '{mat_file_pattern}' file, in {session_path}, "
+            f"found {len(mat_file_paths)}."
+        )
+    return mat_file_paths[0]
+
+
+class Embargo22ASessionLoader:
+    """
+    Parse the sources of a session once and share the normalized result between the converter and its interfaces.
+
+    The normalized session (trial table, Database signals, Header definitions, Expt metadata and the events table) is
+    persisted as a folder of .npy columns and JSON documents. The folder is keyed by the path, size and modification
+    time of the source file, so re-runs and metadata-only passes load it instead of parsing MATLAB again.
+
+    MAT files saved with `-v7.3` are read lazily: each part is parsed from the file the first time it is requested.
+    A converter metadata pass reads the trial table and the events table, from which `Embargo22ANWBConverter` sets the
+    imaging timestamps when it is created, then Expt and Header; the Database signals are only read when the behavior
+    is written. Their events table is decoded from the file, or read from `events.csv` when its layout cannot be
+    decoded; for older MAT files, the table must be exported to `events.csv` in the session folder.
+    """
+
+    events_file_name = "events.csv"
+    event_column_dtypes = dict(Timestamp="float64", TrialNum="int32", Type="int32", EventID="int32")
+    csv_rows_per_chunk = 1_000_000
+    condition_type_labels = ["blank", "target", "visual_stimulus"]  # Indexed by TypeCond
+    cache_version = 2
+    ignore_fields = ["Events", "nTrial", "FileName", "Sync", "Graphics", "ServerParams", "TTLCfg"]
+    part_file_names = dict(
+        expt="expt.json",
+        header="header.json",
+        trials="trials",
+        database="database",
+        database_offsets="database",
+        events="events",
+    )
+
+    def __init__(self, session_path: FolderPathType, cache_folder_path: OptionalFolderPathType = None):
+        self.session_path = Path(session_path)
+        self.mat_file_path = find_mat_file_path(self.session_path)
+        self.events_file_path = self.session_path / self.events_file_name
+        self.is_lazy = LazyMatReader.is_v73(self.mat_file_path)
+
+        self.cache_folder_path = Path(cache_folder_path or default_cache_folder_path)
+        mat_file_key = _file_key(self.mat_file_path)
+        self.mat_cache_path = self.cache_folder_path / f"{self.mat_file_path.stem}-{mat_file_key}-v{self.cache_version}"
+
+        self._parts = dict()
+
+    @property
+    def events_cache_path(self) -> Path:
+        return (
+            self.cache_folder_path
+            / f"{self.events_file_path.stem}-{_file_key(self.events_file_path)}-v{self.cache_version}"
+        )
+
+    @property
+    def expt(self) -> dict:
+        """The Expt structure of TS (acquisition software metadata)."""
+        return self._get_part("expt")
+
+    @property
+    def header(self) -> dict:
+        """The Header structure of TS, including the DEF mappings and the Conditions."""
+        return self._get_part("header")
+
+    @property
+    def trials(self) -> pd.DataFrame:
+        """The scalar fields of TS.Trial, one row per trial in file order."""
+        return self._get_part("trials")
+
+    @property
+    def database(self) -> dict:
+        """The signals of TS.Trial.Database concatenated over trials, as memory-mapped arrays."""
+        return self._get_part("database")
+
+    @property
+    def database_offsets(self) -> np.ndarray:
+        """Sample index where the Database signals of each trial start, with the total number of samples appended."""
+        return self._get_part("database_offsets")
+
+    @property
+    def event_columns(self) -> Dict[str, np.ndarray]:
+        """
+        The columns of the events table as memory-mapped arrays, from the MAT file when it can be decoded and from
+        `events.csv` otherwise. The CSV file is cached one chunk of rows at a time with the types of
+        `event_column_dtypes`, so event logs larger than the memory can be converted.
+        """
+        if "event_columns" not in self._parts:
+            cache_path = None
+            if self.events_source == "mat":
+                cache_path = self.mat_cache_path / self.part_file_names["events"]
+                if not cache_path.exists():
+                    try:
+                        self._parse_part("events")
+                    except table_decode_errors as error:
+                        if not self.events_file_path.exists():
+                            raise
+                        warn(
+                            f"The events table of {self.mat_file_path.name} could not be decoded ({error!r}), "
+                            f"the events are read from {self.events_file_path.name}."
+                        )
+                        cache_path = None
+            if cache_path is None:  # The table of the MAT file is missing or could not be decoded
+                cache_path = self.events_cache_path
+                if not cache_path.exists():
+                    self._write_csv_columns(
+                        cache_path, self.events_file_path, self.event_column_dtypes, self.csv_rows_per_chunk
+                    )
+            self._parts["event_columns"] = self._read_column_arrays(cache_path, mmap_mode="r")
+        return self._parts["event_columns"]
+
+    @property
+    def events_source(self) -> str:
+        """Where the events table is read from: "mat" for v7.3 MAT files with an events table, "csv" otherwise."""
+        return "mat" if self.is_lazy and self._has_events_table() else "csv"
+
+    @property
+    def events(self) -> pd.DataFrame:
+        """The events table of the session, loaded in memory; see `event_columns`."""
+        return pd.DataFrame(self.event_columns)
+
+    def get_condition_types(self, current_conditions: np.ndarray) -> np.ndarray:
+        """The TypeCond of the conditions `CurrCond` (numbered from 1), as indices into `condition_type_labels`."""
+        condition_to_type = np.asarray(self.header["Conditions"]["TypeCond"], dtype="int64")  # Indexed by CurrCond - 1
+        return condition_to_type[np.asarray(current_conditions).astype("int64") - 1]
+
+    @property
+    def smallest_timestamp(self) -> float:
+        """Smallest timestamp of the events table in seconds; all times are written relative to it."""
+        return float(self.event_columns["Timestamp"].min())
+
+    def _get_part(self, name: str):
+        if name not in self._parts:
+            if not (self.mat_cache_path / self.part_file_names[name]).exists():
+                if self.is_lazy:
+                    self._parse_part(name)
+                else:
+                    self._parse_mat_file()
+            self._parts[name] = self._load_part(name)
+        return self._parts[name]
+
+    def _has_events_table(self) -> bool:
+        if (self.mat_cache_path / self.part_file_names["events"]).exists():
+            return True
+        with LazyMatReader(self.mat_file_path) as reader:
+            return "Events" in reader.get_field_names("TS") and reader.get_class_name("TS/Events") == "table"
+
+    def _load_part(self, name: str):
+        path = self.mat_cache_path / self.part_file_names[name]
+        if name in ["expt", "header"]:
+            with open(path, "r") as file:
+                return json.load(file)
+        if name == "database":
+            return {path.stem: np.load(path, mmap_mode="r") for path in sorted((path / "signals").glob("*.npy"))}
+        if name == "database_offsets":
+            return np.load(path / "offsets.npy")
+        return self._read_columns(path)
+
+    def _parse_part(self, name: str):
+        """Parse a single part of a v7.3 MAT file into the cache, reading only the fields it needs."""
+        self.mat_cache_path.mkdir(parents=True, exist_ok=True)
+        with LazyMatReader(self.mat_file_path) as reader:
+            if name in ["expt", "header"]:
+                self._write_json(self.mat_cache_path / self.part_file_names[name], reader.read(f"TS/{name.title()}"))
+            elif name == "trials":
+                field_names = reader.get_field_names("TS/Trial")
+                field_names = [field for field in field_names if field not in self.ignore_fields + ["Database"]]
+                self._write_columns(
+                    self.mat_cache_path / "trials",
+                    self._get_scalar_columns(
+                        {field: reader.read_struct_array_field("TS/Trial", field) for field in field_names}
+                    ),
+                )
+            elif name in ["database", "database_offsets"]:
+                database_paths = [
+                    reader.get_struct_array_element_path("TS/Trial", "Database", index)
+                    for index in range(reader.get_num_elements("TS/Trial"))
+                ]
+                samples_per_trial = [reader.get_num_samples(f"{path}/Timestamp") for path in database_paths]
+                trial_databases = (reader.read(path) for path in database_paths)
+                self._write_database(self.mat_cache_path, samples_per_trial, trial_databases)
+            elif name == "events":
+                self._write_columns(self.mat_cache_path / "events", reader.read_table("TS/Events"))
+
+    def _parse_mat_file(self):
+        trial_structure = read_mat(str(self.mat_file_path), variable_names=["TS"], ignore_fields=self.ignore_fields)
+        trial_structure = trial_structure["TS"]
+        df_trial_data = pd.DataFrame(trial_structure["Trial"])
+        trial_databases = list(df_trial_data.pop("Database"))
+        samples_per_trial = [len(np.atleast_1d(database["Timestamp"])) for database in trial_databases]
+
+        self.mat_cache_path.mkdir(parents=True, exist_ok=True)
+        self._write_columns(self.mat_cache_path / "trials", self._get_scalar_columns(df_trial_data))
+        self._write_database(self.mat_cache_path, samples_per_trial, trial_databases)
+        self._write_json(self.mat_cache_path / "header.json", trial_structure["Header"])
+        self._write_json(self.mat_cache_path / "expt.json", trial_structure["Expt"])
+
+    @staticmethod
+    def _get_scalar_columns(trial_data) -> pd.DataFrame:
+        """Keep the fields of TS.Trial whose entries are all numeric scalars."""
+        scalar_columns = dict()
+        for column, values in trial_data.items():
+            try:
+                scalar_columns[column] = [to_scalar(value) for value in values]
+            except ValueError:
+                continue
+        return pd.DataFrame(scalar_columns)
+
+    @staticmethod
+    def _write_json(file_path: Path, value):
+        temporary_file_path = file_path.with_name(file_path.name + ".tmp")
+        with open(temporary_file_path, "w") as file:
+            json.dump(to_jsonable(value), file)
+        os.replace(temporary_file_path, file_path)
+
+    @staticmethod
+    def _write_database(cache_path: Path, samples_per_trial: List[int], trial_databases: Iterable[dict]):
+        """Concatenate each Database signal over trials directly into a .npy file without an in-memory copy."""
+        offsets = np.concatenate([[0], np.cumsum(samples_per_trial)]).astype("int64")
+
+        temporary_database_path = cache_path / "database.tmp"
+        shutil.rmtree(temporary_database_path, ignore_errors=True)
+        (temporary_database_path / "signals").mkdir(parents=True)
+        np.save(temporary_database_path / "offsets.npy", offsets)
+
+        signals = dict()
+        for trial_index, database in enumerate(trial_databases):
+            if trial_index == 0:
+                for signal_name, first_value in database.items():
+                    first_value = np.asarray(first_value)
+                    if first_value.ndim == 0 or len(first_value) != samples_per_trial[0]:
+                        continue  # Not sampled on the Database time base
+                    signals[signal_name] = np.lib.format.open_memmap(
+                        temporary_database_path / "signals" / f"{signal_name}.npy",
+                        mode="w+",
+                        dtype=first_value.dtype,
+                        shape=(offsets[-1],) + first_value.shape[1:],
+                    )
+            for signal_name, signal in signals.items():
+                signal[offsets[trial_index] : offsets[trial_index + 1]] = np.asarray(database[signal_name])
+
+        for signal in signals.values():
+            signal.flush()
+        del signals
+        shutil.rmtree(cache_path / "database", ignore_errors=True)
+        temporary_database_path.rename(cache_path / "database")
+
+    @staticmethod
+    def _write_columns(folder_path: Path, df: pd.DataFrame):
+        temporary_folder_path = folder_path.with_name(folder_path.name + ".tmp")
+        shutil.rmtree(temporary_folder_path, ignore_errors=True)
+        temporary_folder_path.mkdir(parents=True)
+        for column_index, column in enumerate(df.columns):
+            values = df[column].to_numpy()
+            values = values.astype(str) if values.dtype == object else values  # Text columns of MATLAB tables
+            np.save(temporary_folder_path / f"{column_index}.npy", values)
+        with open(temporary_folder_path / "columns.json", "w") as file:
+            json.dump([str(column) for column in df.columns], file)
+        shutil.rmtree(folder_path, ignore_errors=True)
+        temporary_folder_path.rename(folder_path)
+
+    @staticmethod
+    def _write_csv_columns(folder_path: Path, csv_file_path: Path, dtypes: Dict[str, str], rows_per_chunk: int):
+        """Write the `dtypes` columns of a CSV file like `_write_columns`, reading `rows_per_chunk` rows at a time."""
+        with open(csv_file_path, "rb") as file:  # Rows are counted first so each column is written in place
+            num_lines, last_byte = 0, b"\n"
+            for block in iter(lambda: file.read(2**24), b""):
+                num_lines, last_byte = num_lines + block.count(b"\n"), block[-1:]
+        num_rows = max(0, num_lines + (last_byte != b"\n") - 1)  # Without the header
+
+        temporary_folder_path = folder_path.with_name(folder_path.name + ".tmp")
+        shutil.rmtree(temporary_folder_path, ignore_errors=True)
+        temporary_folder_path.mkdir(parents=True)
+        columns = list(dtypes)
+        arrays = [
+            np.lib.format.open_memmap(
+                temporary_folder_path / f"{column_index}.npy", mode="w+", dtype=dtypes[column], shape=(num_rows,)
+            )
+            for column_index, column in enumerate(columns)
+        ]
+
+        # Integer codes may be written as floats (e.g. `3.0`), so every column is parsed as float and then cast
+        chunks = pd.read_csv(
+            csv_file_path, usecols=columns, dtype={column: "float64" for column in columns}, chunksize=rows_per_chunk
+        )
+        start = 0
+        for chunk in chunks:
+            stop = start + len(chunk)
+            for column, array in zip(columns, arrays):
+                array[start:stop] = chunk[column].to_numpy()
+            start = stop
+        for array in arrays:
+            array.flush()
+        if start < num_rows:  # Blank lines are not rows
+            arrays = [np.array(array[:start]) for array in arrays]
+            for column_index, array in enumerate(arrays):
+                np.save(temporary_folder_path / f"{column_index}.npy", array)
+        del arrays
+
+        with open(temporary_folder_path / "columns.json", "w") as file:
+            json.dump(columns, file)
+        shutil.rmtree(folder_path, ignore_errors=True)
+        temporary_folder_path.rename(folder_path)
+
+    @staticmethod
+    def _read_column_arrays(folder_path: Path, mmap_mode: Optional[str] = None) -> Dict[str, np.ndarray]:
+        with open(folder_path / "columns.json", "r") as file:
+            columns = json.load(file)
+        return {
+            column: np.load(folder_path / f"{index}.npy", mmap_mode=mmap_mode) for index, column in enumerate(columns)
+        }
+
+    @classmethod
+    def _read_columns(cls, folder_path: Path) -> pd.DataFrame:
+        data = cls._read_column_arrays(folder_path)
+        return pd.DataFrame(data, columns=list(data))
+
+
+@lru_cache(maxsize=16)
+def _get_session_loader(
+    session_path: str, cache_folder_path: Optional[str], mat_file_key: str, events_file_key: Optional[str]
+) -> Embargo22ASessionLoader:
+    return Embargo22ASessionLoader(session_path=session_path, cache_folder_path=cache_folder_path)
+
+
+def get_session_loader(
+    session_path: FolderPathType, cache_folder_path: OptionalFolderPathType = None
+) -> Embargo22ASessionLoader:
+    """
+    Return the loader shared by every consumer of the same session in this process.
+
+    A new loader is made when the MAT file or `events.csv` of the session changed, so that parts loaded from the
+    previous files are not served.
+    """
+    session_path = Path(session_path).resolve()
+    cache_folder_path = str(Path(cache_folder_path).resolve()) if cache_folder_path is not None else None
+    events_file_path = session_path / Embargo22ASessionLoader.events_file_name
+    return _get_session_loader(
+        session_path=str(session_path),
+        cache_folder_path=cache_folder_path,
+        mat_file_key=_file_key(find_mat_file_path(session_path)),
+        events_file_key=_file_key(events_file_path) if events_file_path.exists() else None,
+    )
@@ -0,0 +1,452 @@
+"""Segmentation interface that writes every plane of a suite2p folder from memory-mapped arrays."""
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional
+from warnings import warn
+
+import numpy as np
+from hdmf.common import VectorData, VectorIndex
+from pynwb import NWBFile
+from pynwb.ophys import Fluorescence, ImageSegmentation, PlaneSegmentation, RoiResponseSeries
+
+from neuroconv.basedatainterface import BaseDataInterface
+from neuroconv.tools.hdmf import SliceableDataChunkIterator
+from neuroconv.tools.nwb_helpers import get_module
+from neuroconv.tools.roiextractors import add_devices, add_imaging_plane
+from neuroconv.utils import dict_deep_update, get_base_schema, get_schema_from_hdmf_class
+from neuroconv.utils.types import FolderPathType
+
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
+from seidemann_lab_to_nwb.embargo22a.roitraceextraction import (
+    RoiTraceDataChunkIterator,
+    RoiTraceExtractor,
+    get_roi_weights,
+)
+
+# Trace files of suite2p and the name of the RoiResponseSeries they are written to
+trace_file_names = dict(RoiResponseSeries="F.npy", Neuropil="Fneu.npy", Deconvolved="spks.npy")
+trace_descriptions = dict(
+    RoiResponseSeries="Raw fluorescence traces extracted by suite2p.",
+    Neuropil="Neuropil fluorescence traces extracted by suite2p.",
+    Deconvolved="Deconvolved activity inferred by suite2p.",
+)
+# Traces extracted from the raw imaging data with the ROI masks of suite2p, see `run_conversion`
+extracted_trace_descriptions = dict(
+    ExtractedRoiResponseSeries="Fluorescence traces extracted from the raw imaging data with the ROI masks of suite2p.",
+    ExtractedNeuropil="Neuropil traces extracted from the raw imaging data around the ROI masks of suite2p.",
+)
+
+pixel_mask_dtype = np.dtype([("x", "uint32"), ("y", "uint32"), ("weight", "float32")])
+
+
+def get_plane_name(name: str, plane_index: int) -> str:
+    """Name of an object of plane `plane_index`; the objects of the first plane keep the name in the metadata."""
+    return name if plane_index == 0 else f"{name}_Plane{plane_index}"
+
+
+def read_plane_segmentation(plane_folder_path: Path) -> dict:
+    """
+    Read the ROIs of a suite2p plane as flat arrays.
+
+    The pixel masks of all ROIs are concatenated in a single array of (x, y, weight) rows with the end of each ROI in
+    `pixel_mask_index`, which is how NWB stores ragged columns, so no dense image mask is ever built.
+    """
+    stat = np.load(plane_folder_path / "stat.npy", allow_pickle=True)
+    iscell = np.load(plane_folder_path / "iscell.npy", mmap_mode="r")
+
+    num_pixels = np.array([len(roi["xpix"]) for roi in stat], dtype="int64")
+    pixel_mask = np.empty(num_pixels.sum(), dtype=pixel_mask_dtype)
+    if len(stat):
+        pixel_mask["x"] = np.concatenate([roi["xpix"] for roi in stat])
+        pixel_mask["y"] = np.concatenate([roi["ypix"] for roi in stat])
+        pixel_mask["weight"] = np.concatenate([roi["lam"] for roi in stat])
+
+    # suite2p stores the median pixel as (y, x)
+    centroids = np.array([roi["med"] for roi in stat], dtype="int64").reshape(-1, 2)[:, ::-1]
+
+    return dict(
+        pixel_mask=pixel_mask,
+        pixel_mask_index=np.cumsum(num_pixels),
+        centroids=centroids,
+        accepted=(np.asarray(iscell[:, 0]) == 1).astype("uint8"),
+    )
+
+
+class Embargo22ASuite2pSegmentationInterface(BaseDataInterface):
+    """
+    Data interface for the suite2p output of a session, with every `plane*` folder written as its own segmentation.
+
+    The traces (`F.npy`, `Fneu.npy` and `spks.npy`) are memory-mapped and written in chunks, so they are never fully
+    loaded in memory. The ROIs of the planes are read in parallel and stored as pixel masks.
+    """
+
+    compression_policy = CompressionPolicy()  # Replaced by the policy of the conversion
+
+    def __init__(self, folder_path: FolderPathType):
+        super().__init__(folder_path=folder_path)
+
+        self.folder_path = Path(self.source_data["folder_path"])
+        self.plane_folder_paths = sorted(
+            (path for path in self.folder_path.glob("plane*") if path.name[len("plane") :].isdigit()),
+            key=lambda path: int(path.name[len("plane") :]),
+        )
+        if not self.plane_folder_paths:
+            raise ValueError(f"No plane folders found in {self.folder_path}.")
+
+        ops = np.load(self.plane_folder_paths[0] / "ops.npy", allow_pickle=True).item()
+        self.sampling_frequency = float(ops["fs"])
+        self._times = None
+        self.imaging_interface = None
+
+    def get_num_frames(self, plane_index: int = 0) -> int:
+        return np.load(self.plane_folder_paths[plane_index] / "F.npy", mmap_mode="r").shape[1]
+
+    def set_times(self, times: np.ndarray):
+        """Set the times of the imaging frames the segmentation was computed from, in seconds."""
+        self._times = np.asarray(times, dtype="float64")
+
+    def set_imaging_interface(self, imaging_interface):
+        """Set the interface of the raw imaging data the segmentation was computed from, to extract traces from it."""
+        self.imaging_interface = imaging_interface
+
+    def get_plane_frames(self, plane_index: int) -> Optional[slice]:
+        """
+        The imaging frames of a plane, whose times were set with `set_times`; planes of a volume are acquired one after
+        the other, so they interleave. None when the frames of the plane do not match the frame times.
+        """
+        if self._times is None:
+            return None
+
+        num_frames = self.get_num_frames(plane_index)
+        num_planes = len(self.plane_folder_paths)
+        if len(self._times) == num_frames:
+            return slice(0, None, 1)
+        if len(self._times) >= num_frames * num_planes:
+            return slice(plane_index, None, num_planes)
+        return None
+
+    def get_plane_times(self, plane_index: int) -> Optional[np.ndarray]:
+        """Frame times of a plane, see `get_plane_frames`."""
+        if self._times is None:
+            return None
+
+        plane_frames = self.get_plane_frames(plane_index)
+        if plane_frames is not None:
+            return self._times[plane_frames][: self.get_num_frames(plane_index)]
+
+        warn(
+            f"The {len(self._times)} frame times do not match the {self.get_num_frames(plane_index)} frames of plane "
+            f"{plane_index}; the sampling frequency of suite2p is used instead."
+        )
+        return None
+
+    def get_metadata_schema(self) -> dict:
+        metadata_schema = super().get_metadata_schema()
+        metadata_schema["properties"]["Ophys"] = get_base_schema(tag="Ophys")
+        metadata_schema["properties"]["Ophys"]["properties"] = dict(
+            ImageSegmentation=get_schema_from_hdmf_class(ImageSegmentation),
+            Fluorescence=get_schema_from_hdmf_class(Fluorescence),
+        )
+        metadata_schema["properties"]["Ophys"]["properties"]["ImageSegmentation"]["additionalProperties"] = True
+
+        # One series per trace and plane
+        roi_response_series_schema = metadata_schema["properties"]["Ophys"]["properties"]["Fluorescence"]["properties"][
+            "roi_response_series"
+        ]
+        roi_response_series_schema.pop("maxItems")
+        roi_response_series_schema["items"]["required"] = list()
+        return metadata_schema
+
+    def get_metadata(self) -> dict:
+        plane_segmentations = []
+        roi_response_series = []
+        for plane_index in range(len(self.plane_folder_paths)):
+            plane_segmentations.append(
+                dict(
+                    name=get_plane_name("PlaneSegmentation", plane_index),
+                    description=f"ROIs segmented by suite2p on plane {plane_index}.",
+                )
+            )
+            for trace_name, description in trace_descriptions.items():
+                roi_response_series.append(
+                    dict(name=get_plane_name(trace_name, plane_index), description=description, unit="n.a.")
+                )
+
+        return dict(
+            Ophys=dict(
+                ImageSegmentation=dict(name="ImageSegmentation", plane_segmentations=plane_segmentations),
+                Fluorescence=dict(name="Fluorescence", roi_response_series=roi_response_series),
+            )
+        )
+
+    def run_conversion(
+        self,
+        nwbfile: NWBFile,
+        metadata: dict,
+        stub_test: bool = False,
+        stub_frames: int = 100,
+        include_neuropil: bool = True,
+        include_deconvolved: bool = True,
+        max_workers: Optional[int] = None,
+        chunk_mb: float = 10.0,
+        stop_time: Optional[float] = None,
+        extract_traces: bool = False,
+        extraction_frames_per_block: int = 500,
+        allow_overlap: bool = False,
+        inner_neuropil_radius: int = 2,
+        min_neuropil_pixels: int = 350,
+    ):
+        """
+        Add the ROIs and traces of every plane to the ophys processing module.
+
+        With `extract_traces`, the fluorescence and neuropil traces of the ROIs are also extracted from the raw imaging
+        data of the interface set with `set_imaging_interface`, and written as the `ExtractedRoiResponseSeries` and
+        `ExtractedNeuropil` series of every plane (see `get_trace_extractor`).
+
+        Parameters
+        ----------
+        nwbfile: NWBFile
+        metadata: dict
+        stub_test: bool, default: False
+            Only write the first `stub_frames` frames of the traces.
+        stub_frames: int, default: 100
+        include_neuropil: bool, default: True
+        include_deconvolved: bool, default: True
+        max_workers: int, optional
+            Number of threads reading the ROIs of the planes. Defaults to one per plane.
+        chunk_mb: float, default: 10.0
+            Target size in MB of the HDF5 chunks of the traces.
+        stop_time: float, optional
+            Only write the frames acquired before this time in seconds, e.g. to preview a session.
+        extract_traces: bool, default: False
+        extraction_frames_per_block: int, default: 500
+            Number of raw frames read and extracted at once; memory is bounded by one block of frames.
+        allow_overlap: bool, default: False
+            Keep the pixels shared by several ROIs in their masks, which suite2p excludes by default.
+        inner_neuropil_radius: int, default: 2
+            Distance in pixels between a ROI and its neuropil mask, when suite2p did not save the neuropil masks.
+        min_neuropil_pixels: int, default: 350
+            Minimum number of pixels of a neuropil mask, when suite2p did not save the neuropil masks.
+        """
+        if extract_traces and self.imaging_interface is None:
+            raise ValueError(
+                "Traces can only be extracted once the imaging interface is set with 'set_imaging_interface'."
+            )
+        trace_names = ["RoiResponseSeries"]
+        trace_names += ["Neuropil"] if include_neuropil else []
+        trace_names += ["Deconvolved"] if include_deconvolved else []
+
+        metadata = dict_deep_update(self.get_metadata(), metadata)
+
+        max_workers = max_workers or len(self.plane_folder_paths)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            plane_segmentations_data = list(executor.map(read_plane_segmentation, self.plane_folder_paths))
+
+        add_devices(nwbfile=nwbfile, metadata=metadata)
+        ophys_module = get_module(nwbfile, "ophys", description="contains optical physiology processed data")
+
+        image_segmentation_metadata = metadata["Ophys"]["ImageSegmentation"]
+        image_segmentation_name = image_segmentation_metadata["name"]
+        if image_segmentation_name in ophys_module.data_interfaces:
+            image_segmentation = ophys_module[image_segmentation_name]
+        else:
+            image_segmentation = ImageSegmentation(name=image_segmentation_name)
+            ophys_module.add(image_segmentation)
+
+        fluorescence_metadata = metadata["Ophys"]["Fluorescence"]
+        fluorescence_name = fluorescence_metadata["name"]
+        if fluorescence_name in ophys_module.data_interfaces:
+            fluorescence = ophys_module[fluorescence_name]
+        else:
+            fluorescence = Fluorescence(name=fluorescence_name)
+            ophys_module.add(fluorescence)
+
+        for plane_index, plane_segmentation_data in enumerate(plane_segmentations_data):
+            imaging_plane = self.add_plane_imaging_plane(nwbfile=nwbfile, metadata=metadata, plane_index=plane_index)
+            plane_segmentation = self.get_plane_segmentation(
+                plane_segmentation_data=plane_segmentation_data,
+                metadata=metadata,
+                plane_index=plane_index,
+                imaging_plane=imaging_plane,
+            )
+            image_segmentation.add_plane_segmentation(plane_segmentation)
+
+            rois = plane_segmentation.create_roi_table_region(
+                region=list(range(len(plane_segmentation))), description=f"ROIs of plane {plane_index}"
+            )
+            num_frames = self.get_num_frames(plane_index)
+            stop_frame = min(stub_frames, num_frames) if stub_test else num_frames
+            timestamps = self.get_plane_times(plane_index)
+            if stop_time is not None and timestamps is not None:
+                stop_frame = min(stop_frame, int(np.searchsorted(timestamps, stop_time, side="left")))
+            elif stop_time is not None:
+                stop_frame = min(stop_frame, int(max(0, np.ceil(stop_time * self.sampling_frequency))))
+
+            iterators = dict()
+            for trace_name in trace_names:
+                # suite2p stores (rois, frames); the transposed memmap is read one chunk of frames at a time
+                traces = np.load(self.plane_folder_paths[plane_index] / trace_file_names[trace_name], mmap_mode="r")
+                traces = traces[:, :stop_frame].T
+                iterators[trace_name] = SliceableDataChunkIterator(data=traces, chunk_mb=chunk_mb)
+            if extract_traces:
+                extractor = self.get_trace_extractor(
+                    plane_index=plane_index,
+                    stop_frame=stop_frame,
+                    frames_per_block=extraction_frames_per_block,
+                    allow_overlap=allow_overlap,
+                    inner_neuropil_radius=inner_neuropil_radius,
+                    min_neuropil_pixels=min_neuropil_pixels,
+                )
+                for trace_index, trace_name in enumerate(extracted_trace_descriptions):
+                    iterators[trace_name] = RoiTraceDataChunkIterator(
+                        extractor=extractor, trace_index=trace_index, chunk_mb=chunk_mb
+                    )
+
+            for trace_name, iterator in iterators.items():
+                series_name = get_plane_name(trace_name, plane_index)
+                description = {**trace_descriptions, **extracted_trace_descriptions}[trace_name]
+                series_metadata = next(
+                    (
+                        series_metadata
+                        for series_metadata in fluorescence_metadata["roi_response_series"]
+                        if series_metadata["name"] == series_name
+                    ),
+                    dict(name=series_name, description=description, unit="n.a."),
+                )
+
+                data = self.compression_policy.wrap(f"{series_name}/data", iterator)
+                series_kwargs = dict(series_metadata, data=data, rois=rois)
+                if timestamps is not None:
+                    plane_timestamps = self.compression_policy.wrap(
+                        f"{series_name}/timestamps", timestamps[: iterator.maxshape[0]]
+                    )
+                    series_kwargs.update(timestamps=plane_timestamps)
+                else:
+                    series_kwargs.update(starting_time=0.0, rate=self.sampling_frequency)
+                fluorescence.add_roi_response_series(RoiResponseSeries(**series_kwargs))
+
+    def get_trace_extractor(
+        self,
+        plane_index: int,
+        stop_frame: int,
+        frames_per_block: int = 500,
+        allow_overlap: bool = False,
+        inner_neuropil_radius: int = 2,
+        min_neuropil_pixels: int = 350,
+    ) -> RoiTraceExtractor:
+        """
+        Extractor of the traces of the ROIs of a plane from the raw imaging data, up to `stop_frame`.
+
+        The masks of `stat.npy` are turned into one sparse (2 * ROIs, pixels) weight matrix (see `get_roi_weights`),
+        and the raw frames of the plane (see `get_plane_frames`) are read in blocks of `frames_per_block` frames,
+        whose ROI and neuropil traces are computed with one sparse matrix product.
+        """
+        plane_folder_path = self.plane_folder_paths[plane_index]
+        raw_iterator = self.imaging_interface.get_data_chunk_iterator()
+        frame_shape = (raw_iterator.num_rows, raw_iterator.num_columns)
+        ops = np.load(plane_folder_path / "ops.npy", allow_pickle=True).item()
+        if (ops.get("Ly", frame_shape[0]), ops.get("Lx", frame_shape[1])) != frame_shape:
+            raise ValueError(
+                f"The frames of plane {plane_index} are {ops['Ly']} x {ops['Lx']} pixels, but the raw imaging frames "
+                f"are {frame_shape[0]} x {frame_shape[1]} pixels."
+            )
+
+        num_planes = len(self.plane_folder_paths)
+        plane_frames = self.get_plane_frames(plane_index) or slice(plane_index, None, num_planes)
+        first_frame, frame_step = plane_frames.start or 0, plane_frames.step or 1
+        num_plane_frames = len(range(first_frame, raw_iterator.num_frames, frame_step))
+
+        def get_frames(start_frame: int, stop_frame: int) -> np.ndarray:
+            raw_start_frame = first_frame + start_frame * frame_step
+            raw_stop_frame = raw_start_frame + (stop_frame - start_frame - 1) * frame_step + 1
+            return raw_iterator.get_frames(start_frame=raw_start_frame, stop_frame=raw_stop_frame)[::frame_step]
+
+        stat = np.load(plane_folder_path / "stat.npy", allow_pickle=True)
+        weights = get_roi_weights(
+            stat=stat,
+            frame_shape=frame_shape,
+            allow_overlap=allow_overlap,
+            inner_neuropil_radius=inner_neuropil_radius,
+            min_neuropil_pixels=min_neuropil_pixels,
+        )
+        return RoiTraceExtractor(
+            weights=weights,
+            get_frames=get_frames,
+            num_frames=min(stop_frame, num_plane_frames),
+            frames_per_block=frames_per_block,
+        )
+
+    def add_plane_imaging_plane(self, nwbfile: NWBFile, metadata: dict, plane_index: int):
+        """
+        Add the imaging plane of a suite2p plane.
+
+        The first plane is the imaging plane of the metadata. Other planes use the metadata entry named after them
+        when there is one, and a copy of the first imaging plane otherwise.
+        """
+        imaging_planes_metadata = metadata["Ophys"]["ImagingPlane"]
+        plane_name = get_plane_name(imaging_planes_metadata[0]["name"], plane_index)
+        plane_metadata = next(
+            (plane_metadata for plane_metadata in imaging_planes_metadata if plane_metadata["name"] == plane_name),
+            dict(deepcopy(imaging_planes_metadata[0]), name=plane_name),
+        )
+
+        plane_metadata_copy = deepcopy(metadata)
+        plane_metadata_copy["Ophys"]["ImagingPlane"] = [plane_metadata]
+        add_imaging_plane(nwbfile=nwbfile, metadata=plane_metadata_copy, imaging_plane_index=0)
+
+        return nwbfile.imaging_planes[plane_name]
+
+    def get_plane_segmentation(
+        self, plane_segmentation_data: dict, metadata: dict, plane_index: int, imaging_plane
+    ) -> PlaneSegmentation:
+        plane_segmentations_metadata = metadata["Ophys"]["ImageSegmentation"]["plane_segmentations"]
+        plane_segmentation_name = get_plane_name(plane_segmentations_metadata[0]["name"], plane_index)
+        plane_segmentation_metadata = next(
+            (
+                plane_segmentation_metadata
+                for plane_segmentation_metadata in plane_segmentations_metadata
+                if plane_segmentation_metadata["name"] == plane_segmentation_name
+            ),
+            dict(name=plane_segmentation_name, description=f"ROIs segmented by suite2p on plane {plane_index}."),
+        )
+
+        pixel_mask = VectorData(
+            name="pixel_mask",
+            description="Pixel masks of the ROIs as (x, y, weight) rows.",
+            data=self.compression_policy.wrap(
+                f"{plane_segmentation_name}/pixel_mask", plane_segmentation_data["pixel_mask"]
+            ),
+        )
+        pixel_mask_index = VectorIndex(
+            name="pixel_mask_index", data=plane_segmentation_data["pixel_mask_index"], target=pixel_mask
+        )
+        centroids = VectorData(
+            name="ROICentroids",
+            description="The x, y centroids of each ROI.",
+            data=self.compression_policy.wrap(
+                f"{plane_segmentation_name}/ROICentroids", plane_segmentation_data["centroids"]
+            ),
+        )
+        accepted = VectorData(
+            name="Accepted",
+            description="1 if ROI was accepted or 0 if rejected as a cell during segmentation operation.",
+            data=self.compression_policy.wrap(
+                f"{plane_segmentation_name}/Accepted", plane_segmentation_data["accepted"]
+            ),
+        )
+
+        rejected = VectorData(
+            name="Rejected",
+            description="1 if ROI was rejected or 0 if accepted as a cell during segmentation operation.",
+            data=self.compression_policy.wrap(
+                f"{plane_segmentation_name}/Rejected", 1 - plane_segmentation_data["accepted"]
+            ),
+        )
+
+        return PlaneSegmentation(
+            **plane_segmentation_metadata,
+            imaging_plane=imaging_plane,
+            id=np.arange(len(plane_segmentation_data["accepted"])),
+            columns=[pixel_mask, pixel_mask_index, centroids, accepted, rejected],
+        )
@@ -0,0 +1,100 @@
+"""A single hook on the writes of the HDF5 backend, which runs the callbacks of the conversion in a fixed order."""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+import h5py
+import hdmf
+from hdmf.backends.hdf5.h5tools import HDF5IO
+from hdmf.backends.hdf5.h5_utils import HDF5IODataChunkIteratorQueue
+from hdmf.data_utils import DataChunk
+
+# The hook replaces private methods of hdmf, whose names and signatures are only checked for these versions
+supported_hdmf_versions = ["3.4.7"]
+_install_lock = threading.Lock()  # Held while hooks are installed
+
+
+class HDF5WriteHooks:
+    """
+    Callbacks on the datasets written by the HDF5 backend while `install` is entered.
+
+    The hook replaces `HDF5IODataChunkIteratorQueue._write_chunk`, which writes the chunks of DataChunkIterators, and
+    wraps `HDF5IO.__list_fill__`, which writes the datasets given in memory. The callbacks run in the order of their
+    lists. The hook is installed for the whole process, so only one write can use it at a time; it should only be
+    installed when a callback is registered, see `has_callbacks`. Its lists are:
+
+    - `chunk_writers(dataset, chunk)` write a chunk instead of `dataset[chunk.selection] = chunk.data` and return
+      True, or return False to leave it to the next writer (e.g. `parallelcompression.write_compressed_chunk`).
+    - `chunk_callbacks(dataset, chunk, read_seconds, write_seconds)` are called once the chunk is written, with the
+      time spent reading it from the iterator and writing it; `chunk` is None when the iterator is exhausted.
+    - `list_fill_callbacks(dataset, write_seconds)` are called once a dataset given in memory is written.
+    """
+
+    def __init__(self):
+        self.chunk_writers: List[Callable[[h5py.Dataset, DataChunk], bool]] = []
+        self.chunk_callbacks: List[Callable[[h5py.Dataset, Optional[DataChunk], float, float], None]] = []
+        self.list_fill_callbacks: List[Callable[[h5py.Dataset, float], None]] = []
+
+    def write_chunk(self, dataset: h5py.Dataset, data) -> bool:
+        """Write the next chunk of the DataChunkIterator `data`, as `_write_chunk`; False once it is exhausted."""
+        start_time = time.perf_counter()
+        try:
+            chunk = next(data)
+        except StopIteration:
+            chunk = None
+        read_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if chunk is not None:
+            dataset.id.extend(chunk.get_min_bounds())
+            if not any(chunk_writer(dataset, chunk) for chunk_writer in self.chunk_writers):
+                dataset[chunk.selection] = chunk.data
+        write_seconds = time.perf_counter() - start_time
+
+        for chunk_callback in self.chunk_callbacks:
+            chunk_callback(dataset, chunk, read_seconds, write_seconds)
+        return chunk is not None
+
+    @property
+    def has_callbacks(self) -> bool:
+        return bool(self.chunk_writers or self.chunk_callbacks or self.list_fill_callbacks)
+
+    @contextmanager
+    def install(self):
+        """
+        Run the callbacks on every dataset written by the HDF5 backend inside the context.
+
+        Raises a RuntimeError for versions of hdmf not in `supported_hdmf_versions`, and when hooks are already
+        installed, e.g. by a conversion running in another thread.
+        """
+        if hdmf.__version__ not in supported_hdmf_versions:
+            raise RuntimeError(
+                f"The HDF5 write hooks replace private methods of hdmf {', '.join(supported_hdmf_versions)}, found hdmf "
+                f"{hdmf.__version__}; install a supported version, or convert without parallel imaging compression, "
+                "profiling and checkpoints."
+            )
+        if not _install_lock.acquire(blocking=False):
+            raise RuntimeError("HDF5 write hooks are already installed, another write of this process uses them.")
+        write_chunk = HDF5IODataChunkIteratorQueue._write_chunk
+        list_fill = HDF5IO.__list_fill__
+        hooks = self
+
+        def _write_chunk(cls, dset, data):
+            return hooks.write_chunk(dset, data)
+
+        def _list_fill(cls, parent, name, data, options=None):
+            start_time = time.perf_counter()
+            dset = list_fill(parent, name, data, options)
+            for list_fill_callback in hooks.list_fill_callbacks:
+                list_fill_callback(dset, time.perf_counter() - start_time)
+            return dset
+
+        HDF5IODataChunkIteratorQueue._write_chunk = classmethod(_write_chunk)
+        HDF5IO.__list_fill__ = classmethod(_list_fill)
+        try:
+            yield self
+        finally:
+            HDF5IODataChunkIteratorQueue._write_chunk = write_chunk
+            HDF5IO.__list_fill__ = list_fill
+            _install_lock.release()
@@ -0,0 +1,198 @@
+"""Trial-averaged movies and projections of the imaging data, accumulated while the raw frames are written."""
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+
+class ImagingSummaryAccumulator:
+    """
+    Accumulate the summaries of a movie from the blocks of frames read to write it, so the raw file is read once.
+
+    Frames are grouped in trials of `frames_per_trial` consecutive frames, and `trial_conditions` holds the condition
+    of every trial as an index into `condition_labels`. For every condition, the mean and the variance over trials of
+    each frame of the trial are updated with Welford's algorithm in float32, which needs two movies of one trial per
+    condition. The mean and maximum projections are computed over every frame, including those after the last trial.
+
+    Frames are numbered from the first frame written and each is only added once, so blocks read again (e.g. to resume
+    an interrupted write) do not change the summaries.
+    """
+
+    def __init__(
+        self,
+        num_frames: int,
+        frame_shape: Tuple[int, ...],
+        dtype: np.dtype,
+        trial_conditions: Optional[np.ndarray] = None,
+        condition_labels: Optional[List[str]] = None,
+        frames_per_trial: int = 75,
+    ):
+        """
+        Parameters
+        ----------
+        num_frames: int
+            Number of frames of the movie.
+        frame_shape: tuple of int
+            Shape of one frame, in the order of the written data.
+        dtype: np.dtype
+            Data type of the frames, also used for the maximum projection.
+        trial_conditions: np.ndarray, optional
+            Condition of every trial, as indices into `condition_labels`. Only the projections are computed without it.
+        condition_labels: list of str, optional
+            Label of every condition.
+        frames_per_trial: int, default: 75
+        """
+        self.num_frames = num_frames
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.frames_per_trial = frames_per_trial
+        self.condition_labels = list(condition_labels or [])
+
+        # Conditions of the trials with at least one frame in the movie
+        num_trials = -(-num_frames // frames_per_trial)
+        self.trial_conditions = np.asarray(trial_conditions if trial_conditions is not None else [], dtype="int64")
+        self.trial_conditions = self.trial_conditions[:num_trials]
+        self.conditions = [int(condition) for condition in np.unique(self.trial_conditions)]
+
+        trial_shape = (frames_per_trial,) + self.frame_shape
+        self._trial_counts = {condition: np.zeros(frames_per_trial, dtype="int64") for condition in self.conditions}
+        self._trial_means = {condition: np.zeros(trial_shape, dtype="float32") for condition in self.conditions}
+        self._trial_squared_deviations = {
+            condition: np.zeros(trial_shape, dtype="float32") for condition in self.conditions
+        }
+        self._frame_sum = np.zeros(self.frame_shape, dtype="float64")
+        self._frame_max = np.full(self.frame_shape, self._get_min_value(self.dtype), dtype=self.dtype)
+
+        self._is_frame_added = np.zeros(num_frames, dtype=bool)
+        self.num_blocks_streamed = 0  # Incremented by the writer for every chunk of frames it writes
+
+    @staticmethod
+    def _get_min_value(dtype: np.dtype):
+        return np.iinfo(dtype).min if dtype.kind in "iu" else -np.inf
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self._is_frame_added.all())
+
+    def get_num_trials(self, condition: int) -> int:
+        """Number of trials of `condition` in the movie, including a last trial cut short."""
+        return int(np.count_nonzero(self.trial_conditions == condition))
+
+    def add_frames(self, start_frame: int, frames: np.ndarray):
+        """Add the block of consecutive `frames` that starts at `start_frame` to the summaries."""
+        frame_indices = np.arange(start_frame, start_frame + len(frames))
+        is_new = ~self._is_frame_added[frame_indices]
+        if not is_new.any():
+            return
+        if not is_new.all():
+            frames, frame_indices = frames[is_new], frame_indices[is_new]
+        self._is_frame_added[frame_indices] = True
+
+        self._frame_sum += frames.sum(axis=0, dtype="float64")
+        np.maximum(self._frame_max, frames.max(axis=0), out=self._frame_max)
+
+        trials, positions = np.divmod(frame_indices, self.frames_per_trial)
+        for trial in np.unique(trials[trials < len(self.trial_conditions)]):
+            is_trial_frame = trials == trial
+            condition = int(self.trial_conditions[trial])
+            trial_positions = positions[is_trial_frame]
+            if np.all(np.diff(trial_positions) == 1):  # Frames added in order, whose views are updated in place
+                trial_positions = slice(trial_positions[0], trial_positions[-1] + 1)
+            trial_frames = frames[is_trial_frame].astype("float32")
+
+            counts = self._trial_counts[condition]
+            counts[trial_positions] += 1
+            means = self._trial_means[condition][trial_positions]
+            deviations = trial_frames - means
+            means += deviations / counts[trial_positions].reshape((-1,) + (1,) * len(self.frame_shape))
+            trial_frames -= means
+            deviations *= trial_frames
+            self._trial_means[condition][trial_positions] = means
+            self._trial_squared_deviations[condition][trial_positions] += deviations
+
+    def add_missing_frames(self, get_data: Callable[[tuple], np.ndarray], frames_per_block: int = 500):
+        """Read the frames not added yet with `get_data`, a function that returns a selection of frames."""
+        missing_frames = np.flatnonzero(~self._is_frame_added)
+        run_breaks = np.flatnonzero(np.diff(missing_frames) > 1)
+        run_starts = missing_frames[np.concatenate([[0], run_breaks + 1])] if len(missing_frames) else []
+        run_stops = missing_frames[np.concatenate([run_breaks, [-1]])] + 1 if len(missing_frames) else []
+        for run_start, run_stop in zip(run_starts, run_stops):
+            for start_frame in range(int(run_start), int(run_stop), frames_per_block):
+                selection = (slice(start_frame, min(start_frame + frames_per_block, int(run_stop))),)
+                selection += tuple(slice(0, length) for length in self.frame_shape)
+                self.add_frames(start_frame, get_data(selection))
+
+    def get_trial_average(self, condition: int) -> np.ndarray:
+        return self._trial_means[condition]
+
+    def get_trial_variance(self, condition: int) -> np.ndarray:
+        """Variance over trials of every frame of the trial (ddof=0)."""
+        counts = self._trial_counts[condition].reshape((-1,) + (1,) * len(self.frame_shape))
+        return self._trial_squared_deviations[condition] / np.maximum(counts, 1)
+
+    def get_mean_projection(self) -> np.ndarray:
+        return (self._frame_sum / max(1, int(self._is_frame_added.sum()))).astype("float32")
+
+    def get_max_projection(self) -> np.ndarray:
+        return self._frame_max
+
+
+class ImagingSummaryDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Write one summary of an `ImagingSummaryAccumulator` once the frames it summarizes have been written.
+
+    The summary is a single chunk computed after the last frame was added. The HDF5 backend writes the iterators of
+    the file either one after the other or a chunk of each in turn (e.g. for checkpointed conversions): in the second
+    case, the summary is deferred with empty chunks while frames are still being written. If no frame was written
+    since the previous request, as when the summary is written first, the missing frames are read with `get_data`.
+    """
+
+    def __init__(
+        self,
+        accumulator: ImagingSummaryAccumulator,
+        get_summary: Callable[[], np.ndarray],
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        get_data: Callable[[tuple], np.ndarray],
+    ):
+        self.accumulator = accumulator
+        self.get_summary = get_summary
+        self.get_data = get_data
+        self._maxshape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._num_blocks_streamed = 0
+        self._is_written = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> DataChunk:
+        if self._is_written:
+            raise StopIteration
+
+        if not self.accumulator.is_complete:
+            if self.accumulator.num_blocks_streamed != self._num_blocks_streamed:
+                self._num_blocks_streamed = self.accumulator.num_blocks_streamed
+                selection = (slice(0, 0),) + tuple(slice(0, length) for length in self._maxshape[1:])
+                return DataChunk(data=np.empty((0,) + self._maxshape[1:], dtype=self._dtype), selection=selection)
+            self.accumulator.add_missing_frames(get_data=self.get_data)
+
+        self._is_written = True
+        data = np.asarray(self.get_summary(), dtype=self._dtype)
+        return DataChunk(data=data, selection=tuple(slice(0, length) for length in self._maxshape))
+
+    next = __next__
+
+    def recommended_chunk_shape(self) -> Tuple[int, ...]:
+        return None
+
+    def recommended_data_shape(self) -> Tuple[int, ...]:
+        return self._maxshape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def maxshape(self) -> Tuple[int, ...]:
+        return self._maxshape
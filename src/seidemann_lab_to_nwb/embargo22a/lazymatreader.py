@@ -0,0 +1,317 @@
+"""Lazy reader for MATLAB v7.3 (HDF5) MAT files, including MATLAB table objects."""
+import struct
+from pathlib import Path
+from typing import List, Optional
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from neuroconv.utils import FilePathType
+
+# Errors raised when an MCOS object uses a layout that is not supported, e.g. one written by another MATLAB release
+table_decode_errors = (KeyError, IndexError, ValueError, NotImplementedError, struct.error)
+
+numeric_classes = (
+    "double",
+    "single",
+    "int8",
+    "uint8",
+    "int16",
+    "uint16",
+    "int32",
+    "uint32",
+    "int64",
+    "uint64",
+)
+
+
+def _decode_attribute(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _squeeze(array: np.ndarray):
+    """Follow the conventions of `pymatreader`: drop singleton dimensions and return scalars as Python objects."""
+    array = np.squeeze(array)
+    return array.item() if array.ndim == 0 else array
+
+
+class LazyMatReader:
+    """
+    Read the variables of a MATLAB v7.3 MAT file on demand.
+
+    MAT files saved with `-v7.3` are HDF5 files, so single fields and single elements of struct arrays can be read
+    without loading the rest of the file. MATLAB `table` objects, which other Python readers cannot decode, are read
+    from the MCOS subsystem of the file and returned as pandas DataFrames.
+
+    Paths use `/` to separate fields, e.g. `TS/Expt/ThorImageExperiment`.
+    """
+
+    def __init__(self, file_path: FilePathType):
+        self.file_path = Path(file_path)
+        self.file = h5py.File(self.file_path, mode="r")
+        self._mcos = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def is_v73(file_path: FilePathType) -> bool:
+        """MAT files saved with `-v7.3` are the only ones that are HDF5 files."""
+        return h5py.is_hdf5(file_path)
+
+    def get_field_names(self, path: str) -> List[str]:
+        """Field names of the struct (or struct array) at `path`, in MATLAB order."""
+        group = self.file[path]
+        if "MATLAB_fields" in group.attrs:
+            return [
+                "".join(_decode_attribute(character) for character in field) for field in group.attrs["MATLAB_fields"]
+            ]
+        return list(group.keys())
+
+    def is_struct_array(self, path: str) -> bool:
+        """Elements of struct arrays are stored as one dataset of references per field."""
+        node = self.file[path]
+        if not isinstance(node, h5py.Group):
+            return False
+        fields = [node[field] for field in node.keys()]
+        return bool(fields) and all(
+            isinstance(field, h5py.Dataset) and field.dtype == h5py.ref_dtype and "MATLAB_class" not in field.attrs
+            for field in fields
+        )
+
+    def get_class_name(self, path: str) -> str:
+        """MATLAB class of the variable or field at `path`."""
+        return _decode_attribute(self.file[path].attrs.get("MATLAB_class", b""))
+
+    def get_shape(self, path: str) -> tuple:
+        """Shape of the array at `path` in MATLAB order, read without loading the data."""
+        dataset = self.file[path]
+        if dataset.attrs.get("MATLAB_empty", 0):
+            return (0,)
+        return dataset.shape[::-1]
+
+    def get_num_samples(self, path: str) -> int:
+        """Length of the first non-singleton dimension of the array at `path`, as it is after squeezing."""
+        non_singleton_shape = [length for length in self.get_shape(path) if length != 1]
+        return non_singleton_shape[0] if non_singleton_shape else 1
+
+    def get_num_elements(self, path: str) -> int:
+        """Number of elements of the struct array at `path`."""
+        first_field = self.get_field_names(path)[0]
+        return self.file[path][first_field].size
+
+    def get_struct_array_element_path(self, path: str, field: str, index: int) -> str:
+        """Path of the value of `field` in element `index` of a struct array, to read it or its fields lazily."""
+        reference = self.file[path][field][()].T.ravel()[index]
+        return self.file[reference].name
+
+    def read(self, path: str):
+        """Read and decode the variable or field at `path`."""
+        return self._decode(self.file[path])
+
+    def read_struct_array_field(self, path: str, field: str, indices: Optional[List[int]] = None) -> list:
+        """
+        Read one field of the elements of a struct array, without touching its other fields.
+
+        Parameters
+        ----------
+        path: str
+            Path of the struct array, e.g. `TS/Trial`.
+        field: str
+            Name of the field, e.g. `TimeOITrigger`.
+        indices: list of int, optional
+            Elements to read. Defaults to all of them.
+        """
+        references = self.file[path][field][()].T.ravel()
+        indices = range(len(references)) if indices is None else indices
+        return [self._decode(self.file[references[index]]) for index in indices]
+
+    def read_table(self, path: str, num_rows: Optional[int] = None) -> pd.DataFrame:
+        """
+        Decode the MATLAB table object at `path` into a DataFrame.
+
+        With `num_rows`, only the first rows of the table are decoded: the datasets of its columns are sliced as they
+        are read.
+        """
+        class_name = self.get_class_name(path)
+        if class_name != "table":
+            raise ValueError(f"'{path}' is a MATLAB '{class_name}', not a table.")
+        return self._decode_object(self.file[path], class_name=class_name, num_rows=num_rows)
+
+    def _decode(self, node, num_rows: Optional[int] = None):
+        """Decode a node; `num_rows` only reads the first rows of an array or a cell array, not of an object."""
+        if isinstance(node, h5py.Group):
+            return self._decode_group(node)
+
+        attributes = node.attrs
+        class_name = _decode_attribute(attributes.get("MATLAB_class", b""))
+
+        if attributes.get("MATLAB_object_decode", 0) == 3:
+            return self._decode_object(node, class_name=class_name)
+
+        if attributes.get("MATLAB_empty", 0):
+            return "" if class_name == "char" else [] if class_name == "cell" else np.array([])
+
+        # MATLAB arrays are stored transposed, their rows are along the last axis of the dataset
+        selection = () if num_rows is None or node.ndim == 0 else (Ellipsis, slice(0, num_rows))
+        if node.dtype == h5py.ref_dtype:
+            references = node[selection].T
+            values = [self._decode(self.file[reference]) for reference in references.ravel()]
+            return (
+                values if references.squeeze().ndim <= 1 else np.array(values, dtype=object).reshape(references.shape)
+            )
+
+        data = node[selection].T
+        if class_name == "char":
+            rows = ["".join(map(chr, row)) for row in np.atleast_2d(data)]
+            return rows[0] if len(rows) == 1 else rows
+        if class_name == "logical":
+            return _squeeze(data.astype(bool))
+        if class_name in numeric_classes:
+            return _squeeze(data)
+
+        raise NotImplementedError(f"MATLAB class '{class_name}' of {node.name} is not supported.")
+
+    def _decode_group(self, group: h5py.Group):
+        path = group.name
+        field_names = self.get_field_names(path)
+        if self.is_struct_array(path):
+            return {field: self.read_struct_array_field(path, field) for field in field_names}
+        return {field: self._decode(group[field]) for field in field_names}
+
+    def _decode_object(self, dataset: h5py.Dataset, class_name: str, num_rows: Optional[int] = None):
+        """
+        Decode an MCOS object reference: [0xDD000000, ndims, dims..., object ids..., class id].
+
+        `num_rows` only decodes the first rows of tables.
+        """
+        header = dataset[()].T.ravel()
+        num_dims = int(header[1])
+        num_objects = int(np.prod(header[2 : 2 + num_dims]))
+        object_ids = header[2 + num_dims : 2 + num_dims + num_objects]
+
+        if class_name == "table":
+            objects = [
+                self._table_to_dataframe(self._get_mcos().get_object_properties(int(object_id), num_rows=num_rows))
+                for object_id in object_ids
+            ]
+        else:
+            objects = [self._get_mcos().get_object_properties(int(object_id)) for object_id in object_ids]
+
+        return objects[0] if len(objects) == 1 else objects
+
+    def _get_mcos(self) -> "MCOSSubsystem":
+        if self._mcos is None:
+            self._mcos = MCOSSubsystem(reader=self)
+        return self._mcos
+
+    @staticmethod
+    def _table_to_dataframe(properties: dict) -> pd.DataFrame:
+        """The DataFrame of a table, with the rows read of its columns (see `get_object_properties`)."""
+        if "varnames" in properties:  # Tables saved before R2018a
+            variable_names = properties["varnames"]
+        else:
+            variable_names = properties["varDim"]["labels"]
+        variable_names = [variable_names] if isinstance(variable_names, str) else list(variable_names)
+
+        columns = properties["data"]
+        columns = [columns] if len(variable_names) == 1 and not isinstance(columns, list) else columns
+        num_rows = min(int(properties["nrows"]), properties.get("num_rows_read", np.inf))
+
+        data = dict()
+        for name, column in zip(variable_names, columns):
+            column = np.asarray(column)
+            if column.ndim > 0 and len(column) > num_rows:  # Columns of objects are decoded whole
+                column = column[:num_rows]
+            column = column.reshape(num_rows, -1)
+            data[name] = column[:, 0] if column.shape[1] == 1 else list(column)
+        return pd.DataFrame(data)
+
+
+class MCOSSubsystem:
+    """
+    The MATLAB Class Object System subsystem of a v7.3 MAT file.
+
+    `#subsystem#/MCOS` is a cell array. Its first cell is a byte stream describing the classes, the objects and the
+    properties of each object; property values are stored in the other cells. Class default values (used for
+    properties that an object does not store) are not read.
+    """
+
+    def __init__(self, reader: LazyMatReader):
+        self.reader = reader
+        references = reader.file["#subsystem#/MCOS"][()].T.ravel()
+        self.cells = [reader.file[reference] for reference in references]
+
+        metadata = self.cells[0][()].T.ravel().astype("uint8").tobytes()
+        version, num_names = struct.unpack_from("<2I", metadata, 0)
+        num_offsets = 6 if version == 2 else 8
+        offsets = struct.unpack_from(f"<{num_offsets}I", metadata, 8)
+
+        # Names are null-terminated strings starting right after the header: version, number of names and offsets
+        names_start = 8 + 4 * num_offsets
+        self.names = metadata[names_start : offsets[0]].split(b"\0")[:num_names]
+        self.names = [name.decode() for name in self.names]
+
+        class_entries = np.frombuffer(metadata[offsets[0] : offsets[1]], dtype="<u4").reshape(-1, 4)
+        self.class_names = [self._get_name(name_index) for _, name_index, _, _ in class_entries]
+
+        self.segment2_properties = self._parse_property_lists(metadata[offsets[1] : offsets[2]])
+        object_entries = np.frombuffer(metadata[offsets[2] : offsets[3]], dtype="<u4").reshape(-1, 6)
+        self.segment4_properties = self._parse_property_lists(metadata[offsets[3] : offsets[4]])
+
+        # Each entry is (class index, 0, 0, segment 2 index, segment 4 index, object id)
+        self.objects = {int(entry[5]): entry for entry in object_entries[1:]}
+
+    def _get_name(self, name_index: int) -> Optional[str]:
+        return self.names[name_index - 1] if name_index > 0 else None
+
+    @staticmethod
+    def _parse_property_lists(segment: bytes) -> list:
+        """Each list is (number of properties, then (name index, flag, value) per property), aligned to 8 bytes."""
+        property_lists = [None]  # Indices are one-based
+        position = 8  # The segment starts with 8 bytes of zeros
+        while position + 4 <= len(segment):
+            (num_properties,) = struct.unpack_from("<I", segment, position)
+            position += 4
+            properties = struct.unpack_from(f"<{3 * num_properties}I", segment, position)
+            position += 12 * num_properties
+            position += (8 - position % 8) % 8
+            property_lists.append([properties[index : index + 3] for index in range(0, len(properties), 3)])
+        return property_lists
+
+    def get_object_properties(self, object_id: int, num_rows: Optional[int] = None) -> dict:
+        """
+        The properties of an object, by name.
+
+        With `num_rows`, only the first rows of the columns of a table (the cells of its `data` property) are read,
+        and `num_rows_read` is added to the properties.
+        """
+        class_index, _, _, segment2_index, segment4_index, _ = self.objects[object_id]
+        if segment2_index:
+            property_list = self.segment2_properties[segment2_index]
+        else:
+            property_list = self.segment4_properties[segment4_index]
+
+        properties = dict()
+        for name_index, flag, value in property_list:
+            if flag == 0:  # The value is a name
+                properties[self._get_name(name_index)] = self._get_name(value)
+            elif flag == 1 and num_rows is not None and self._get_name(name_index) == "data":
+                cell = self.cells[value + 2]
+                properties["data"] = [
+                    self.reader._decode(self.reader.file[reference], num_rows=num_rows)
+                    for reference in cell[()].T.ravel()
+                ]
+                properties["num_rows_read"] = num_rows
+            elif flag == 1:  # The value is stored in a cell; the first two cells hold metadata
+                properties[self._get_name(name_index)] = self.reader._decode(self.cells[value + 2])
+            else:  # The value is stored inline (logicals and small integers)
+                properties[self._get_name(name_index)] = value
+        return properties
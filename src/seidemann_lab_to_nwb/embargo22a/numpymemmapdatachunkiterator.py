@@ -0,0 +1,168 @@
+"""Chunked iterator that reads raw imaging data in the native layout of the file."""
+import math
+from pathlib import Path
+from typing import Optional, Tuple
+from warnings import warn
+
+import numpy as np
+from hdmf.data_utils import DataChunk, GenericDataChunkIterator
+
+from neuroconv.utils import FilePathType
+
+from seidemann_lab_to_nwb.embargo22a.prefetchingframereader import PrefetchingFrameReader
+
+
+class NumpyMemmapDataChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over a raw binary imaging file one block of frames at a time.
+
+    The file is memory-mapped with its native axis order, so a block of consecutive frames of one channel is read as a
+    single contiguous region whenever the layout allows it (channel-first or frame-first files). Blocks are returned in
+    the NWB (frames, columns, rows) convention and never exceed `frames_per_block` frames.
+
+    With a `summary_accumulator` (see `ImagingSummaryAccumulator`), every block of whole frames read is also added to
+    the trial averages and projections of the accumulator.
+
+    With `prefetch_depth` > 0, the blocks are instead read with a `PrefetchingFrameReader`, which reads the next
+    `prefetch_depth` blocks in a background thread while the current one is compressed and written. This needs the
+    frames to be contiguous in the file (frame-first files, or channel-first files); other layouts are memory-mapped.
+    """
+
+    def __init__(
+        self,
+        file_path: FilePathType,
+        dtype: str,
+        num_rows: int,
+        num_columns: int,
+        num_channels: int,
+        frame_axis: int,
+        rows_axis: int,
+        columns_axis: int,
+        channels_axis: int,
+        offset: int = 0,
+        channel: int = 0,
+        start_frame: int = 0,
+        stop_frame: Optional[int] = None,
+        frames_per_block: int = 500,
+        chunk_shape: Optional[Tuple[int, int, int]] = None,
+        chunk_mb: float = 10.0,
+        display_progress: bool = False,
+        summary_accumulator=None,
+        prefetch_depth: int = 0,
+        num_prefetch_buffers: Optional[int] = None,
+    ):
+        self.file_path = Path(file_path)
+        self.raw_dtype = np.dtype(dtype)
+        self.num_rows = num_rows
+        self.num_columns = num_columns
+        self.channel = channel
+        self.frame_axis = frame_axis
+        self.rows_axis = rows_axis
+        self.columns_axis = columns_axis
+        self.channels_axis = channels_axis
+        self.summary_accumulator = summary_accumulator
+
+        frame_size_in_bytes = num_rows * num_columns * num_channels * self.raw_dtype.itemsize
+        file_size_in_bytes = self.file_path.stat().st_size
+        self.num_frames_in_file = (file_size_in_bytes - offset) // frame_size_in_bytes
+
+        memmap_shape = [0, 0, 0, 0]
+        memmap_shape[frame_axis] = self.num_frames_in_file
+        memmap_shape[rows_axis] = num_rows
+        memmap_shape[columns_axis] = num_columns
+        memmap_shape[channels_axis] = num_channels
+        self._memmap = np.memmap(
+            self.file_path, dtype=self.raw_dtype, mode="r", offset=offset, shape=tuple(memmap_shape)
+        )
+
+        # Order of the remaining axes once the channel axis has been indexed out
+        remaining_axes = [axis for axis in range(4) if axis != channels_axis]
+        self._to_frames_rows_columns = [remaining_axes.index(axis) for axis in (frame_axis, rows_axis, columns_axis)]
+
+        stop_frame = self.num_frames_in_file if stop_frame is None else min(stop_frame, self.num_frames_in_file)
+        self.start_frame = start_frame
+        self.stop_frame = stop_frame
+        self.num_frames = stop_frame - start_frame
+
+        self._frame_reader = None
+        if prefetch_depth > 0:
+            self._set_frame_reader(offset, prefetch_depth, num_prefetch_buffers)
+
+        if chunk_shape is None:
+            bytes_per_output_frame = num_rows * num_columns * self.raw_dtype.itemsize
+            frames_per_chunk = max(1, int(chunk_mb * 1e6 // bytes_per_output_frame))
+            frames_per_chunk = min(frames_per_chunk, frames_per_block, self.num_frames)
+            chunk_shape = (frames_per_chunk, num_columns, num_rows)
+        chunk_shape = tuple(int(axis) for axis in chunk_shape)
+
+        # The buffer always spans whole frames and must hold an integer number of chunks along the frame axis
+        frames_per_buffer = math.ceil(frames_per_block / chunk_shape[0]) * chunk_shape[0]
+        frames_per_buffer = min(frames_per_buffer, self.num_frames)
+        buffer_shape = (frames_per_buffer, num_columns, num_rows)
+
+        super().__init__(buffer_shape=buffer_shape, chunk_shape=chunk_shape, display_progress=display_progress)
+
+    def _set_frame_reader(self, offset: int, prefetch_depth: int, num_buffers: Optional[int]):
+        """Read the frames with a `PrefetchingFrameReader` if the frames of the channel are contiguous in the file."""
+        # The channel is selected in the file when its axis is before the frame axis, and in memory otherwise
+        frames_index = [slice(None)] * 4
+        if self.channels_axis < self.frame_axis:
+            frames_index[self.channels_axis] = self.channel
+        frames_view = self._memmap[tuple(frames_index)]
+        self._frame_axis_in_view = self.frame_axis - int(self.channels_axis < self.frame_axis)
+        is_frame_outermost = all(length == 1 for length in frames_view.shape[: self._frame_axis_in_view])
+        if not (frames_view.flags.c_contiguous and is_frame_outermost):
+            warn(f"The frames of {self.file_path.name} are not contiguous in the file, they are not prefetched.")
+            return
+
+        self._frames_view_shape = frames_view.shape
+        self._frame_reader = PrefetchingFrameReader(
+            file_path=self.file_path,
+            offset=offset + (frames_view.ctypes.data - self._memmap.ctypes.data),
+            frame_size=frames_view.strides[self._frame_axis_in_view],
+            num_frames=self.stop_frame,
+            prefetch_depth=prefetch_depth,
+            num_buffers=num_buffers,
+        )
+
+    def get_frames(self, start_frame: int, stop_frame: int) -> np.ndarray:
+        """Read frames [start_frame, stop_frame) of the file as a (frames, rows, columns) array."""
+        if self._frame_reader is not None:
+            with self._frame_reader.read(start_frame=start_frame, stop_frame=stop_frame) as block:
+                block_shape = list(self._frames_view_shape)
+                block_shape[self._frame_axis_in_view] = stop_frame - start_frame
+                frames = block.view(self.raw_dtype).reshape(block_shape)
+                if self.channels_axis > self.frame_axis:
+                    channel_index = [slice(None)] * 4
+                    channel_index[self.channels_axis] = self.channel
+                    frames = frames[tuple(channel_index)]
+                return np.array(frames.transpose(self._to_frames_rows_columns))
+
+        index = [slice(None)] * 4
+        index[self.frame_axis] = slice(start_frame, stop_frame)
+        index[self.channels_axis] = self.channel
+        frames = self._memmap[tuple(index)].transpose(self._to_frames_rows_columns)
+
+        return np.array(frames)  # Copying in (frames, rows, columns) order walks the file sequentially
+
+    def _get_data(self, selection: Tuple[slice]) -> np.ndarray:
+        frame_selection, columns_selection, rows_selection = selection
+        start_frame = self.start_frame + (frame_selection.start or 0)
+        stop_frame = self.start_frame + (self.num_frames if frame_selection.stop is None else frame_selection.stop)
+        frames = self.get_frames(start_frame=start_frame, stop_frame=stop_frame).transpose(0, 2, 1)
+        if self.summary_accumulator is not None:
+            self.summary_accumulator.add_frames(start_frame=start_frame - self.start_frame, frames=frames)
+
+        return frames[:, columns_selection, rows_selection]
+
+    def __next__(self) -> DataChunk:
+        chunk = super().__next__()
+        if self.summary_accumulator is not None:
+            self.summary_accumulator.num_blocks_streamed += 1
+        return chunk
+
+    def _get_dtype(self) -> np.dtype:
+        return self.raw_dtype
+
+    def _get_maxshape(self) -> Tuple[int, int, int]:
+        return (self.num_frames, self.num_columns, self.num_rows)
@@ -1,15 +1,32 @@
+from copy import deepcopy
+from functools import partial
+from typing import List, Optional
+
+import numpy as np
 from pydantic import FilePath
+from pynwb import NWBFile
+from pynwb.base import Images
+from pynwb.image import GrayscaleImage, ImageSeries
+from pynwb.ophys import TwoPhotonSeries
 from roiextractors import NumpyMemmapImagingExtractor
 from roiextractors.extraction_tools import VideoStructure
 
 from neuroconv.datainterfaces.ophys.baseimagingextractorinterface import BaseImagingExtractorInterface
+from neuroconv.tools.nwb_helpers import get_module
+from neuroconv.tools.roiextractors import add_devices, add_imaging_plane
 from neuroconv.utils import FilePathType
 
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
+from seidemann_lab_to_nwb.embargo22a.imagingsummaries import ImagingSummaryAccumulator, ImagingSummaryDataChunkIterator
+from seidemann_lab_to_nwb.embargo22a.parallelcompression import ParallelCompressionDataChunkIterator
+from numpymemmapdatachunkiterator import NumpyMemmapDataChunkIterator
+
 
 class NumpyMemmapImagingInterface(BaseImagingExtractorInterface):
     """Data Interface for raw imaging data."""
 
     IX = NumpyMemmapImagingExtractor
+    compression_policy = CompressionPolicy()  # Replaced by the policy of the conversion
 
     def __init__(
         self,
@@ -57,3 +74,227 @@ class NumpyMemmapImagingInterface(BaseImagingExtractorInterface):
             num_channels_axis=channels_axis,
             offset=offset,
         )
+
+        # Trial structure of the frames, for the trial-averaged summaries; see `set_trial_conditions`
+        self.trial_conditions = None
+        self.condition_labels = None
+        self.frames_per_trial = None
+
+    def set_trial_conditions(self, trial_conditions: np.ndarray, condition_labels: List[str], frames_per_trial: int):
+        """
+        Set the trial structure of the movie: consecutive trials of `frames_per_trial` frames, whose conditions are
+        `trial_conditions` as indices into `condition_labels`.
+        """
+        self.trial_conditions = np.asarray(trial_conditions)
+        self.condition_labels = list(condition_labels)
+        self.frames_per_trial = frames_per_trial
+
+    def get_data_chunk_iterator(
+        self,
+        start_frame: int = 0,
+        stop_frame: Optional[int] = None,
+        frames_per_block: int = 500,
+        chunk_shape: Optional[list] = None,
+        display_progress: bool = False,
+        summary_accumulator: Optional[ImagingSummaryAccumulator] = None,
+        prefetch_depth: int = 0,
+        num_prefetch_buffers: Optional[int] = None,
+    ) -> NumpyMemmapDataChunkIterator:
+        """Build an iterator that streams the raw file in its native order, one block of frames at a time."""
+        return NumpyMemmapDataChunkIterator(
+            file_path=self.source_data["file_path"],
+            dtype=self.source_data["dtype"],
+            num_rows=self.source_data["rows"],
+            num_columns=self.source_data["columns"],
+            num_channels=self.source_data["num_channels"],
+            frame_axis=self.source_data["frame_axis"],
+            rows_axis=self.source_data["rows_axis"],
+            columns_axis=self.source_data["columns_axis"],
+            channels_axis=self.source_data["num_channels_axis"],
+            offset=self.source_data["offset"],
+            start_frame=start_frame,
+            stop_frame=stop_frame,
+            frames_per_block=frames_per_block,
+            chunk_shape=chunk_shape,
+            display_progress=display_progress,
+            summary_accumulator=summary_accumulator,
+            prefetch_depth=prefetch_depth,
+            num_prefetch_buffers=num_prefetch_buffers,
+        )
+
+    def get_stop_frame(self, stop_time: float) -> int:
+        """Index of the first frame acquired at or after `stop_time` in seconds."""
+        num_frames = self.imaging_extractor.get_num_frames()
+        if self.imaging_extractor.has_time_vector():
+            frame_times = self.imaging_extractor.frame_to_time(np.arange(num_frames))
+            return int(np.searchsorted(frame_times, stop_time, side="left"))
+        sampling_frequency = float(self.source_data["sampling_frequency"])
+        return int(min(num_frames, max(0, np.ceil(stop_time * sampling_frequency))))
+
+    def run_conversion(
+        self,
+        nwbfile: NWBFile,
+        metadata: dict,
+        stub_test: bool = False,
+        stub_frames: int = 100,
+        frames_per_block: int = 500,
+        chunk_shape: Optional[list] = None,
+        stop_time: Optional[float] = None,
+        write_trial_summaries: bool = False,
+        prefetch_depth: int = 0,
+        num_prefetch_buffers: Optional[int] = None,
+        number_of_jobs: int = 1,
+    ):
+        """
+        Write the raw imaging data as a TwoPhotonSeries without materializing more than one block of frames.
+
+        Parameters
+        ----------
+        nwbfile: NWBFile
+        metadata: dict
+        stub_test: bool, default: False
+            Only write the first `stub_frames` frames.
+        stub_frames: int, default: 100
+        frames_per_block: int, default: 500
+            Number of frames read from the raw file at once; peak memory is bounded by the size of one block.
+        chunk_shape: list, optional
+            HDF5 chunk shape in (frames, columns, rows). Defaults to the chunk shape of the compression policy for
+            `<series name>/data`, or to whole-frame chunks of about 10 MB.
+        stop_time: float, optional
+            Only write the frames acquired before this time in seconds, e.g. to preview a session.
+        write_trial_summaries: bool, default: False
+            Also write the mean and maximum projections of the movie and, once `set_trial_conditions` was called, the
+            mean and variance over the trials of every condition, computed from the frames as they are written (see
+            `add_trial_summaries`).
+        prefetch_depth: int, default: 0
+            Number of blocks of frames read ahead in a background thread while the current block is compressed and
+            written, for raw files on network storage (see `PrefetchingFrameReader`). Disabled by default.
+        num_prefetch_buffers: int, optional
+            Number of block buffers of the read-ahead, `prefetch_depth + 1` by default; each holds one block of
+            `frames_per_block` frames.
+        number_of_jobs: int, default: 1
+            Number of threads that compress the gzip chunks of the data with the HDF5 backend; the chunks are then
+            written with direct chunk writes by `parallelcompression.write_compressed_chunk`, which
+            `Embargo22ANWBConverter.run_conversion` hooks on the write. 1 compresses them in the HDF5 filters, as they
+            are written.
+        """
+        two_photon_series_kwargs = deepcopy(metadata["Ophys"]["TwoPhotonSeries"][0])
+        dataset_name = f"{two_photon_series_kwargs['name']}/data"
+        chunk_shape = chunk_shape or self.compression_policy.get_settings(dataset_name, num_dimensions=3)["chunk_shape"]
+
+        num_frames = self.imaging_extractor.get_num_frames()
+        stop_frame = min(stub_frames, num_frames) if stub_test else None
+        if stop_time is not None:
+            stop_frame = min(stop_frame or num_frames, self.get_stop_frame(stop_time=stop_time))
+        summary_accumulator = None
+        if write_trial_summaries:
+            frame_shape = (self.source_data["columns"], self.source_data["rows"])
+            summary_accumulator = ImagingSummaryAccumulator(
+                num_frames=(stop_frame if stop_frame is not None else num_frames),
+                frame_shape=frame_shape,
+                dtype=self.source_data["dtype"],
+                trial_conditions=self.trial_conditions,
+                condition_labels=self.condition_labels,
+                frames_per_trial=self.frames_per_trial or 1,
+            )
+        iterator = self.get_data_chunk_iterator(
+            stop_frame=stop_frame,
+            frames_per_block=frames_per_block,
+            chunk_shape=chunk_shape,
+            display_progress=self.verbose,
+            summary_accumulator=summary_accumulator,
+            prefetch_depth=prefetch_depth,
+            num_prefetch_buffers=num_prefetch_buffers,
+        )
+
+        add_devices(nwbfile=nwbfile, metadata=metadata)
+        add_imaging_plane(nwbfile=nwbfile, metadata=metadata)
+
+        imaging_plane = nwbfile.get_imaging_plane(name=two_photon_series_kwargs["imaging_plane"])
+        data = iterator
+        if number_of_jobs != 1 and self.compression_policy.backend == "hdf5":
+            data = ParallelCompressionDataChunkIterator(data_iterator=iterator, number_of_jobs=number_of_jobs)
+        two_photon_series_kwargs.update(
+            imaging_plane=imaging_plane,
+            data=self.compression_policy.wrap(dataset_name, data),
+        )
+
+        if self.imaging_extractor.has_time_vector():
+            frames = np.arange(iterator.start_frame, iterator.stop_frame)
+            timestamps = self.imaging_extractor.frame_to_time(frames)
+            timestamps = self.compression_policy.wrap(f"{two_photon_series_kwargs['name']}/timestamps", timestamps)
+            two_photon_series_kwargs.update(timestamps=timestamps, rate=None)
+        else:
+            two_photon_series_kwargs.update(starting_time=0.0, rate=float(self.source_data["sampling_frequency"]))
+
+        two_photon_series = TwoPhotonSeries(**two_photon_series_kwargs)
+        nwbfile.add_acquisition(two_photon_series)
+
+        if summary_accumulator is not None:
+            self.add_trial_summaries(nwbfile=nwbfile, iterator=iterator)
+
+    def add_trial_summaries(self, nwbfile: NWBFile, iterator: NumpyMemmapDataChunkIterator):
+        """
+        Add the summaries of the frames of `iterator` to the ophys processing module.
+
+        The summaries are written in the same pass as the raw frames, from the statistics that the accumulator of the
+        iterator collects while the frames are read; they never read the raw file again.
+
+        - `TrialAverage<Condition>` and `TrialVariance<Condition>`: ImageSeries with the mean and the variance over the
+          trials of a condition of every frame of the trial, aligned on the imaging trigger of the trials.
+        - `ImagingProjections`: the mean and maximum projections of the whole movie.
+        """
+        accumulator = iterator.summary_accumulator
+        frame_shape = accumulator.frame_shape
+        sampling_frequency = float(self.source_data["sampling_frequency"])
+
+        def wrap_summary(name: str, get_summary, shape: tuple, dtype):
+            data = ImagingSummaryDataChunkIterator(
+                accumulator=accumulator, get_summary=get_summary, shape=shape, dtype=dtype, get_data=iterator._get_data
+            )
+            return self.compression_policy.wrap(name, data)
+
+        ophys_module = get_module(
+            nwbfile=nwbfile, name="ophys", description="contains optical physiology processed data"
+        )
+        trial_shape = (accumulator.frames_per_trial,) + frame_shape
+        for condition in accumulator.conditions:
+            label = accumulator.condition_labels[condition]
+            num_trials = accumulator.get_num_trials(condition)
+            series_label = "".join(word.capitalize() for word in label.split("_"))
+            for summary_name, statistic, get_summary in (
+                ("TrialAverage", "mean", accumulator.get_trial_average),
+                ("TrialVariance", "variance (ddof=0)", accumulator.get_trial_variance),
+            ):
+                name = f"{summary_name}{series_label}"
+                get_condition_summary = partial(get_summary, condition)
+                image_series = ImageSeries(
+                    name=name,
+                    data=wrap_summary(f"{name}/data", get_condition_summary, trial_shape, "float32"),
+                    unit="n.a.",
+                    starting_time=0.0,
+                    rate=sampling_frequency,
+                    description=(
+                        f"The {statistic} over the {num_trials} '{label}' trials of every frame of the trial, aligned "
+                        f"on the imaging trigger of the trials, computed from the raw imaging data."
+                    ),
+                )
+                ophys_module.add(image_series)
+
+        images = [
+            GrayscaleImage(
+                name="mean",
+                data=wrap_summary("ImagingProjections/mean", accumulator.get_mean_projection, frame_shape, "float32"),
+                description="The mean of every frame of the raw imaging data.",
+            ),
+            GrayscaleImage(
+                name="max",
+                data=wrap_summary(
+                    "ImagingProjections/max", accumulator.get_max_projection, frame_shape, accumulator.dtype
+                ),
+                description="The maximum of every frame of the raw imaging data.",
+            ),
+        ]
+        ophys_module.add(
+            Images(name="ImagingProjections", images=images, description="Projections of the raw imaging data.")
+        )
@@ -0,0 +1,209 @@
+"""Compression of the HDF5 chunks of a DataChunkIterator in a pool of threads, written with direct chunk writes."""
+import os
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import h5py
+import numpy as np
+from h5py import h5z
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk, GenericDataChunkIterator
+
+
+def get_direct_write_filters(dataset: h5py.Dataset) -> Optional[dict]:
+    """
+    The filters of `dataset` as `compress_chunk` arguments, or None when its chunks cannot be compressed by it.
+
+    Only chunked datasets whose filter pipeline is gzip, optionally after the byte shuffle, are supported; the chunks
+    of other codecs (lzf, Blosc, Zstd) or without compression are written through the HDF5 filters.
+    """
+    if dataset.chunks is None:
+        return None
+    create_plist = dataset.id.get_create_plist()
+    filters = [create_plist.get_filter(index) for index in range(create_plist.get_nfilters())]
+    filter_codes = [filter_code for filter_code, _, _, _ in filters]
+    if filter_codes not in ([h5z.FILTER_DEFLATE], [h5z.FILTER_SHUFFLE, h5z.FILTER_DEFLATE]):
+        return None
+    deflate_values = filters[-1][2]
+    if len(deflate_values) != 1:
+        return None
+    return dict(chunk_shape=dataset.chunks, shuffle=len(filters) == 2, level=int(deflate_values[0]))
+
+
+def compress_chunk(data: np.ndarray, chunk_shape: Tuple[int, ...], shuffle: bool, level: int) -> bytes:
+    """
+    Compress a chunk the way the HDF5 filters `shuffle` and `deflate` do, to be written with `write_direct_chunk`.
+
+    HDF5 stores the chunks at the edge of a dataset whole, so a smaller chunk is padded with zeros (the fill value)
+    to `chunk_shape`.
+    """
+    if data.shape != tuple(chunk_shape):
+        padded_data = np.zeros(chunk_shape, dtype=data.dtype)
+        padded_data[tuple(slice(0, length) for length in data.shape)] = data
+        data = padded_data
+    data = np.ascontiguousarray(data)
+    if shuffle and data.dtype.itemsize > 1:
+        data = data.view("uint8").reshape(-1, data.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(data).data, level)
+
+
+class CompressedDataChunk(DataChunk):
+    """
+    DataChunk of a `ParallelCompressionDataChunkIterator`, whose HDF5 chunks are compressed by the pool of threads.
+
+    `data` is the uncompressed block, so the chunk can still be written as any other one.
+    """
+
+    def __init__(self, data: np.ndarray, selection: tuple, iterator: "ParallelCompressionDataChunkIterator"):
+        super().__init__(data=data, selection=selection)
+        self.iterator = iterator
+        self.num_chunks = iterator.get_num_chunks(selection)
+        self.compressed_chunks = None  # Offsets and futures of the compressed HDF5 chunks, in the order of the dataset
+
+    def get_compressed_chunks(self, dataset: h5py.Dataset) -> Optional[List[Tuple[Tuple[int, ...], Future]]]:
+        """The compressed HDF5 chunks of the block for `dataset`, or None to write it through the filters."""
+        if self.iterator.filters is None:
+            self.iterator.set_filters(dataset)
+        if self.compressed_chunks is None:
+            self.iterator.submit(self)
+        return self.compressed_chunks
+
+
+class ParallelCompressionDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Wrap a GenericDataChunkIterator so that the HDF5 chunks of its blocks are compressed by `number_of_jobs` threads.
+
+    The blocks of the wrapped iterator are read in order in the calling thread; every block is split into the chunks
+    of the dataset, which are compressed in the pool, and the next blocks are read ahead while fewer than
+    `max_pending_chunks` chunks wait to be written, which bounds the memory used. zlib and numpy release the GIL, so
+    the threads compress on separate cores. The chunks are only compressed, and written in order with HDF5 direct
+    chunk writes, when `write_compressed_chunk` is a chunk writer of the `HDF5WriteHooks` of the write: the filters
+    are taken from the dataset when its first block is written, so the file is the same as one written through the
+    HDF5 filters. Blocks that are not aligned with the chunks of the dataset are written through the filters.
+    """
+
+    def __init__(
+        self,
+        data_iterator: GenericDataChunkIterator,
+        number_of_jobs: Optional[int] = None,
+        max_pending_chunks: Optional[int] = None,
+    ):
+        self.data_iterator = data_iterator
+        self.number_of_jobs = number_of_jobs or os.cpu_count()
+        self.max_pending_chunks = max_pending_chunks or 2 * self.number_of_jobs
+        self.filters = None  # Arguments of `compress_chunk`, or False when the dataset filters are not supported
+        self._executor = None
+        self._pending_chunks = deque()
+        self._is_exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> DataChunk:
+        while not self._is_exhausted and (
+            not self._pending_chunks
+            or sum(chunk.num_chunks for chunk in self._pending_chunks) < self.max_pending_chunks
+        ):
+            try:
+                data_chunk = next(self.data_iterator)
+            except StopIteration:
+                self._is_exhausted = True
+                break
+            chunk = CompressedDataChunk(data=data_chunk.data, selection=data_chunk.selection, iterator=self)
+            self.submit(chunk)
+            self._pending_chunks.append(chunk)
+
+        if not self._pending_chunks:
+            self._shutdown()
+            raise StopIteration
+        return self._pending_chunks.popleft()
+
+    def get_chunk_shape(self) -> Tuple[int, ...]:
+        return self.filters["chunk_shape"] if self.filters else self.recommended_chunk_shape()
+
+    def get_num_chunks(self, selection: Tuple[slice]) -> int:
+        """Number of HDF5 chunks that `selection` overlaps."""
+        chunk_shape = self.get_chunk_shape()
+        return int(
+            np.prod(
+                [
+                    -(-(axis_selection.stop or length) // chunk_length) - (axis_selection.start or 0) // chunk_length
+                    for axis_selection, chunk_length, length in zip(selection, chunk_shape, self.maxshape)
+                ]
+            )
+        )
+
+    def set_filters(self, dataset: h5py.Dataset):
+        """Compress the chunks for the filters of `dataset`, from the blocks read ahead on."""
+        filters = get_direct_write_filters(dataset)
+        if filters is not None and np.dtype(dataset.dtype) != np.dtype(self.dtype):
+            filters = None
+        self.filters = filters or False
+        if self.filters:
+            self._executor = ThreadPoolExecutor(max_workers=self.number_of_jobs)
+            for chunk in self._pending_chunks:
+                chunk.num_chunks = self.get_num_chunks(chunk.selection)
+                self.submit(chunk)
+
+    def submit(self, chunk: CompressedDataChunk):
+        """Submit the compression of the HDF5 chunks of a block aligned with the chunks of the dataset."""
+        if not self.filters or len(chunk.selection) != len(self.filters["chunk_shape"]):
+            return
+        chunk_shape = self.filters["chunk_shape"]
+        starts = [axis_selection.start or 0 for axis_selection in chunk.selection]
+        is_aligned = all(
+            start % chunk_length == 0 and (axis_length % chunk_length == 0 or start + axis_length == length)
+            for start, axis_length, chunk_length, length in zip(starts, chunk.data.shape, chunk_shape, self.maxshape)
+        )
+        if not is_aligned:
+            return
+        compressed_chunks = []
+        for chunk_index in np.ndindex(
+            *[-(-axis_length // chunk_length) for axis_length, chunk_length in zip(chunk.data.shape, chunk_shape)]
+        ):
+            block_selection = tuple(
+                slice(index * chunk_length, (index + 1) * chunk_length)
+                for index, chunk_length in zip(chunk_index, chunk_shape)
+            )
+            chunk_offset = tuple(start + axis_selection.start for start, axis_selection in zip(starts, block_selection))
+            data = chunk.data[block_selection]
+            compressed_chunks.append((chunk_offset, self._executor.submit(compress_chunk, data, **self.filters)))
+        chunk.compressed_chunks = compressed_chunks
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_data(self, selection: Tuple[slice]) -> np.ndarray:
+        return self.data_iterator._get_data(selection)
+
+    def recommended_chunk_shape(self) -> Tuple[int, ...]:
+        return self.data_iterator.recommended_chunk_shape()
+
+    def recommended_data_shape(self) -> Tuple[int, ...]:
+        return self.data_iterator.recommended_data_shape()
+
+    @property
+    def dtype(self):
+        return self.data_iterator.dtype
+
+    @property
+    def maxshape(self) -> Tuple[int, ...]:
+        return self.data_iterator.maxshape
+
+
+def write_compressed_chunk(dataset: h5py.Dataset, chunk: DataChunk) -> bool:
+    """
+    Write the HDF5 chunks of a block of a `ParallelCompressionDataChunkIterator` with HDF5 direct chunk writes.
+
+    The chunk writer of `HDF5WriteHooks`: False is returned for other chunks, and for blocks that are written through
+    the filters, so that they are written as usual.
+    """
+    compressed_chunks = chunk.get_compressed_chunks(dataset) if isinstance(chunk, CompressedDataChunk) else None
+    if compressed_chunks is None:
+        return False
+    for chunk_offset, compressed_data in compressed_chunks:
+        dataset.id.write_direct_chunk(chunk_offset, compressed_data.result(), filter_mask=0)
+    return True
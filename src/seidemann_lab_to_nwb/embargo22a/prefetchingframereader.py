@@ -0,0 +1,177 @@
+"""Read-ahead of the blocks of frames of a raw file in a background thread, for files on network storage."""
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from neuroconv.utils import FilePathType
+
+
+class PrefetchingFrameReader:
+    """
+    Read blocks of consecutive frames of a file whose frames are contiguous ranges of `frame_size` bytes.
+
+    Once a block is read, the next `prefetch_depth` blocks of the same length are read ahead by a background thread
+    with large sequential `readinto` calls, so reading the next blocks from network storage overlaps the compression
+    and write of the current one. Blocks are read into a pool of `num_buffers` reusable buffers, one of which is held
+    by the block being used; memory is bounded by `num_buffers` blocks. A block requested out of sequence (e.g. the
+    missing rows of a resumed write) is read directly, and the read-ahead restarts after it.
+
+    The thread only runs while there are blocks to read ahead, so there is nothing to close.
+    """
+
+    def __init__(
+        self,
+        file_path: FilePathType,
+        offset: int,
+        frame_size: int,
+        num_frames: int,
+        prefetch_depth: int = 2,
+        num_buffers: Optional[int] = None,
+        read_size: int = 2**23,
+    ):
+        """
+        Parameters
+        ----------
+        file_path: FilePathType
+        offset: int
+            Position in bytes of the first frame in the file.
+        frame_size: int
+            Size in bytes of a frame, which is also the distance between two frames.
+        num_frames: int
+            Number of frames that can be read; the read-ahead stops there.
+        prefetch_depth: int, default: 2
+            Number of blocks read ahead of the last block requested.
+        num_buffers: int, optional
+            Number of buffers of the pool. Defaults to `prefetch_depth + 1`, the block being used and those read ahead.
+        read_size: int, default: 8 MiB
+            Size in bytes of each `readinto` call.
+        """
+        self.file_path = Path(file_path)
+        self.offset = offset
+        self.frame_size = frame_size
+        self.num_frames = num_frames
+        self.prefetch_depth = prefetch_depth
+        self.num_buffers = max(1, num_buffers if num_buffers is not None else prefetch_depth + 1)
+        self.read_size = read_size
+
+        self._condition = threading.Condition()
+        self._thread = None
+        self._free_buffers = []
+        self._num_allocated_buffers = 0
+        self._blocks = deque()  # Blocks (start_frame, stop_frame) read ahead or to read ahead, in order
+        self._unread_blocks = deque()  # The blocks the thread has not started reading
+        self._read_blocks = dict()  # Buffer, or exception raised reading it, of every block read ahead
+        self._generation = 0  # Incremented when the read-ahead is discarded, so blocks being read are dropped
+
+    @contextmanager
+    def read(self, start_frame: int, stop_frame: int):
+        """Context of a block of frames, as a flat uint8 array that is only valid inside the context."""
+        block = (start_frame, stop_frame)
+        with self._condition:
+            is_read_ahead = bool(self._blocks) and self._blocks[0] == block
+            if is_read_ahead:
+                self._blocks.popleft()
+                while block not in self._read_blocks:
+                    self._condition.wait()
+                buffer = self._read_blocks.pop(block)
+            else:
+                self._discard_read_ahead()
+                while not self._has_free_buffer():
+                    self._condition.wait()
+                buffer = self._take_buffer(self._get_num_bytes(block))
+            self._schedule_read_ahead(after_block=block)
+
+        try:
+            if isinstance(buffer, BaseException):
+                raise buffer
+            if not is_read_ahead:
+                with open(self.file_path, "rb", buffering=0) as file:
+                    self._read_block(file, block, buffer)
+            yield buffer[: self._get_num_bytes(block)]
+        finally:
+            if not isinstance(buffer, BaseException):
+                with self._condition:
+                    self._free_buffers.append(buffer)
+                    self._condition.notify_all()
+
+    def _get_num_bytes(self, block: Tuple[int, int]) -> int:
+        return (block[1] - block[0]) * self.frame_size
+
+    def _has_free_buffer(self) -> bool:
+        return bool(self._free_buffers) or self._num_allocated_buffers < self.num_buffers
+
+    def _take_buffer(self, num_bytes: int) -> np.ndarray:
+        """Take a buffer of at least `num_bytes` from the pool; call with the condition held and a free buffer."""
+        if self._free_buffers:
+            buffer = self._free_buffers.pop()
+            if len(buffer) >= num_bytes:
+                return buffer
+        else:
+            self._num_allocated_buffers += 1
+        return np.empty(num_bytes, dtype="uint8")
+
+    def _discard_read_ahead(self):
+        self._generation += 1
+        self._blocks.clear()
+        self._unread_blocks.clear()
+        for buffer in self._read_blocks.values():
+            if not isinstance(buffer, BaseException):
+                self._free_buffers.append(buffer)
+        self._read_blocks.clear()
+
+    def _schedule_read_ahead(self, after_block: Tuple[int, int]):
+        """Schedule the blocks of the same length as `after_block` that follow it, up to `prefetch_depth` blocks."""
+        block_length = after_block[1] - after_block[0]
+        next_start_frame = self._blocks[-1][1] if self._blocks else after_block[1]
+        while len(self._blocks) < self.prefetch_depth and next_start_frame < self.num_frames and block_length > 0:
+            block = (next_start_frame, min(next_start_frame + block_length, self.num_frames))
+            self._blocks.append(block)
+            self._unread_blocks.append(block)
+            next_start_frame = block[1]
+
+        if self._unread_blocks and self._thread is None:
+            self._thread = threading.Thread(target=self._read_ahead, name="PrefetchingFrameReader", daemon=True)
+            self._thread.start()
+        self._condition.notify_all()
+
+    def _read_ahead(self):
+        with open(self.file_path, "rb", buffering=0) as file:
+            while True:
+                with self._condition:
+                    while self._unread_blocks and not self._has_free_buffer():
+                        self._condition.wait()
+                    if not self._unread_blocks:
+                        self._thread = None
+                        return
+                    block = self._unread_blocks.popleft()
+                    generation = self._generation
+                    buffer = self._take_buffer(self._get_num_bytes(block))
+
+                try:
+                    self._read_block(file, block, buffer)
+                    result = buffer
+                except Exception as exception:
+                    result = exception
+
+                with self._condition:
+                    if isinstance(result, BaseException) or generation != self._generation:
+                        self._free_buffers.append(buffer)
+                    if generation == self._generation:
+                        self._read_blocks[block] = result
+                    self._condition.notify_all()
+
+    def _read_block(self, file, block: Tuple[int, int], buffer: np.ndarray):
+        """Fill `buffer` with the bytes of `block`, in sequential reads of at most `read_size` bytes."""
+        num_bytes = self._get_num_bytes(block)
+        view = memoryview(buffer)[:num_bytes]
+        file.seek(self.offset + block[0] * self.frame_size)
+        position = 0
+        while position < num_bytes:
+            num_read = file.readinto(view[position : position + self.read_size])
+            if not num_read:
+                raise EOFError(f"{self.file_path} ends before frame {block[1]}.")
+            position += num_read
@@ -0,0 +1,200 @@
+"""Extraction of the fluorescence and neuropil traces of suite2p ROIs from the raw frames with sparse weights."""
+import tempfile
+from typing import Callable, Tuple
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from scipy.ndimage import distance_transform_edt
+from scipy.sparse import coo_matrix, csr_matrix
+
+neuropil_radius_step = 5  # Pixels added to the outer radius of a neuropil mask until it has enough pixels
+
+
+def get_neuropil_pixels(
+    ypix: np.ndarray, xpix: np.ndarray, is_cell_pixel: np.ndarray, inner_neuropil_radius: int, min_neuropil_pixels: int
+) -> np.ndarray:
+    """
+    Flat indices of the neuropil mask of a ROI, like the masks suite2p makes.
+
+    The mask is the ring of pixels farther than `inner_neuropil_radius` from the ROI that are not part of any ROI
+    (`is_cell_pixel`), whose outer radius grows until it has `min_neuropil_pixels` pixels or covers the frame. Only
+    the crop of the frame around the ring is used.
+    """
+    num_rows, num_columns = is_cell_pixel.shape
+    outer_radius = inner_neuropil_radius + neuropil_radius_step
+    while True:
+        row_start, row_stop = max(0, ypix.min() - outer_radius), min(num_rows, ypix.max() + outer_radius + 1)
+        column_start, column_stop = max(0, xpix.min() - outer_radius), min(num_columns, xpix.max() + outer_radius + 1)
+        is_outside_roi = np.ones((row_stop - row_start, column_stop - column_start), dtype=bool)
+        is_outside_roi[ypix - row_start, xpix - column_start] = False
+        distance = distance_transform_edt(is_outside_roi)
+        is_neuropil = (distance > inner_neuropil_radius) & (distance <= outer_radius)
+        is_neuropil &= ~is_cell_pixel[row_start:row_stop, column_start:column_stop]
+        if np.count_nonzero(is_neuropil) >= min_neuropil_pixels or outer_radius >= num_rows + num_columns:
+            break
+        outer_radius += neuropil_radius_step
+
+    rows, columns = np.nonzero(is_neuropil)
+    return (rows + row_start) * num_columns + columns + column_start
+
+
+def get_roi_weights(
+    stat: np.ndarray,
+    frame_shape: Tuple[int, int],
+    allow_overlap: bool = False,
+    inner_neuropil_radius: int = 2,
+    min_neuropil_pixels: int = 350,
+) -> csr_matrix:
+    """
+    Sparse (2 * ROIs, pixels) matrix of the weights of the ROI masks of `stat`, followed by those of their neuropil.
+
+    The pixels of the frames of shape (rows, columns) are flattened in C order, the order of `ypix` and `xpix`. The
+    weights of a ROI are its `lam` normalized to a sum of 1, without the pixels shared with other ROIs unless
+    `allow_overlap` (or when all its pixels are shared); those of a neuropil mask are uniform. The neuropil masks are
+    the `neuropil_mask` of `stat` when suite2p saved them, and are made by `get_neuropil_pixels` otherwise.
+    """
+    num_rows, num_columns = frame_shape
+    num_rois = len(stat)
+    roi_pixels = [
+        np.asarray(roi["ypix"], dtype="int64") * num_columns + np.asarray(roi["xpix"], dtype="int64") for roi in stat
+    ]
+    pixel_counts = np.bincount(np.concatenate(roi_pixels), minlength=num_rows * num_columns) if num_rois else None
+
+    rows, columns, weights = [], [], []
+    for roi_index, (roi, pixels) in enumerate(zip(stat, roi_pixels)):
+        lam = np.asarray(roi["lam"], dtype="float64")
+        if not allow_overlap and np.any(pixel_counts[pixels] == 1):
+            is_kept = pixel_counts[pixels] == 1
+            pixels, lam = pixels[is_kept], lam[is_kept]
+        lam_sum = lam.sum()
+        rows.append(np.full(len(pixels), roi_index))
+        columns.append(pixels)
+        weights.append(lam / lam_sum if lam_sum > 0 else np.full(len(pixels), 1.0 / max(1, len(pixels))))
+
+    is_cell_pixel = (pixel_counts > 0).reshape(frame_shape) if num_rois else None
+    for roi_index, (roi, pixels) in enumerate(zip(stat, roi_pixels)):
+        if "neuropil_mask" in roi:
+            neuropil_pixels = np.asarray(roi["neuropil_mask"], dtype="int64")
+        elif len(pixels):
+            neuropil_pixels = get_neuropil_pixels(
+                ypix=np.asarray(roi["ypix"], dtype="int64"),
+                xpix=np.asarray(roi["xpix"], dtype="int64"),
+                is_cell_pixel=is_cell_pixel,
+                inner_neuropil_radius=inner_neuropil_radius,
+                min_neuropil_pixels=min_neuropil_pixels,
+            )
+        else:
+            neuropil_pixels = np.empty(0, dtype="int64")
+        rows.append(np.full(len(neuropil_pixels), num_rois + roi_index))
+        columns.append(neuropil_pixels)
+        weights.append(np.full(len(neuropil_pixels), 1.0 / max(1, len(neuropil_pixels))))
+
+    shape = (2 * num_rois, num_rows * num_columns)
+    if not num_rois:
+        return csr_matrix(shape, dtype="float32")
+    weights = np.concatenate(weights).astype("float32")
+    return coo_matrix((weights, (np.concatenate(rows), np.concatenate(columns))), shape=shape).tocsr()
+
+
+class RoiTraceExtractor:
+    """
+    Extract the traces of the ROIs and of their neuropil from blocks of frames, with one sparse matrix product each.
+
+    `get_frames(start_frame, stop_frame)` reads a block of frames as a (frames, rows, columns) array, and `weights` is
+    the matrix of `get_roi_weights`. Every block of `frames_per_block` frames is read and extracted once, into a
+    temporary memory-mapped file that the iterators of the ROI traces and of the neuropil traces read, whatever the
+    order the backend writes them in; memory is bounded by one block of frames.
+    """
+
+    def __init__(
+        self,
+        weights: csr_matrix,
+        get_frames: Callable[[int, int], np.ndarray],
+        num_frames: int,
+        frames_per_block: int = 500,
+    ):
+        self.weights = weights.astype("float32")
+        self.num_rois = weights.shape[0] // 2
+        self.get_frames = get_frames
+        self.num_frames = num_frames
+        self.frames_per_block = frames_per_block
+
+        self._traces = None  # Created when the first block is extracted
+        self._is_block_extracted = np.zeros(-(-num_frames // frames_per_block), dtype=bool)
+
+    def get_traces(self, start_frame: int, stop_frame: int) -> np.ndarray:
+        """The ROI traces followed by the neuropil traces of frames [start_frame, stop_frame), as (frames, 2 * ROIs)."""
+        if self._traces is None:
+            shape = (self.num_frames, 2 * self.num_rois)
+            if self.num_frames == 0 or self.num_rois == 0:  # A memory map cannot be empty
+                self._traces = np.empty(shape, dtype="float32")
+            else:
+                self._traces = np.memmap(tempfile.TemporaryFile(), dtype="float32", mode="w+", shape=shape)
+
+        stop_frame = min(stop_frame, self.num_frames)
+        first_block = start_frame // self.frames_per_block
+        last_block = -(-stop_frame // self.frames_per_block)
+        for block_index in range(first_block, last_block):
+            if not self._is_block_extracted[block_index]:
+                self._extract_block(block_index)
+        return self._traces[start_frame:stop_frame]
+
+    def _extract_block(self, block_index: int):
+        start_frame = block_index * self.frames_per_block
+        stop_frame = min(start_frame + self.frames_per_block, self.num_frames)
+        frames = self.get_frames(start_frame, stop_frame)
+        pixels = frames.reshape(len(frames), -1).T
+        self._traces[start_frame:stop_frame] = (self.weights @ pixels).T
+        self._is_block_extracted[block_index] = True
+
+
+class RoiTraceDataChunkIterator(AbstractDataChunkIterator):
+    """Write the ROI (`trace_index` 0) or neuropil (1) traces of a `RoiTraceExtractor`, one block at a time."""
+
+    def __init__(self, extractor: RoiTraceExtractor, trace_index: int, chunk_mb: float = 10.0):
+        self.extractor = extractor
+        self.trace_index = trace_index
+        self._maxshape = (extractor.num_frames, extractor.num_rois)
+        self._dtype = np.dtype("float32")
+
+        bytes_per_frame = self._dtype.itemsize * max(1, extractor.num_rois)
+        frames_per_chunk = max(1, min(self._maxshape[0], int(chunk_mb * 1e6 // bytes_per_frame)))
+        self._chunk_shape = (frames_per_chunk, max(1, extractor.num_rois))
+
+        self._block_starts = iter(range(0, extractor.num_frames, extractor.frames_per_block))
+
+    @property
+    def _columns(self) -> slice:
+        return slice(self.trace_index * self.extractor.num_rois, (self.trace_index + 1) * self.extractor.num_rois)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> DataChunk:
+        start = next(self._block_starts)
+        stop = min(start + self.extractor.frames_per_block, self.extractor.num_frames)
+        block = np.array(self.extractor.get_traces(start, stop)[:, self._columns])
+        return DataChunk(data=block, selection=(slice(start, stop), slice(0, self.extractor.num_rois)))
+
+    next = __next__
+
+    def _get_data(self, selection: Tuple[slice, ...]) -> np.ndarray:
+        """Read `selection` of the traces without advancing the iterator, like `GenericDataChunkIterator`."""
+        start = selection[0].start or 0
+        stop = self._maxshape[0] if selection[0].stop is None else selection[0].stop
+        traces = np.array(self.extractor.get_traces(start, stop)[:, self._columns])
+        return traces[(slice(None),) + tuple(selection[1:])]
+
+    def recommended_chunk_shape(self) -> Tuple[int, ...]:
+        return self._chunk_shape
+
+    def recommended_data_shape(self) -> Tuple[int, ...]:
+        return self._maxshape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def maxshape(self) -> Tuple[int, ...]:
+        return self._maxshape
@@ -0,0 +1,491 @@
+"""Pre-flight checks of the layout and consistency of sessions, from file sizes, small samples and lazy MAT reads."""
+import itertools
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from neuroconv.utils.types import FolderPathType
+
+from seidemann_lab_to_nwb.embargo22a.conversion_parameters import (
+    columns,
+    columns_axis,
+    frame_axis,
+    num_channels,
+    num_channels_axis,
+    rows,
+    rows_axis,
+)
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import Embargo22ASessionLoader, to_jsonable, to_scalar
+from seidemann_lab_to_nwb.embargo22a.embargo22asuite2pinterface import trace_file_names
+from seidemann_lab_to_nwb.embargo22a.lazymatreader import LazyMatReader, table_decode_errors
+
+raw_file_name = "Image_001_001.raw"
+default_imaging_parameters = dict(
+    num_rows=rows,
+    num_columns=columns,
+    num_channels=num_channels,
+    rows_axis=rows_axis,
+    columns_axis=columns_axis,
+    channels_axis=num_channels_axis,
+    frame_axis=frame_axis,
+    sampling_frequency=30.0,
+    dtype="uint16",
+    offset=0,
+)
+candidate_dtypes = ["uint16", "int16", ">u2", ">i2", "uint8", "int8", "uint32", "int32", "float32", "float64"]
+trial_fields = ["TrialNum", "TimeTrialStart", "TimeOITrigger", "FlagOIBLK"]
+
+
+def is_session(session_path: FolderPathType) -> bool:
+    """A session folder holds a `stream` folder with the raw imaging file, the suite2p output and the TS MAT file."""
+    stream_path = Path(session_path) / "stream"
+    has_raw_file = (stream_path / raw_file_name).is_file()
+    has_suite2p = (stream_path / "suite2p").is_dir()
+    has_mat_file = any(stream_path.glob("*.mat"))
+    return has_raw_file and has_suite2p and has_mat_file
+
+
+def find_sessions(
+    root_path: Optional[FolderPathType] = None,
+    manifest_path: Optional[FolderPathType] = None,
+    complete_only: bool = True,
+) -> List[Path]:
+    """
+    Find the session folders, the folders with a `stream` folder.
+
+    Parameters
+    ----------
+    root_path: FolderPathType, optional
+        Folder searched recursively for session folders.
+    manifest_path: FolderPathType, optional
+        Text file with one session folder per line; empty lines and lines starting with '#' are ignored.
+    complete_only: bool, default: True
+        Only keep the sessions with every source file (see `is_session`); the scan reports what the others miss.
+    """
+    session_paths = []
+    if root_path is not None:
+        stream_paths = sorted(Path(root_path).rglob("stream"))
+        session_paths += [stream_path.parent for stream_path in stream_paths if stream_path.is_dir()]
+    if manifest_path is not None:
+        lines = Path(manifest_path).read_text().splitlines()
+        session_paths += [Path(line.strip()) for line in lines if line.strip() and not line.startswith("#")]
+
+    session_paths = list(dict.fromkeys(session_paths))
+    return (
+        [session_path for session_path in session_paths if is_session(session_path)] if complete_only else session_paths
+    )
+
+
+class SessionScan:
+    """The findings of `scan_session`: what was measured in each part of the session, and the problems found."""
+
+    def __init__(self, session_path: Path):
+        self.session_path = session_path
+        self.parts = dict()
+        self.problems = []
+
+    def add_problem(self, severity: str, check: str, message: str):
+        self.problems.append(dict(severity=severity, check=check, message=message))
+
+    @property
+    def has_errors(self) -> bool:
+        return any(problem["severity"] == "error" for problem in self.problems)
+
+    def to_dict(self) -> dict:
+        return dict(session_path=str(self.session_path), **self.parts, problems=self.problems)
+
+
+def get_raw_shape(num_frames: int, imaging_parameters: dict, axes: Optional[Dict[str, int]] = None) -> tuple:
+    """Shape of the raw file, in the order of its axes."""
+    axes = axes or {name: imaging_parameters[name] for name in ["frame_axis", "rows_axis", "columns_axis"]}
+    shape = [0] * 4
+    shape[imaging_parameters["channels_axis"]] = imaging_parameters["num_channels"]
+    shape[axes["frame_axis"]] = num_frames
+    shape[axes["rows_axis"]] = imaging_parameters["num_rows"]
+    shape[axes["columns_axis"]] = imaging_parameters["num_columns"]
+    return tuple(shape)
+
+
+def _get_spatial_correlation(window: np.ndarray) -> float:
+    """Smallest correlation of the pixels of a frame window with their neighbours along the rows and the columns."""
+    window = window.astype("float64")
+    correlations = []
+    for axis in range(2):
+        first, second = np.moveaxis(window, axis, 0)[:-1].ravel(), np.moveaxis(window, axis, 0)[1:].ravel()
+        if first.std() == 0 or second.std() == 0:
+            return np.nan
+        correlations.append(np.corrcoef(first, second)[0, 1])
+    return float(min(correlations))
+
+
+def guess_raw_layout(
+    file_path: Path,
+    imaging_parameters: dict,
+    expected_num_frames: Optional[int] = None,
+    sample_frames: int = 3,
+    window_size: int = 32,
+) -> dict:
+    """
+    Guess the data type and the order of the axes of the raw file from its size and a few sampled frames.
+
+    The data types are those whose frames fill the file (and match `expected_num_frames` when given); camera pixels
+    span a small part of the range of the type, so the type whose most significant bytes take the fewest values is
+    kept, and the configured type on ties (e.g. uint16 and int16 without negative values). The order of the frame, row
+    and column axes is the one whose frames are the most spatially coherent, measured on a `window_size` window of
+    `sample_frames` frames. It is only reported as determined when that correlation is high and clearly the best,
+    which it is not for noise.
+    """
+    configured_dtype = np.dtype(imaging_parameters["dtype"])
+    data_size = file_path.stat().st_size - imaging_parameters["offset"]
+    num_pixels = imaging_parameters["num_rows"] * imaging_parameters["num_columns"] * imaging_parameters["num_channels"]
+    sample_size = min(data_size, 2**16)
+    sample_bytes = np.fromfile(file_path, dtype="uint8", count=sample_size, offset=imaging_parameters["offset"])
+
+    dtype_scores = dict()
+    for dtype in dict.fromkeys([configured_dtype.str] + [np.dtype(dtype).str for dtype in candidate_dtypes]):
+        dtype = np.dtype(dtype)
+        frame_size = num_pixels * dtype.itemsize
+        if data_size == 0 or data_size % frame_size:
+            continue
+        if expected_num_frames is not None and data_size // frame_size != expected_num_frames:
+            continue
+        sample = sample_bytes[: sample_size - sample_size % dtype.itemsize].reshape(-1, dtype.itemsize)
+        most_significant_bytes = sample[:, -1] if dtype.byteorder in "<=|" else sample[:, 0]
+        dtype_scores[dtype] = len(np.unique(most_significant_bytes))
+    if not dtype_scores:
+        return dict(dtype=None, axes=None, is_axes_order_determined=False)
+    dtype = min(dtype_scores, key=lambda dtype: dtype_scores[dtype])  # The first of the best, the configured one first
+    num_frames = data_size // (num_pixels * dtype.itemsize)
+
+    # Positions of the frame, rows and columns axes among the axes other than the channels axis
+    axis_positions = [axis for axis in range(4) if axis != imaging_parameters["channels_axis"]]
+    configured_axes = {name: imaging_parameters[name] for name in ["frame_axis", "rows_axis", "columns_axis"]}
+    frame_indices = np.unique(np.linspace(0, num_frames - 1, sample_frames).astype("int64"))
+    axes_scores = []
+    for positions in itertools.permutations(axis_positions):
+        axes = dict(zip(["frame_axis", "rows_axis", "columns_axis"], positions))
+        shape = get_raw_shape(num_frames, imaging_parameters, axes=axes)
+        raw_data = np.memmap(file_path, dtype=dtype, mode="r", offset=imaging_parameters["offset"], shape=shape)
+        correlations = []
+        for frame_index in frame_indices:
+            selection = [slice(None)] * 4
+            selection[imaging_parameters["channels_axis"]] = 0
+            selection[axes["frame_axis"]] = int(frame_index)
+            selection[axes["rows_axis"]] = slice(0, window_size)
+            selection[axes["columns_axis"]] = slice(0, window_size)
+            window = np.asarray(raw_data[tuple(selection)])
+            correlations.append(
+                _get_spatial_correlation(window if axes["rows_axis"] < axes["columns_axis"] else window.T)
+            )
+        del raw_data
+        score = float(np.nanmean(correlations)) if not np.all(np.isnan(correlations)) else np.nan
+        axes_scores.append((axes, score))
+
+    # Orders that only transpose the frames (e.g. rows and columns swapped in square frames) cannot be told apart
+    scores = np.nan_to_num([score for _, score in axes_scores], nan=-1.0)
+    best_score = scores.max()
+    is_best = np.isclose(scores, best_score)
+    best_axes = [axes for (axes, _), is_best_axes in zip(axes_scores, is_best) if is_best_axes]
+    second_score = scores[~is_best].max() if not is_best.all() else best_score
+    is_determined = bool(best_score >= 0.5 and best_score - max(second_score, 0.0) >= 0.1)
+    return dict(
+        dtype=dtype.str if dtype.byteorder == ">" else dtype.name,
+        num_frames=int(num_frames),
+        axes=(configured_axes if configured_axes in best_axes else best_axes[0]) if is_determined else configured_axes,
+        is_axes_order_determined=is_determined,
+        spatial_correlation=float(best_score) if best_score > -1 else None,
+    )
+
+
+def read_trial_fields(session_loader: Embargo22ASessionLoader) -> pd.DataFrame:
+    """
+    The fields of TS.Trial needed to check a session. They are read one field at a time from v7.3 MAT files, and from
+    the trials parsed by the session loader otherwise (which parses the whole MAT file once and caches it).
+    """
+    trials_cache_path = session_loader.mat_cache_path / session_loader.part_file_names["trials"]
+    if session_loader.is_lazy and not trials_cache_path.exists():
+        with LazyMatReader(session_loader.mat_file_path) as reader:
+            field_names = reader.get_field_names("TS/Trial")
+            return pd.DataFrame(
+                {
+                    field: [to_scalar(value) for value in reader.read_struct_array_field("TS/Trial", field)]
+                    for field in trial_fields
+                    if field in field_names
+                }
+            )
+    df_trials = session_loader.trials
+    return df_trials[[field for field in trial_fields if field in df_trials.columns]]
+
+
+def read_event_sample(session_loader: Embargo22ASessionLoader, num_rows: int) -> Dict[str, np.ndarray]:
+    """
+    The first `num_rows` events, from the cached events table when there is one, from the first rows of the table of
+    the MAT file otherwise, and from `events.csv` when the table is missing or cannot be decoded.
+    """
+    column_names = list(session_loader.event_column_dtypes)
+    mat_events_cache_path = session_loader.mat_cache_path / session_loader.part_file_names["events"]
+    if session_loader.events_source == "mat" and not mat_events_cache_path.exists():
+        try:
+            with LazyMatReader(session_loader.mat_file_path) as reader:
+                df_events = reader.read_table("TS/Events", num_rows=num_rows)
+            return {column: df_events[column].to_numpy() for column in df_events.columns}
+        except table_decode_errors:
+            if not session_loader.events_file_path.exists():
+                raise
+    elif session_loader.events_source == "mat" or session_loader.events_cache_path.exists():
+        return {column: np.asarray(values[:num_rows]) for column, values in session_loader.event_columns.items()}
+    df_events = pd.read_csv(session_loader.events_file_path, usecols=column_names, nrows=num_rows)
+    return {column: df_events[column].to_numpy() for column in column_names}
+
+
+def _check_raw_file(scan: SessionScan, raw_file_path: Path, imaging_parameters: dict) -> Optional[int]:
+    """Check that the raw file holds whole frames, and return their number."""
+    if not raw_file_path.is_file():
+        scan.add_problem("error", "raw_file", f"The raw imaging file {raw_file_path} is missing.")
+        return None
+
+    file_size = raw_file_path.stat().st_size
+    num_pixels = imaging_parameters["num_rows"] * imaging_parameters["num_columns"] * imaging_parameters["num_channels"]
+    frame_size = num_pixels * np.dtype(imaging_parameters["dtype"]).itemsize
+    data_size = file_size - imaging_parameters["offset"]
+    num_frames, remainder = divmod(data_size, frame_size)
+    scan.parts["raw"] = dict(file_size=file_size, frame_size=frame_size, num_frames=num_frames)
+    if data_size <= 0 or remainder:
+        scan.add_problem(
+            "error",
+            "raw_file",
+            f"The {data_size} bytes of the raw file are not a whole number of {imaging_parameters['num_rows']} x "
+            f"{imaging_parameters['num_columns']} x {imaging_parameters['num_channels']} {imaging_parameters['dtype']} "
+            f"frames of {frame_size} bytes ({remainder} bytes left).",
+        )
+        return None
+    return num_frames
+
+
+def _check_trials(
+    scan: SessionScan, df_trials: pd.DataFrame, num_frames: Optional[int], imaging_parameters: dict, frames_per_trial
+) -> Optional[int]:
+    """Check the imaged trials against the frames of the raw file, and return the expected number of frames."""
+    missing_fields = [field for field in trial_fields if field not in df_trials.columns]
+    if missing_fields:
+        scan.add_problem("error", "trials", f"TS.Trial has no {', '.join(missing_fields)} field.")
+        return None
+
+    is_imaged = df_trials["FlagOIBLK"].to_numpy() == 1
+    expected_num_frames = int(is_imaged.sum()) * frames_per_trial
+    scan.parts["trials"] = dict(
+        num_trials=len(df_trials), num_imaged_trials=int(is_imaged.sum()), expected_num_frames=expected_num_frames
+    )
+    if not df_trials["TrialNum"].is_unique:
+        scan.add_problem("error", "trials", "TS.Trial has duplicated TrialNum values.")
+
+    if num_frames is not None and num_frames != expected_num_frames:
+        scan.add_problem(
+            "error",
+            "frame_count",
+            f"The raw file has {num_frames} frames ({num_frames / frames_per_trial:g} trials of {frames_per_trial} "
+            f"frames) but {int(is_imaged.sum())} trials have FlagOIBLK == 1, i.e. {expected_num_frames} frames.",
+        )
+
+    # The frames of a trial are timed from its trigger, so they must end before the trigger of the next imaged trial
+    trigger_times = np.sort(df_trials["TimeOITrigger"].to_numpy()[is_imaged]) / 1e3
+    trial_duration = frames_per_trial / imaging_parameters["sampling_frequency"]
+    num_overlaps = int(np.count_nonzero(np.diff(trigger_times) < trial_duration))
+    if num_overlaps:
+        scan.add_problem(
+            "warning",
+            "trials",
+            f"{num_overlaps} imaged trials start less than {trial_duration:g} s ({frames_per_trial} frames) after the "
+            "previous one, so their frame times overlap.",
+        )
+    return expected_num_frames
+
+
+def _check_events(
+    scan: SessionScan,
+    session_loader: Embargo22ASessionLoader,
+    df_trials: pd.DataFrame,
+    num_event_rows: int,
+    time_offset_tolerance: float,
+):
+    """Check the event codes, and compare the time base of the events with that of TS on the trial starts."""
+    events_source = session_loader.events_source
+    if events_source == "csv" and not session_loader.events_file_path.is_file():
+        scan.add_problem(
+            "error",
+            "events",
+            f"{session_loader.events_file_path.name} is missing, and the events table can only be decoded from v7.3 "
+            "MAT files.",
+        )
+        return
+    try:
+        event_columns = read_event_sample(session_loader, num_rows=num_event_rows)
+    except ValueError as exception:  # Missing columns
+        scan.add_problem("error", "events", f"The events table cannot be read: {exception}")
+        return
+
+    event_definitions = session_loader.header.get("DEF", dict()).get("EVENT", dict())
+    scan.parts["events"] = dict(source=events_source, num_rows_read=len(event_columns["Timestamp"]))
+    event_numbers = np.concatenate([event_columns["Type"], event_columns["EventID"]])
+    unknown_numbers = np.setdiff1d(event_numbers, np.array(list(event_definitions.values()), dtype="float64"))
+    if len(unknown_numbers):
+        scan.add_problem(
+            "error", "events", f"The event numbers {unknown_numbers.tolist()} are not in TS.Header.DEF.EVENT."
+        )
+
+    new_trial_type = event_definitions.get("TYPE_NEW_TRIAL")
+    is_new_trial = event_columns["Type"] == new_trial_type
+    df_new_trials = pd.DataFrame(
+        dict(TrialNum=event_columns["TrialNum"][is_new_trial], event_time=event_columns["Timestamp"][is_new_trial])
+    )
+    df_new_trials = df_new_trials.drop_duplicates("TrialNum").merge(df_trials, on="TrialNum")
+    if len(df_new_trials) == 0 or "TimeTrialStart" not in df_new_trials:
+        scan.add_problem("warning", "time_base", "No TYPE_NEW_TRIAL event of the sample matches a trial of TS.")
+        return
+
+    trial_start_times = df_new_trials["TimeTrialStart"].to_numpy() / 1e3
+    time_offsets = df_new_trials["event_time"].to_numpy() - trial_start_times
+    time_offset = float(np.median(time_offsets))
+    time_offset_spread = float(np.ptp(time_offsets))
+    scan.parts["events"].update(
+        num_trials_compared=len(df_new_trials), time_offset=time_offset, time_offset_spread=time_offset_spread
+    )
+    time_ratio = np.median(df_new_trials["event_time"].to_numpy()) / np.median(trial_start_times)
+    if 900 < time_ratio < 1100:
+        scan.add_problem("error", "time_base", "The event timestamps are in ms, the conversion expects seconds.")
+    elif abs(time_offset) > time_offset_tolerance:
+        scan.add_problem(
+            "warning",
+            "time_base",
+            f"The events are {time_offset:+.4f} s away from the trial starts of TS: the trials, imaging and Database "
+            "times are written relative to the first event, so they will be shifted by as much.",
+        )
+    if time_offset_spread > time_offset_tolerance:
+        scan.add_problem(
+            "warning",
+            "time_base",
+            f"The offset between the events and the trial starts of TS varies by {time_offset_spread:.4f} s.",
+        )
+
+
+def _check_suite2p(scan: SessionScan, suite2p_folder_path: Path, num_frames: Optional[int]):
+    """Check the traces of every plane from the headers of their .npy files."""
+    plane_folder_paths = sorted(
+        (path for path in suite2p_folder_path.glob("plane*") if path.name[len("plane") :].isdigit()),
+        key=lambda path: int(path.name[len("plane") :]),
+    )
+    if not plane_folder_paths:
+        scan.add_problem("error", "suite2p", f"There are no plane folders in {suite2p_folder_path}.")
+        return
+
+    planes = []
+    for plane_folder_path in plane_folder_paths:
+        shapes = dict()
+        for file_name in trace_file_names.values():
+            if (plane_folder_path / file_name).is_file():
+                shapes[file_name] = np.load(plane_folder_path / file_name, mmap_mode="r").shape
+        if "F.npy" not in shapes:
+            scan.add_problem("error", "suite2p", f"{plane_folder_path.name} has no F.npy.")
+            continue
+        if len(set(shapes.values())) > 1:
+            scan.add_problem("error", "suite2p", f"The traces of {plane_folder_path.name} differ in shape: {shapes}.")
+        num_rois, plane_num_frames = shapes["F.npy"]
+        planes.append(dict(name=plane_folder_path.name, num_rois=num_rois, num_frames=plane_num_frames))
+
+        # Planes of a volume interleave, see `Embargo22ASuite2pSegmentationInterface.get_plane_frames`
+        num_planes = len(plane_folder_paths)
+        if num_frames is not None and plane_num_frames != num_frames and num_frames < plane_num_frames * num_planes:
+            scan.add_problem(
+                "warning",
+                "suite2p",
+                f"{plane_folder_path.name} has {plane_num_frames} frames, which do not match the {num_frames} frames "
+                f"of the raw file; the suite2p sampling frequency will be used for its times.",
+            )
+    scan.parts["suite2p"] = dict(planes=planes)
+
+
+def scan_session(
+    session_path: FolderPathType,
+    imaging_parameters: Optional[dict] = None,
+    frames_per_trial: int = 75,
+    num_event_rows: int = 100_000,
+    time_offset_tolerance: float = 0.005,
+) -> dict:
+    """
+    Check a session before converting it, without reading the bulk of its data.
+
+    The raw file is checked from its size and a few sampled frames, TS.Trial from the fields the checks need (read
+    lazily from v7.3 MAT files), the events from their first `num_event_rows` rows and suite2p from the headers of its
+    .npy files. The checks are:
+
+    - the raw file holds whole frames of the configured shape and type, and their number is `frames_per_trial` times
+      the number of trials with FlagOIBLK == 1;
+    - the type and axis order guessed from the raw file are the configured ones;
+    - the event numbers are defined in the Header, and the TYPE_NEW_TRIAL events match the trial starts of TS;
+    - the suite2p traces of every plane are consistent with each other and with the raw frames.
+
+    Parameters
+    ----------
+    session_path: FolderPathType
+        Session folder, with the `stream` folder.
+    imaging_parameters: dict, optional
+        Source data of the imaging interface, see `default_imaging_parameters`; only the keys given are replaced.
+    frames_per_trial: int, default: 75
+    num_event_rows: int, default: 100000
+    time_offset_tolerance: float, default: 0.005
+        Largest offset in seconds between the events and TS that is not reported.
+
+    Returns
+    -------
+    dict
+        The measurements of every part of the session, the time taken and the `problems` found, each with its
+        `severity` ("error" when the conversion would fail or be wrong, "warning" otherwise), `check` and `message`.
+    """
+    start_time = time.perf_counter()
+    imaging_parameters = dict(default_imaging_parameters, **(imaging_parameters or dict()))
+    session_path = Path(session_path)
+    stream_path = session_path / "stream"
+    scan = SessionScan(session_path=session_path)
+
+    raw_file_path = stream_path / raw_file_name
+    num_frames = _check_raw_file(scan, raw_file_path, imaging_parameters)
+
+    expected_num_frames = None
+    try:
+        session_loader = Embargo22ASessionLoader(session_path=stream_path)
+    except ValueError as exception:  # No MAT file or more than one
+        scan.add_problem("error", "mat_file", str(exception))
+    else:
+        scan.parts["mat_file"] = dict(file_name=session_loader.mat_file_path.name, is_v73=session_loader.is_lazy)
+        df_trials = read_trial_fields(session_loader)
+        expected_num_frames = _check_trials(scan, df_trials, num_frames, imaging_parameters, frames_per_trial)
+        _check_events(scan, session_loader, df_trials, num_event_rows, time_offset_tolerance)
+
+    if raw_file_path.is_file():
+        layout = guess_raw_layout(raw_file_path, imaging_parameters, expected_num_frames=expected_num_frames)
+        scan.parts.setdefault("raw", dict()).update(guessed_layout=layout)
+        configured_axes = {name: imaging_parameters[name] for name in ["frame_axis", "rows_axis", "columns_axis"]}
+        if layout["dtype"] is not None and np.dtype(layout["dtype"]) != np.dtype(imaging_parameters["dtype"]):
+            scan.add_problem(
+                "error",
+                "raw_layout",
+                f"The raw file looks like {layout['num_frames']} frames of {layout['dtype']}, not "
+                f"{imaging_parameters['dtype']}.",
+            )
+        if layout["is_axes_order_determined"] and layout["axes"] != configured_axes:
+            scan.add_problem(
+                "warning", "raw_layout", f"The frames of the raw file look like they have the axes {layout['axes']}."
+            )
+
+    suite2p_folder_path = stream_path / "suite2p"
+    if suite2p_folder_path.is_dir():
+        _check_suite2p(scan, suite2p_folder_path, num_frames)
+    else:
+        scan.add_problem("error", "suite2p", f"The suite2p folder {suite2p_folder_path} is missing.")
+
+    report = scan.to_dict()
+    report["seconds"] = time.perf_counter() - start_time
+    return to_jsonable(report)
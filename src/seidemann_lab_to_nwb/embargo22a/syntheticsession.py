@@ -0,0 +1,250 @@
+"""Generate synthetic sessions with the layout of the Seidemann lab recordings, for benchmarks and smoke tests."""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+
+from neuroconv.utils.types import FolderPathType
+
+from seidemann_lab_to_nwb.embargo22a.conversion_parameters import (
+    columns_axis,
+    frame_axis,
+    num_channels_axis,
+    rows_axis,
+)
+
+raw_file_name = "Image_001_001.raw"
+mat_file_name = "M22D20210127R0Data2P20201001.mat"
+
+# Codes of the Header.DEF mappings, as numbered by the acquisition software
+outcome_definitions = dict(SUCCESS=0.0, BREAK_FIX=1.0, BREAK_FIX_LATE=2.0)
+event_definitions = dict(
+    TYPE_EYE_STATE=1.0,
+    TYPE_PROTOCOL_STATE=2.0,
+    TYPE_NEW_TRIAL=3.0,
+    TYPE_OI_STATE=4.0,
+    TYPE_REWARD_STATE=5.0,
+    EYE_IN=11.0,
+    EYE_OUT=12.0,
+    PROTOCOL_FIXATE=21.0,
+    PROTOCOL_STIMULUS=22.0,
+    NEW_TRIAL=31.0,
+    OI_ON=41.0,
+    OI_OFF=42.0,
+    REWARD_ON=51.0,
+)
+
+
+def write_raw_imaging(
+    file_path: Path, num_frames: int, num_rows: int, num_columns: int, num_channels: int = 1, seed: int = 0
+):
+    """Write a uint16 raw file with the axes of `conversion_parameters`, one block of frames at a time."""
+    shape = [0, 0, 0, 0]
+    shape[num_channels_axis], shape[frame_axis], shape[rows_axis], shape[columns_axis] = (
+        num_channels,
+        num_frames,
+        num_rows,
+        num_columns,
+    )
+    raw_data = np.memmap(file_path, dtype="uint16", mode="w+", shape=tuple(shape))
+
+    random_generator = np.random.default_rng(seed)
+    frames_per_block = max(1, int(50e6 // (num_rows * num_columns * num_channels * 2)))
+    for start_frame in range(0, num_frames, frames_per_block):
+        stop_frame = min(start_frame + frames_per_block, num_frames)
+        index = [slice(None)] * 4
+        index[frame_axis] = slice(start_frame, stop_frame)
+        block_shape = list(shape)
+        block_shape[frame_axis] = stop_frame - start_frame
+        raw_data[tuple(index)] = random_generator.integers(1000, 3000, size=block_shape, dtype="uint16")
+
+    raw_data.flush()
+    del raw_data
+
+
+def write_suite2p_folder(
+    folder_path: Path,
+    num_frames: int,
+    num_rows: int,
+    num_columns: int,
+    num_rois: int,
+    num_planes: int = 1,
+    sampling_frequency: float = 30.0,
+    seed: int = 0,
+):
+    """Write the suite2p files the segmentation interface reads, for every plane."""
+    random_generator = np.random.default_rng(seed)
+    frames_per_plane = num_frames // num_planes
+    for plane_index in range(num_planes):
+        plane_folder_path = folder_path / f"plane{plane_index}"
+        plane_folder_path.mkdir(parents=True, exist_ok=True)
+
+        stat = []
+        for _ in range(num_rois):
+            center = random_generator.integers([4, 4], [max(5, num_rows - 4), max(5, num_columns - 4)])
+            offsets = random_generator.integers(-4, 5, size=(random_generator.integers(20, 80), 2))
+            pixels = np.unique(np.clip(center + offsets, 0, [num_rows - 1, num_columns - 1]), axis=0)
+            stat.append(
+                dict(
+                    ypix=pixels[:, 0],
+                    xpix=pixels[:, 1],
+                    lam=random_generator.random(len(pixels)).astype("float32"),
+                    med=[int(center[0]), int(center[1])],
+                )
+            )
+        np.save(plane_folder_path / "stat.npy", np.array(stat, dtype=object), allow_pickle=True)
+
+        for trace_file_name in ["F.npy", "Fneu.npy", "spks.npy"]:
+            traces = np.lib.format.open_memmap(
+                plane_folder_path / trace_file_name, mode="w+", dtype="float32", shape=(num_rois, frames_per_plane)
+            )
+            for roi_index in range(num_rois):
+                traces[roi_index] = random_generator.random(frames_per_plane, dtype="float32")
+            traces.flush()
+            del traces
+
+        iscell = np.column_stack([random_generator.integers(0, 2, num_rois), random_generator.random(num_rois)])
+        np.save(plane_folder_path / "iscell.npy", iscell)
+        ops = dict(fs=sampling_frequency / num_planes, Ly=num_rows, Lx=num_columns, nchannels=1, nplanes=num_planes)
+        np.save(plane_folder_path / "ops.npy", np.array(ops, dtype=object), allow_pickle=True)
+
+
+def generate_session(
+    data_path: FolderPathType,
+    num_trials: int = 20,
+    num_rows: int = 64,
+    num_columns: int = 64,
+    frames_per_trial: int = 75,
+    trial_duration: float = 4.0,
+    database_sampling_frequency: float = 1000.0,
+    num_rois: int = 50,
+    num_planes: int = 1,
+    blank_every: int = 4,
+    seed: int = 0,
+    session_start_ms: float = 1e6,
+) -> Path:
+    """
+    Generate a synthetic session in `data_path` and return the path of its `stream` folder.
+
+    The session has the files the conversion reads: the raw imaging file (`Image_001_001.raw`, uint16 with the axes of
+    `conversion_parameters`), a TS MAT file with the Trial, Database, Header and Expt structures, `events.csv` and a
+    suite2p folder with `num_planes` planes. One trial out of `blank_every` is not imaged (FlagOIBLK == 0), and every
+    imaged trial has `frames_per_trial` frames, as in the recordings.
+
+    Parameters
+    ----------
+    data_path: FolderPathType
+        Session folder, created if needed.
+    num_trials: int, default: 20
+    num_rows: int, default: 64
+    num_columns: int, default: 64
+    frames_per_trial: int, default: 75
+    trial_duration: float, default: 4.0
+        Duration of a trial in seconds; trials start every `trial_duration + 1` seconds.
+    database_sampling_frequency: float, default: 1000.0
+        Sampling frequency of the Database signals (eyes, photodiode, LFP and EKG) in Hz.
+    num_rois: int, default: 50
+        Number of ROIs of every suite2p plane.
+    num_planes: int, default: 1
+    blank_every: int, default: 4
+    seed: int, default: 0
+    session_start_ms: float, default: 1e6
+        Time of the first trial in the clock of the acquisition software, in ms.
+    """
+    stream_path = Path(data_path) / "stream"
+    stream_path.mkdir(parents=True, exist_ok=True)
+    random_generator = np.random.default_rng(seed)
+
+    samples_per_trial = int(trial_duration * database_sampling_frequency)
+    trial_fields = [
+        "TrialNum",
+        "TimeTrialStart",
+        "TimeTrialEnd",
+        "TimeOILSStart",
+        "TimeOITrigger",
+        "TimeOILSEnd",
+        "TimeStimStart",
+        "TimeStimEnd",
+        "TimeDBTrigger",
+        "TimeFPStart",
+        "TimeFixHoldStart",
+        "TimeFixHoldEnd",
+        "TimeNow",
+        "Outcome",
+        "CurrCond",
+        "OIStimID",
+        "FlagOIBLK",
+        "FPPos",
+        "Database",
+    ]
+    trials = np.zeros((1, num_trials), dtype=[(field, object) for field in trial_fields])
+    events = []
+    for trial_index in range(num_trials):
+        start = session_start_ms + trial_index * (trial_duration + 1.0) * 1e3
+        is_imaged = trial_index % blank_every != blank_every - 1
+        condition = random_generator.integers(1, 4)
+        values = dict(
+            TrialNum=float(trial_index + 1),
+            TimeTrialStart=start,
+            TimeTrialEnd=start + trial_duration * 1e3,
+            TimeOILSStart=start + 100.0,
+            TimeOITrigger=start + 200.0,
+            TimeOILSEnd=start + 3000.0,
+            TimeStimStart=start + 500.0,
+            TimeStimEnd=start + 1000.0,
+            TimeDBTrigger=start,
+            TimeFPStart=start + 10.0,
+            TimeFixHoldStart=start + 20.0,
+            TimeFixHoldEnd=start + 3500.0,
+            TimeNow=start,
+            Outcome=float(random_generator.choice(list(outcome_definitions.values()), p=[0.8, 0.1, 0.1])),
+            CurrCond=float(condition),
+            OIStimID=float(condition),
+            FlagOIBLK=float(is_imaged),
+            FPPos=np.zeros(2),
+        )
+        timestamps = start / 1e3 + np.arange(samples_per_trial) / database_sampling_frequency
+        values["Database"] = dict(
+            Timestamp=timestamps,
+            Eyes=random_generator.normal(size=(samples_per_trial, 3)),
+            Photodiode=random_generator.normal(size=samples_per_trial),
+            LFP=random_generator.normal(size=(samples_per_trial, 2)),
+            EKG=random_generator.normal(size=samples_per_trial),
+        )
+        for field, value in values.items():
+            trials[0, trial_index][field] = value
+
+        trial_events = [
+            (start, "TYPE_NEW_TRIAL", "NEW_TRIAL"),
+            (start + 10.0, "TYPE_PROTOCOL_STATE", "PROTOCOL_FIXATE"),
+            (start + 20.0, "TYPE_EYE_STATE", "EYE_IN"),
+            (start + 500.0, "TYPE_PROTOCOL_STATE", "PROTOCOL_STIMULUS"),
+            (start + 3500.0, "TYPE_EYE_STATE", "EYE_OUT"),
+        ]
+        if is_imaged:
+            trial_events += [(start + 200.0, "TYPE_OI_STATE", "OI_ON"), (start + 3000.0, "TYPE_OI_STATE", "OI_OFF")]
+        if values["Outcome"] == outcome_definitions["SUCCESS"]:
+            trial_events += [(start + 3600.0, "TYPE_REWARD_STATE", "REWARD_ON")]
+        for time, event_type, event in sorted(trial_events):
+            events.append((time / 1e3, trial_index + 1, event_definitions[event_type], event_definitions[event]))
+
+    header = dict(
+        DEF=dict(
+            OUTCOME=outcome_definitions,
+            EVENT=event_definitions,
+        ),
+        Conditions=dict(TypeCond=np.array([0.0, 2.0, 1.0])),  # Indexed by CurrCond - 1
+    )
+    expt = dict(ThorImageExperiment=dict(Date=dict(Attributes=dict(date="01/27/2021 10:11:12"))))
+    savemat(stream_path / mat_file_name, dict(TS=dict(Trial=trials, Header=header, Expt=expt, nTrial=num_trials)))
+
+    df_events = pd.DataFrame(events, columns=["Timestamp", "TrialNum", "Type", "EventID"])
+    df_events.to_csv(stream_path / "events.csv", index=False)
+
+    num_imaged_trials = sum(trial_index % blank_every != blank_every - 1 for trial_index in range(num_trials))
+    num_frames = num_imaged_trials * frames_per_trial
+    write_raw_imaging(stream_path / raw_file_name, num_frames, num_rows, num_columns, seed=seed)
+    write_suite2p_folder(stream_path / "suite2p", num_frames, num_rows, num_columns, num_rois, num_planes, seed=seed)
+
+    return stream_path
@@ -0,0 +1,92 @@
+"""Detect TimeSeries that share a time base and write their timestamps only once."""
+import hashlib
+from collections import defaultdict
+
+import h5py
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataIO
+from pynwb import NWBFile, TimeSeries
+
+
+def _unwrap(data):
+    return data.data if isinstance(data, DataIO) else data
+
+
+def get_timestamps_nbytes(timestamps) -> int:
+    """Size in bytes of timestamps held in memory or produced by a data chunk iterator."""
+    timestamps = _unwrap(timestamps)
+    if isinstance(timestamps, AbstractDataChunkIterator):
+        return int(np.prod(timestamps.maxshape)) * np.dtype(timestamps.dtype).itemsize
+    return np.asarray(timestamps).nbytes
+
+
+def _get_series_path(series: TimeSeries) -> str:
+    names = []
+    container = series
+    while container is not None and not isinstance(container, NWBFile):
+        names.append(container.name)
+        container = container.parent
+    return "/".join(reversed(names))
+
+
+def _link_timestamps(series: TimeSeries, reference_series: TimeSeries):
+    """Make `series` use the timestamps of `reference_series`, as if it had been built with timestamps=reference."""
+    series.fields["timestamps"] = reference_series
+    reference_series.fields.setdefault("timestamp_link", list()).append(series)
+
+
+def deduplicate_timestamps(nwbfile: NWBFile) -> dict:
+    """
+    Link every TimeSeries whose in-memory timestamps equal those of another series to a single copy.
+
+    Timestamps produced by data chunk iterators cannot be compared without consuming them; interfaces that stream
+    timestamps link their series when they build them. Both kinds of links are accounted for in the returned report.
+
+    Returns
+    -------
+    report: dict
+        The links created by this function, the links that already existed and the total number of bytes saved.
+    """
+    all_series = sorted(
+        (neurodata_object for neurodata_object in nwbfile.objects.values() if isinstance(neurodata_object, TimeSeries)),
+        key=_get_series_path,
+    )
+
+    # Group the series that own an in-memory copy of their timestamps by content
+    series_by_digest = defaultdict(list)
+    for series in all_series:
+        timestamps = _unwrap(series.fields.get("timestamps"))
+        if timestamps is None or isinstance(timestamps, (TimeSeries, AbstractDataChunkIterator, h5py.Dataset)):
+            continue  # Nothing to compare in memory, or already written to the file
+        timestamps = np.asarray(timestamps, dtype="float64")
+        digest = hashlib.blake2b(timestamps.tobytes(), digest_size=16).hexdigest()
+        series_by_digest[(timestamps.shape, digest)].append((series, timestamps))
+
+    new_links = []
+    for candidates in series_by_digest.values():
+        reference_series, reference_timestamps = candidates[0]
+        for series, timestamps in candidates[1:]:
+            if not np.array_equal(timestamps, reference_timestamps):
+                continue
+            _link_timestamps(series=series, reference_series=reference_series)
+            new_links.append((series, reference_series))
+
+    # Account for every link in the file, including those made by the interfaces
+    new_link_ids = {id(series) for series, _ in new_links}
+    links = []
+    for series in all_series:
+        reference_series = series.fields.get("timestamps")
+        if not isinstance(reference_series, TimeSeries):
+            continue
+        while isinstance(reference_series.fields.get("timestamps"), TimeSeries):
+            reference_series = reference_series.fields["timestamps"]
+        links.append(
+            dict(
+                series=_get_series_path(series),
+                linked_to=_get_series_path(reference_series),
+                bytes_saved=get_timestamps_nbytes(reference_series.fields["timestamps"]),
+                detected=id(series) in new_link_ids,
+            )
+        )
+
+    return dict(links=links, bytes_saved=sum(link["bytes_saved"] for link in links))
@@ -0,0 +1,139 @@
+"""Index of the frames of every trial in the imaging series, and trial-aligned reads of those series."""
+from typing import List, Optional, Tuple
+from warnings import catch_warnings, filterwarnings
+
+import numpy as np
+from hdmf.utils import get_data_shape
+from pynwb.base import TimeSeries, TimeSeriesReference, TimeSeriesReferenceVectorData
+from pynwb.epoch import TimeIntervals
+
+
+def add_trial_frame_index(
+    trials: TimeIntervals,
+    trial_start_frames: np.ndarray,
+    frames_per_trial: int,
+    series_frames: List[Tuple[TimeSeries, slice]],
+):
+    """
+    Add the `timeseries` column of the trials table: the range of samples of every series acquired during each trial.
+
+    Parameters
+    ----------
+    trials: TimeIntervals
+    trial_start_frames: np.ndarray
+        First imaging frame of every row of the trials table, or -1 for the trials that were not imaged.
+    frames_per_trial: int
+        Number of imaging frames of a trial.
+    series_frames: list of (TimeSeries, slice)
+        The series to index with the imaging frames of their samples, e.g. `slice(1, None, 2)` for the second plane
+        of a volume of two planes. Ranges are cut to the samples of each series, and series without samples during a
+        trial are not referenced by it.
+    """
+    trial_start_frames = np.asarray(trial_start_frames, dtype="int64")
+    is_imaged = trial_start_frames >= 0
+
+    sample_ranges = []
+    for series, frame_slice in series_frames:
+        offset, step = frame_slice.start or 0, frame_slice.step or 1
+        num_samples = get_data_shape(series.data)[0]
+        # First sample of the series at or after each frame; the samples of a trial are between those of its bounds
+        starts = np.clip(-(-(trial_start_frames - offset) // step), 0, num_samples)
+        stops = np.clip(-(-(trial_start_frames + frames_per_trial - offset) // step), 0, num_samples)
+        sample_ranges.append((series, starts, np.where(is_imaged, stops - starts, 0)))
+
+    references, index = [], []
+    for trial_index in range(len(trial_start_frames)):
+        for series, starts, counts in sample_ranges:
+            if counts[trial_index] > 0:
+                references.append(TimeSeriesReference(int(starts[trial_index]), int(counts[trial_index]), series))
+        index.append(len(references))
+
+    with catch_warnings():  # hdmf only expects the index of predefined columns to be created from nested lists
+        filterwarnings("ignore", message="Column 'timeseries' is predefined")
+        trials.add_column(
+            name="timeseries",
+            description="The samples of the imaging series and of the ROI response series acquired during the trial.",
+            data=references,
+            index=index,
+            col_cls=TimeSeriesReferenceVectorData,
+        )
+
+
+def get_trial_frame_ranges(trials: TimeIntervals, series: TimeSeries) -> np.ndarray:
+    """
+    The range of samples of `series` of every trial, from the `timeseries` column of the trials table.
+
+    Returns an array of (idx_start, count) rows, one per trial, with (-1, 0) for the trials without samples of `series`.
+    """
+    timeseries_index = trials["timeseries"]
+    references = timeseries_index.target.data[:]
+    index = np.asarray(timeseries_index.data[:], dtype="int64")
+
+    frame_ranges = np.tile(np.array([-1, 0], dtype="int64"), (len(index), 1))
+    trial_indices = np.searchsorted(index, np.arange(len(references)), side="right")
+    for trial_index, (idx_start, count, timeseries) in zip(trial_indices, references):
+        if timeseries is series or getattr(timeseries, "object_id", None) == series.object_id:
+            frame_ranges[trial_index] = idx_start, count
+    return frame_ranges
+
+
+def get_trial_aligned_data(
+    trials: TimeIntervals,
+    series: TimeSeries,
+    trial_indices: Optional[np.ndarray] = None,
+    fill_value: float = np.nan,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the samples of `series` of the trials as a (trials, frames, ...) stack, e.g. (trials, frames, x, y) for the
+    imaging series and (trials, frames, ROIs) for the ROI response series.
+
+    Consecutive trials are stored one after the other, so the samples of each run of consecutive trials are read in a
+    single slice of the dataset instead of one read per trial, and the timestamps are never read.
+
+    Parameters
+    ----------
+    trials: TimeIntervals
+        A trials table with the `timeseries` column, see `add_trial_frame_index`.
+    series: TimeSeries
+    trial_indices: np.ndarray, optional
+        Rows of the trials table to read. Defaults to every trial with samples of `series`.
+    fill_value: float, default: NaN
+        Value of the frames after the end of the trials shorter than the longest one, e.g. at the end of a preview.
+
+    Returns
+    -------
+    data: np.ndarray
+        The samples of every trial.
+    trial_indices: np.ndarray
+        The rows of the trials table read.
+    """
+    frame_ranges = get_trial_frame_ranges(trials, series)
+    if trial_indices is None:
+        trial_indices = np.flatnonzero(frame_ranges[:, 1] > 0)
+    trial_indices = np.asarray(trial_indices, dtype="int64")
+    starts, counts = frame_ranges[trial_indices, 0], frame_ranges[trial_indices, 1]
+
+    sample_shape = tuple(get_data_shape(series.data)[1:])
+    num_frames = int(counts.max()) if len(counts) else 0
+    data_shape = (len(trial_indices), num_frames) + sample_shape
+    if np.all(counts == num_frames):
+        data = np.empty(data_shape, dtype=series.data.dtype)
+    else:
+        dtype = np.result_type(series.data.dtype, np.min_scalar_type(fill_value))
+        data = np.full(data_shape, fill_value, dtype=dtype)
+
+    # Runs of trials whose samples follow each other
+    positions = np.flatnonzero(counts > 0)
+    if len(positions) == 0:
+        return data, trial_indices
+    is_run_start = np.ones(len(positions), dtype=bool)
+    is_run_start[1:] = starts[positions[1:]] != starts[positions[:-1]] + counts[positions[:-1]]
+    runs = np.split(positions, np.flatnonzero(is_run_start)[1:])
+    for run in runs:
+        run_start = starts[run[0]]
+        run_data = series.data[run_start : starts[run[-1]] + counts[run[-1]]]
+        for position in run:
+            offset = starts[position] - run_start
+            data[position, : counts[position]] = run_data[offset : offset + counts[position]]
+
+    return data, trial_indices
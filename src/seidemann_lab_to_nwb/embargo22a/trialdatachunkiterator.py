@@ -0,0 +1,100 @@
+"""Iterator that writes a signal sampled per trial one block of trials at a time."""
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+
+class TrialDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Yield a signal stored as consecutive trials one block of trials at a time.
+
+    `data` holds the samples of all trials concatenated along the first axis (typically a memory-mapped array from the
+    session cache) and `trial_offsets` the sample index where each trial starts, followed by the total number of
+    samples. Only one block of trials is in memory at any time, so peak memory scales with the trial size instead of
+    the session length.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        trial_offsets: np.ndarray,
+        columns: Optional[Union[int, list]] = None,
+        subtract: float = 0.0,
+        trials_per_block: int = 10,
+        chunk_mb: float = 1.0,
+    ):
+        """
+        Parameters
+        ----------
+        data: np.ndarray
+            Samples of all trials concatenated along the first axis.
+        trial_offsets: np.ndarray
+            Sample index where each trial starts, with the total number of samples appended.
+        columns: int or list, optional
+            Columns of a two-dimensional signal to keep. An integer selects a single column as a one-dimensional signal.
+        subtract: float, default: 0.0
+            Value subtracted from every sample, e.g. the reference time of timestamps.
+        trials_per_block: int, default: 10
+            Number of trials read and written at once.
+        chunk_mb: float, default: 1.0
+            Target size in MB of the recommended HDF5 chunks.
+        """
+        self.data = data
+        self.trial_offsets = np.asarray(trial_offsets)
+        self.columns = columns
+        self.subtract = subtract
+        self.trials_per_block = trials_per_block
+
+        sample_shape = np.empty(data.shape[1:])[self._column_selection].shape
+        self._maxshape = (int(self.trial_offsets[-1]),) + sample_shape
+        self._dtype = np.result_type(data.dtype, np.asarray(subtract).dtype) if subtract else data.dtype
+
+        bytes_per_sample = np.dtype(self._dtype).itemsize * int(np.prod(sample_shape))
+        samples_per_chunk = max(1, min(self._maxshape[0], int(chunk_mb * 1e6 // bytes_per_sample)))
+        self._chunk_shape = (samples_per_chunk,) + sample_shape
+
+        self._block_starts = iter(range(0, len(self.trial_offsets) - 1, trials_per_block))
+
+    @property
+    def _column_selection(self) -> tuple:
+        return () if self.columns is None else (self.columns,)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> DataChunk:
+        first_trial = next(self._block_starts)
+        last_trial = min(first_trial + self.trials_per_block, len(self.trial_offsets) - 1)
+        start, stop = int(self.trial_offsets[first_trial]), int(self.trial_offsets[last_trial])
+
+        block = np.array(self.data[(slice(start, stop),) + self._column_selection], dtype=self._dtype)
+        if self.subtract:
+            block -= self.subtract
+        selection = (slice(start, stop),) + (slice(None),) * (block.ndim - 1)
+
+        return DataChunk(data=block, selection=selection)
+
+    next = __next__
+
+    def _get_data(self, selection: Tuple[slice, ...]) -> np.ndarray:
+        """Read `selection` of the signal without advancing the iterator, like `GenericDataChunkIterator`."""
+        data = np.array(self.data[(selection[0],) + self._column_selection], dtype=self._dtype)
+        data = data[(slice(None),) + tuple(selection[1:])]
+        if self.subtract:
+            data -= self.subtract
+        return data
+
+    def recommended_chunk_shape(self) -> Tuple[int, ...]:
+        return self._chunk_shape
+
+    def recommended_data_shape(self) -> Tuple[int, ...]:
+        return self._maxshape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def maxshape(self) -> Tuple[int, ...]:
+        return self._maxshape
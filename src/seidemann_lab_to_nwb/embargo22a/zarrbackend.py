@@ -0,0 +1,231 @@
+"""Write NWB files to Zarr stores with parallel chunk compression, and consolidate them to HDF5 for archiving."""
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from hdmf.build import Builder
+from hdmf.container import Data
+from pynwb import NWBFile, NWBHDF5IO
+
+from neuroconv.tools.hdmf import SliceableDataChunkIterator
+from neuroconv.tools.nwb_helpers import make_nwbfile_from_metadata
+from neuroconv.utils import FilePathType
+
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
+from seidemann_lab_to_nwb.embargo22a.timestampdeduplication import deduplicate_timestamps
+
+# ParallelNWBZarrIO overrides private methods of this version of hdmf-zarr, the one compatible with the pinned hdmf
+supported_hdmf_zarr_version = "0.2.0"
+supported_zarr_major_version = "2"
+zarr_install_message = "install them with `pip install seidemann-lab-to-nwb[zarr]`"
+
+try:
+    import hdmf_zarr
+    import zarr
+except ImportError as error:
+    raise ImportError(f"The Zarr backend needs hdmf-zarr and zarr, {zarr_install_message}.") from error
+if (
+    hdmf_zarr.__version__ != supported_hdmf_zarr_version
+    or zarr.__version__.split(".")[0] != supported_zarr_major_version
+):
+    raise ImportError(
+        f"The Zarr backend needs hdmf-zarr {supported_hdmf_zarr_version} and zarr {supported_zarr_major_version}.x, "
+        f"found hdmf-zarr {hdmf_zarr.__version__} and zarr {zarr.__version__}; {zarr_install_message}."
+    )
+
+from hdmf_zarr.nwb import NWBZarrIO
+from hdmf_zarr.utils import ZarrIODataChunkIteratorQueue
+
+
+class ParallelZarrIODataChunkIteratorQueue(ZarrIODataChunkIteratorQueue):
+    """
+    Write the queued DataChunkIterators with a pool of threads.
+
+    The chunks of every iterator are read in order in the calling thread, while their compression and write run in
+    `number_of_jobs` threads; the codecs release the GIL, so the threads compress on separate cores. At most
+    `max_pending_chunks` chunks wait to be written, which bounds the memory used.
+    """
+
+    def __init__(self, number_of_jobs: Optional[int] = None, max_pending_chunks: Optional[int] = None):
+        super().__init__()
+        self.number_of_jobs = number_of_jobs or os.cpu_count()
+        self.max_pending_chunks = max_pending_chunks or 2 * self.number_of_jobs
+
+    def exhaust_queue(self):
+        with ThreadPoolExecutor(max_workers=self.number_of_jobs) as executor:
+            pending_writes = deque()
+            while len(self) > 0:
+                dataset, data = self.popleft()
+                for chunk in data:
+                    min_shape = np.maximum(dataset.shape, chunk.get_min_bounds())
+                    if tuple(min_shape) != dataset.shape:  # Resizing while chunks are written is not safe
+                        for pending_write in pending_writes:
+                            pending_write.result()
+                        pending_writes.clear()
+                        dataset.resize(tuple(min_shape))
+
+                    pending_writes.append(executor.submit(dataset.__setitem__, chunk.selection, chunk.data))
+                    while len(pending_writes) >= self.max_pending_chunks:
+                        pending_writes.popleft().result()
+
+            for pending_write in pending_writes:
+                pending_write.result()
+
+
+class ParallelNWBZarrIO(NWBZarrIO):
+    """
+    NWBZarrIO that compresses and writes the chunks of DataChunkIterators in `number_of_jobs` threads.
+
+    Chunks of the same array can be written by several threads at once, so writes go through a thread synchronizer
+    that locks each chunk. Three issues of hdmf-zarr 0.2.0 (the version compatible with the pinned hdmf) are also
+    fixed: lists of strings such as `file_create_date` and compound datasets such as `pixel_mask` are written
+    incorrectly, datasets written from iterators lack the `zarr_dtype` without which the store cannot be read, a
+    dataset that is also the target of a link (e.g. the `rois` shared by the series of a plane) is read twice, which
+    fails on the duplicate object ID, and the references of compound datasets (e.g. the `timeseries` column of the
+    trials) are read as builders instead of the objects they reference.
+    """
+
+    def __init__(self, path: str, mode: str, number_of_jobs: Optional[int] = None, **kwargs):
+        super().__init__(path=path, mode=mode, synchronizer=zarr.ThreadSynchronizer(), **kwargs)
+        self._ZarrIO__dci_queue = ParallelZarrIODataChunkIteratorQueue(number_of_jobs=number_of_jobs)
+        self._built_by_path = dict()
+
+    def read(self, **kwargs):
+        container = super().read(**kwargs)
+        for neurodata_object in container.objects.values():
+            data = neurodata_object.data if isinstance(neurodata_object, Data) else None
+            is_compound = isinstance(data, np.ndarray) and data.dtype == object and data.ndim == 1 and len(data) > 0
+            if is_compound and isinstance(data[0], list) and any(isinstance(value, Builder) for value in data[0]):
+                neurodata_object.transform(
+                    lambda rows: [
+                        tuple(self.manager.construct(value) if isinstance(value, Builder) else value for value in row)
+                        for row in rows
+                    ]
+                )
+        return container
+
+    def __list_fill__(self, parent, name, data, options=None):
+        if isinstance(data, (list, tuple)) and len(data) > 0 and isinstance(data[0], (str, bytes)):
+            data = np.array(data, dtype=object)
+        if options is not None and isinstance(options.get("dtype"), list) and not isinstance(data, np.ndarray):
+            # The rows of a compound dataset (e.g. `pixel_mask`) would otherwise be written as a 2D array
+            io_settings = dict(options.get("io_settings") or dict(), shape=(len(data),))
+            options = dict(options, io_settings=io_settings)
+        return super().__list_fill__(parent, name, data, options)
+
+    def _ZarrIO__get_built_path(self, zarr_obj) -> str:
+        # Targets of links are opened as their own store, whose path would otherwise end with a separator
+        return os.path.normpath(os.path.join(zarr_obj.store.path, zarr_obj.path))
+
+    def _ZarrIO__set_built(self, zarr_obj, builder):
+        self._built_by_path.setdefault(self._ZarrIO__get_built_path(zarr_obj), builder)
+
+    def _ZarrIO__get_built(self, zarr_obj):
+        return self._built_by_path.get(self._ZarrIO__get_built_path(zarr_obj))
+
+    @classmethod
+    def __setup_chunked_dataset__(cls, parent, name, data, options=None):
+        dataset = super().__setup_chunked_dataset__(parent, name, data, options)
+        dataset.attrs["zarr_dtype"] = cls.__serial_dtype__(dataset.dtype)
+        return dataset
+
+
+@contextmanager
+def make_or_load_zarr_nwbfile(
+    nwbfile_path: Optional[FilePathType] = None,
+    nwbfile: Optional[NWBFile] = None,
+    metadata: Optional[dict] = None,
+    overwrite: bool = False,
+    number_of_jobs: Optional[int] = None,
+    verbose: bool = True,
+):
+    """
+    Same as `neuroconv.tools.nwb_helpers.make_or_load_nwbfile`, but the file is a Zarr store written in parallel.
+
+    An existing store is replaced when `overwrite` is True, and opened in append mode otherwise.
+    """
+    nwbfile_path = Path(nwbfile_path) if nwbfile_path is not None else None
+    append = nwbfile_path is not None and nwbfile_path.exists() and not overwrite
+    if append and nwbfile is not None:
+        raise ValueError(f"'{nwbfile_path}' exists and 'overwrite' is False, but an in-memory nwbfile was passed.")
+
+    io = None
+    if nwbfile_path is not None:
+        if nwbfile_path.exists() and overwrite:
+            shutil.rmtree(nwbfile_path)
+        mode = "r+" if append else "w"
+        io = ParallelNWBZarrIO(path=str(nwbfile_path), mode=mode, number_of_jobs=number_of_jobs)
+    try:
+        if append:
+            nwbfile = io.read()
+        elif nwbfile is None:
+            nwbfile = make_nwbfile_from_metadata(metadata=metadata)
+        yield nwbfile
+
+        if io is not None:
+            io.write(nwbfile)
+            if verbose:
+                print(f"NWB file saved at {nwbfile_path}!")
+    finally:
+        if io is not None:
+            io.close()
+
+
+def _wrap_zarr_array(array: zarr.Array, name: str, compression_policy: CompressionPolicy):
+    """Compressed iterator over a numeric Zarr array, or None when the array is written as it is."""
+    if array.dtype.kind == "O" and array.size > 0 and isinstance(array[(0,) * array.ndim], str):
+        return array[:].tolist()  # Strings are read as objects, which HDF5 cannot store
+    if array.dtype.kind not in "biuf" or array.ndim == 0:
+        return None
+    chunk_shape = tuple(max(1, min(chunk, length)) for chunk, length in zip(array.chunks, array.shape))
+    data = compression_policy.wrap(name, SliceableDataChunkIterator(data=array, chunk_shape=chunk_shape))
+    return data if data is not None and not isinstance(data, SliceableDataChunkIterator) else None
+
+
+def consolidate_to_hdf5(
+    zarr_path: FilePathType,
+    nwbfile_path: FilePathType,
+    compression_policy: Optional[CompressionPolicy] = None,
+    verbose: bool = True,
+):
+    """
+    Export the NWB file of a Zarr store to a single HDF5 file, for archiving.
+
+    The datasets are streamed from the store one chunk at a time and compressed with `compression_policy` (gzip by
+    default). Series whose timestamps are equal are linked to a single copy again, since the Zarr store keeps the
+    linked timestamps as separate arrays.
+    """
+    compression_policy = compression_policy or CompressionPolicy()
+    with ParallelNWBZarrIO(str(zarr_path), mode="r") as zarr_io:
+        nwbfile = zarr_io.read()
+        deduplicate_timestamps(nwbfile)
+
+        for neurodata_object in nwbfile.objects.values():
+            # Export reuses the builders read from the store for unmodified objects, and pynwb builds the target of
+            # linked timestamps in the source of the object; links to either would become external links to the store
+            neurodata_object.set_modified()
+            neurodata_object._AbstractContainer__container_source = str(nwbfile_path)
+            if isinstance(neurodata_object, Data):  # VectorData, VectorIndex and the ids of the tables
+                name = f"{neurodata_object.parent.name}/{neurodata_object.name}"
+                if isinstance(neurodata_object.data, zarr.Array):
+                    data = _wrap_zarr_array(neurodata_object.data, name, compression_policy)
+                    if data is not None:
+                        neurodata_object.transform(lambda _, data=data: data)
+                continue
+
+            for field_name, value in list(neurodata_object.fields.items()):
+                if isinstance(value, zarr.Array):
+                    data = _wrap_zarr_array(value, f"{neurodata_object.name}/{field_name}", compression_policy)
+                    if data is not None:
+                        neurodata_object.fields[field_name] = data
+
+        with NWBHDF5IO(str(nwbfile_path), mode="w") as hdf5_io:
+            hdf5_io.export(src_io=zarr_io, nwbfile=nwbfile, write_args=dict(link_data=False))
+
+    if verbose:
+        print(f"NWB file consolidated at {nwbfile_path}!")
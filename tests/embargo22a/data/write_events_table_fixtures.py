@@ -0,0 +1,99 @@
+"""
+Write the v7.3 MAT files with a MATLAB `table` of the events in `events.csv` that the tests of `LazyMatReader` read.
+
+MATLAB is not needed: the files are written with h5py following the layout MATLAB uses for v7.3 files, with the table
+stored in the MCOS subsystem as a pre-R2018a table (`varnames`). Both versions of the MCOS metadata are written, with
+6 (version 2) and 8 (later versions) segment offsets.
+"""
+import struct
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+data_path = Path(__file__).parent
+mcos_versions = dict(events_table_mcos_v2=2, events_table_mcos_v4=4)
+
+
+def write_matlab_value(file: h5py.File, name: str, value) -> h5py.Dataset:
+    """Write a char array, a cell array of char arrays or a double array to `#refs#/<name>`."""
+    refs = file.require_group("#refs#")
+    if isinstance(value, str):
+        dataset = refs.create_dataset(name, data=np.array([[ord(character)] for character in value], dtype="uint16"))
+        dataset.attrs["MATLAB_class"] = np.bytes_("char")
+    elif isinstance(value, list):
+        references = [write_matlab_value(file, f"{name}_{index}", item).ref for index, item in enumerate(value)]
+        dataset = refs.create_dataset(name, data=np.array(references, dtype=h5py.ref_dtype).reshape(-1, 1))
+        dataset.attrs["MATLAB_class"] = np.bytes_("cell")
+    else:
+        array = np.asarray(value, dtype="float64")
+        array = array.reshape(1, -1) if array.ndim < 2 else array
+        dataset = refs.create_dataset(name, data=array.T)
+        dataset.attrs["MATLAB_class"] = np.bytes_("double")
+    return dataset
+
+
+def get_mcos_metadata(version: int, num_variables: int, names: list) -> bytes:
+    """The first cell of `#subsystem#/MCOS`: the names, the class, the object and its properties."""
+    name_indices = {name: index + 1 for index, name in enumerate(names)}
+    strings = b"".join(name.encode() + b"\0" for name in names)
+    strings += b"\0" * ((8 - len(strings) % 8) % 8)
+
+    # Properties (name index, flag, value); flag 1 values are in the cells, after the two metadata cells
+    properties = [
+        (name_indices["data"], 1, 0),
+        (name_indices["nrows"], 1, 1),
+        (name_indices["varnames"], 1, 2),
+        (name_indices["ndims"], 2, 2),
+        (name_indices["nvars"], 2, num_variables),
+    ]
+    class_segment = struct.pack("<8I", 0, 0, 0, 0, 0, name_indices["table"], 0, 0)
+    segment2 = b"\0" * 8
+    object_segment = struct.pack("<12I", 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 1)
+    segment4 = b"\0" * 8 + struct.pack("<I", len(properties)) + b"".join(struct.pack("<3I", *p) for p in properties)
+    segment4 += b"\0" * ((8 - len(segment4) % 8) % 8)
+
+    num_offsets = 6 if version == 2 else 8
+    offsets = [8 + 4 * num_offsets + len(strings)]
+    for segment in [class_segment, segment2, object_segment, segment4]:
+        offsets.append(offsets[-1] + len(segment))
+    offsets += [offsets[-1]] * (num_offsets - len(offsets))
+
+    header = struct.pack("<2I", version, len(names)) + struct.pack(f"<{num_offsets}I", *offsets)
+    return header + strings + class_segment + segment2 + object_segment + segment4
+
+
+def write_events_table(file_path: Path, events: pd.DataFrame, version: int):
+    names = ["table", "data", "nrows", "varnames", "ndims", "nvars"]
+    metadata = np.frombuffer(get_mcos_metadata(version, len(events.columns), names), dtype="uint8")
+    columns = [events[column].to_numpy(dtype="float64") for column in events.columns]
+
+    with h5py.File(file_path, mode="w", userblock_size=512) as file:
+        metadata_dataset = file.require_group("#refs#").create_dataset("metadata", data=metadata.reshape(-1, 1))
+        metadata_dataset.attrs["MATLAB_class"] = np.bytes_("uint8")
+        cells = [
+            metadata_dataset,
+            write_matlab_value(file, "defaults", 0.0),
+            write_matlab_value(file, "data", columns),
+            write_matlab_value(file, "nrows", float(len(events))),
+            write_matlab_value(file, "varnames", list(events.columns)),
+        ]
+        mcos = file.create_group("#subsystem#").create_dataset(
+            "MCOS", data=np.array([cell.ref for cell in cells], dtype=h5py.ref_dtype).reshape(-1, 1)
+        )
+        mcos.attrs["MATLAB_class"] = np.bytes_("FileWrapper__")
+
+        events_group = file.create_group("TS")
+        events_group.attrs["MATLAB_class"] = np.bytes_("struct")
+        # Object reference: [0xDD000000, ndims, dims..., object ids..., class id]
+        reference = np.array([0xDD000000, 2, 1, 1, 1, 1], dtype="uint32").reshape(-1, 1)
+        table = events_group.create_dataset("Events", data=reference)
+        table.attrs["MATLAB_class"] = np.bytes_("table")
+        table.attrs["MATLAB_object_decode"] = np.int32(3)
+
+
+if __name__ == "__main__":
+    events = pd.read_csv(data_path / "events.csv")
+    for file_stem, version in mcos_versions.items():
+        write_events_table(data_path / f"{file_stem}.mat", events, version)
@@ -0,0 +1,16 @@
+import numpy as np
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a.compressionpolicy import CompressionPolicy
+
+
+def test_chunk_shape_only_applies_to_datasets_of_its_rank():
+    policy = CompressionPolicy.from_dict(
+        dict(chunk_shape=[64], min_compressed_bytes=0, overrides={"TwoPhotonSeries/data": dict(chunk_shape=[1, 8, 8])})
+    )
+
+    assert policy.wrap("pupil_position/timestamps", np.zeros(100)).io_settings["chunks"] == (64,)
+    assert policy.wrap("eye_tracking_events/data", np.zeros(12)).io_settings["chunks"] == (12,)
+    assert "chunks" not in policy.wrap("pupil_position/data", np.zeros((100, 2))).io_settings
+    assert policy.get_settings("TwoPhotonSeries/data", num_dimensions=3)["chunk_shape"] == [1, 8, 8]
+    assert policy.get_settings("TwoPhotonSeries/data", num_dimensions=1)["chunk_shape"] is None
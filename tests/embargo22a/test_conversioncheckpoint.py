@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+from neuroconv.utils import dict_deep_update, load_dict_from_file
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a import Embargo22ANWBConverter, embargo22asessionloader
+from seidemann_lab_to_nwb.embargo22a.conversion_parameters import (
+    columns_axis,
+    frame_axis,
+    num_channels_axis,
+    rows_axis,
+)
+from seidemann_lab_to_nwb.embargo22a.conversioncheckpoint import ConversionCheckpoint
+from seidemann_lab_to_nwb.embargo22a.syntheticsession import generate_session, raw_file_name
+
+metadata_path = Path(seidemann_lab_to_nwb.embargo22a.__file__).parent / "embargo22a_metadata.yml"
+num_rows, num_columns = 16, 24
+
+
+@pytest.fixture
+def stream_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(embargo22asessionloader, "default_cache_folder_path", tmp_path / "cache")
+    return generate_session(tmp_path / "session", num_trials=8, num_rows=num_rows, num_columns=num_columns)
+
+
+def run_conversion(stream_path: Path, nwbfile_path: Path, **conversion_kwargs):
+    source_data = dict(
+        Imaging=dict(
+            file_path=str(stream_path / raw_file_name),
+            num_rows=num_rows,
+            num_columns=num_columns,
+            num_channels=1,
+            rows_axis=rows_axis,
+            columns_axis=columns_axis,
+            channels_axis=num_channels_axis,
+            frame_axis=frame_axis,
+            sampling_frequency=30.0,
+            dtype="uint16",
+        ),
+        Behavior=dict(session_path=str(stream_path)),
+    )
+    converter = Embargo22ANWBConverter(source_data=source_data)
+    converter.verbose = False
+    converter.data_interface_objects["Imaging"].verbose = False
+    metadata = dict_deep_update(converter.get_metadata(), load_dict_from_file(metadata_path), append_list=False)
+    conversion_options = dict(Imaging=dict(frames_per_block=50, chunk_shape=[50, num_columns, num_rows]))
+    converter.run_conversion(
+        nwbfile_path=str(nwbfile_path), metadata=metadata, conversion_options=conversion_options, **conversion_kwargs
+    )
+
+
+def read_datasets(nwbfile_path: Path) -> dict:
+    """The values of every dataset of the file, with the object references replaced by the paths of their objects."""
+    datasets = dict()
+    with h5py.File(nwbfile_path, mode="r") as file:
+
+        def read_dataset(name: str, node):
+            if not isinstance(node, h5py.Dataset) or name in ("identifier", "file_create_date"):
+                return
+            values = node[()]
+            if node.dtype.names is not None:
+                values = [
+                    tuple(file[value].name if isinstance(value, h5py.Reference) else value for value in row)
+                    for row in values
+                ]
+            datasets[name] = values
+
+        file.visititems(read_dataset)
+    return datasets
+
+
+def test_interrupted_conversion_is_resumed(stream_path, tmp_path, monkeypatch):
+    run_conversion(stream_path=stream_path, nwbfile_path=tmp_path / "uninterrupted.nwb")
+
+    add_chunk_write = ConversionCheckpoint.add_chunk_write
+    num_chunks = [0]
+
+    def abort_chunk_write(self, dataset, chunk, read_seconds=0.0, write_seconds=0.0):
+        add_chunk_write(self, dataset, chunk, read_seconds, write_seconds)
+        num_chunks[0] += 1
+        if num_chunks[0] == 3:
+            raise KeyboardInterrupt
+
+    nwbfile_path = tmp_path / "resumed.nwb"
+    with monkeypatch.context() as patch:
+        patch.setattr(ConversionCheckpoint, "add_chunk_write", abort_chunk_write)
+        with pytest.raises(KeyboardInterrupt):
+            run_conversion(stream_path=stream_path, nwbfile_path=nwbfile_path, checkpoint=True)
+    checkpoint = ConversionCheckpoint.load(nwbfile_path=nwbfile_path)
+    assert checkpoint.status == "writing" and checkpoint.structure_written
+    imaging_progress = checkpoint.datasets["/acquisition/TwoPhotonSeries/data"]
+    assert not imaging_progress["complete"] and imaging_progress["rows_written"] > 0
+
+    run_conversion(stream_path=stream_path, nwbfile_path=nwbfile_path, checkpoint=True)
+    assert ConversionCheckpoint.load(nwbfile_path=nwbfile_path).status == "complete"
+
+    expected_datasets = read_datasets(tmp_path / "uninterrupted.nwb")
+    datasets = read_datasets(nwbfile_path)
+    assert datasets.keys() == expected_datasets.keys()
+    for name, expected_values in expected_datasets.items():
+        assert np.array_equal(np.asarray(datasets[name]), np.asarray(expected_values)), name
+
+
+def test_replaced_interface_keeps_the_other_objects(stream_path, tmp_path):
+    nwbfile_path = tmp_path / "replaced.nwb"
+    run_conversion(stream_path=stream_path, nwbfile_path=nwbfile_path, checkpoint=True)
+    with h5py.File(nwbfile_path, mode="r") as file:
+        imaging_data = file["acquisition/TwoPhotonSeries/data"]
+        imaging_object_id = file["acquisition/TwoPhotonSeries"].attrs["object_id"]
+        imaging_chunk_offset = imaging_data.id.get_chunk_info(0).byte_offset
+        trials_object_id = file["intervals/trials"].attrs["object_id"]
+
+    run_conversion(stream_path=stream_path, nwbfile_path=nwbfile_path, replace_interfaces=["Behavior"])
+
+    with h5py.File(nwbfile_path, mode="r") as file:
+        imaging_data = file["acquisition/TwoPhotonSeries/data"]
+        assert file["acquisition/TwoPhotonSeries"].attrs["object_id"] == imaging_object_id
+        assert imaging_data.id.get_chunk_info(0).byte_offset == imaging_chunk_offset  # The data is not rewritten
+        assert file["intervals/trials"].attrs["object_id"] != trials_object_id
+
+        referenced_paths = {file[row["timeseries"]].name for row in file["intervals/trials/timeseries"][()]}
+        assert "/acquisition/TwoPhotonSeries" in referenced_paths
@@ -0,0 +1,35 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import find_mat_file_path, get_session_loader
+
+data_path = Path(__file__).parent / "data"
+
+
+def test_find_mat_file_path_prefers_data2p_file(tmp_path):
+    (tmp_path / "analysis.mat").touch()
+    assert find_mat_file_path(tmp_path) == tmp_path / "analysis.mat"
+
+    (tmp_path / "M22D20210127R0Data2P20201001.mat").touch()
+    assert find_mat_file_path(tmp_path) == tmp_path / "M22D20210127R0Data2P20201001.mat"
+
+    (tmp_path / "M22D20210127R1Data2P20201001.mat").touch()
+    with pytest.raises(ValueError, match="Data2P"):
+        find_mat_file_path(tmp_path)
+
+
+def test_get_session_loader_is_renewed_when_the_files_change(tmp_path):
+    shutil.copy(data_path / "events_table_mcos_v4.mat", tmp_path / "session_Data2P.mat")
+    events_file_path = tmp_path / "events.csv"
+    shutil.copy(data_path / "events.csv", events_file_path)
+
+    session_loader = get_session_loader(session_path=tmp_path, cache_folder_path=tmp_path / "cache")
+    assert get_session_loader(session_path=tmp_path, cache_folder_path=tmp_path / "cache") is session_loader
+
+    events_file_stat = events_file_path.stat()
+    os.utime(events_file_path, ns=(events_file_stat.st_atime_ns, events_file_stat.st_mtime_ns + 1_000_000_000))
+    assert get_session_loader(session_path=tmp_path, cache_folder_path=tmp_path / "cache") is not session_loader
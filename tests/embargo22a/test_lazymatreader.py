@@ -0,0 +1,57 @@
+import shutil
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import Embargo22ASessionLoader
+from seidemann_lab_to_nwb.embargo22a.lazymatreader import LazyMatReader
+
+data_path = Path(__file__).parent / "data"
+
+
+@pytest.mark.parametrize("file_stem", ["events_table_mcos_v2", "events_table_mcos_v4"])
+def test_read_table_matches_events_csv(file_stem):
+    expected_events = pd.read_csv(data_path / "events.csv")
+    with LazyMatReader(data_path / f"{file_stem}.mat") as reader:
+        assert reader.get_class_name("TS/Events") == "table"
+        events = reader.read_table("TS/Events")
+
+    assert list(events.columns) == list(expected_events.columns)
+    for column in expected_events.columns:
+        np.testing.assert_array_equal(events[column].to_numpy(), expected_events[column].to_numpy())
+
+
+@pytest.mark.parametrize("num_rows", [1, 3, 10_000])
+def test_read_table_reads_the_first_rows(num_rows):
+    expected_events = pd.read_csv(data_path / "events.csv").head(num_rows)
+    with LazyMatReader(data_path / "events_table_mcos_v4.mat") as reader:
+        events = reader.read_table("TS/Events", num_rows=num_rows)
+
+    assert len(events) == len(expected_events)
+    for column in expected_events.columns:
+        np.testing.assert_array_equal(events[column].to_numpy(), expected_events[column].to_numpy())
+
+
+def test_session_loader_falls_back_to_events_csv(tmp_path):
+    session_path = tmp_path / "session"
+    session_path.mkdir()
+    mat_file_path = session_path / "session_Data2P.mat"
+    shutil.copy(data_path / "events_table_mcos_v4.mat", mat_file_path)
+    shutil.copy(data_path / "events.csv", session_path / "events.csv")
+    with h5py.File(mat_file_path, mode="r+") as file:  # A layout the reader does not know: no object entries
+        metadata = file["#refs#/metadata"][()]
+        del file["#refs#/metadata"]
+        file.create_dataset("#refs#/metadata", data=metadata[: len(metadata) // 2])
+
+    session_loader = Embargo22ASessionLoader(session_path=session_path, cache_folder_path=tmp_path / "cache")
+    assert session_loader.events_source == "mat"
+    with pytest.warns(UserWarning, match="could not be decoded"):
+        event_columns = session_loader.event_columns
+
+    expected_events = pd.read_csv(data_path / "events.csv")
+    for column in expected_events.columns:
+        np.testing.assert_array_equal(event_columns[column], expected_events[column].to_numpy())
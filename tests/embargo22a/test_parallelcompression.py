@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import h5py
+import numpy as np
+import pytest
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO, NWBFile, TimeSeries
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a.conversion_parameters import (
+    columns_axis,
+    frame_axis,
+    num_channels_axis,
+    rows_axis,
+)
+from seidemann_lab_to_nwb.embargo22a.hdf5writehooks import HDF5WriteHooks
+from seidemann_lab_to_nwb.embargo22a.numpymemmapimaginginterface import NumpyMemmapImagingInterface
+from seidemann_lab_to_nwb.embargo22a.parallelcompression import (
+    ParallelCompressionDataChunkIterator,
+    compress_chunk,
+    get_direct_write_filters,
+    write_compressed_chunk,
+)
+from seidemann_lab_to_nwb.embargo22a.syntheticsession import generate_session, raw_file_name
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_compress_chunk_matches_the_hdf5_filters(tmp_path, shuffle):
+    data = np.random.default_rng(0).integers(1000, 3000, size=(10, 12, 7), dtype="uint16")
+    chunk_shape = (4, 8, 7)  # The last chunks of the first two axes are partial
+    with h5py.File(tmp_path / "chunks.h5", "w") as file:
+        filtered_dataset = file.create_dataset(
+            "filtered", data=data, chunks=chunk_shape, compression="gzip", compression_opts=4, shuffle=shuffle
+        )
+        filters = get_direct_write_filters(filtered_dataset)
+        assert filters == dict(chunk_shape=chunk_shape, shuffle=shuffle, level=4)
+
+        direct_dataset = file.create_dataset(
+            "direct", shape=data.shape, dtype=data.dtype, chunks=chunk_shape, compression="gzip", shuffle=shuffle
+        )
+        for chunk_offset in [(0, 0, 0), (8, 8, 0)]:  # A full chunk and the partial chunk at the edge
+            selection = tuple(
+                slice(start, start + chunk_length) for start, chunk_length in zip(chunk_offset, chunk_shape)
+            )
+            compressed_data = compress_chunk(data[selection], **filters)
+            direct_dataset.id.write_direct_chunk(chunk_offset, compressed_data, filter_mask=0)
+            assert direct_dataset.id.read_direct_chunk(chunk_offset) == (0, compressed_data)
+            np.testing.assert_array_equal(direct_dataset[selection], data[selection])
+            assert compressed_data == filtered_dataset.id.read_direct_chunk(chunk_offset)[1]
+
+
+def test_parallel_compression_writes_the_blocks_of_the_source(tmp_path):
+    stream_path = generate_session(tmp_path / "session", num_trials=5, num_rows=16, num_columns=24, frames_per_trial=9)
+    interface = NumpyMemmapImagingInterface(
+        file_path=str(stream_path / raw_file_name),
+        sampling_frequency=30.0,
+        dtype="uint16",
+        num_rows=16,
+        num_columns=24,
+        num_channels=1,
+        frame_axis=frame_axis,
+        rows_axis=rows_axis,
+        columns_axis=columns_axis,
+        channels_axis=num_channels_axis,
+    )
+    imaging_extractor = interface.imaging_extractor
+    source_data = imaging_extractor.get_video(start_frame=0, end_frame=imaging_extractor.get_num_frames())
+    source_data = source_data.transpose(0, 2, 1)  # Frames, columns and rows, as written
+    iterator = interface.get_data_chunk_iterator(frames_per_block=10, chunk_shape=[5, 16, 16])
+    assert source_data.shape[0] % 10 != 0  # The last block is partial
+
+    nwbfile = NWBFile(session_description="", identifier="", session_start_time=datetime.now().astimezone())
+    data = ParallelCompressionDataChunkIterator(data_iterator=iterator, number_of_jobs=2)
+    nwbfile.add_acquisition(TimeSeries(name="Imaging", data=H5DataIO(data, compression="gzip"), unit="a.u.", rate=1.0))
+
+    written_blocks = []
+
+    def write_and_record_chunk(dataset, chunk):
+        written_blocks.append(write_compressed_chunk(dataset, chunk))
+        return written_blocks[-1]
+
+    write_hooks = HDF5WriteHooks()
+    write_hooks.chunk_writers.append(write_and_record_chunk)
+    nwbfile_path = tmp_path / "parallel.nwb"
+    with write_hooks.install(), NWBHDF5IO(str(nwbfile_path), "w") as io:
+        io.write(nwbfile)
+    assert len(written_blocks) == -(-source_data.shape[0] // 10) and all(written_blocks)  # Direct chunk writes
+
+    with h5py.File(nwbfile_path, "r") as file:
+        dataset = file["acquisition/Imaging/data"]
+        assert dataset.chunks == (5, 16, 16)
+        np.testing.assert_array_equal(dataset[:], source_data)
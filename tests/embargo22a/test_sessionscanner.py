@@ -0,0 +1,43 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import seidemann_lab_to_nwb.embargo22a  # noqa: F401, imports the package before its modules
+from seidemann_lab_to_nwb.embargo22a.embargo22asessionloader import Embargo22ASessionLoader
+from seidemann_lab_to_nwb.embargo22a.sessionscanner import find_sessions, read_event_sample
+
+data_path = Path(__file__).parent / "data"
+
+
+def test_find_sessions(tmp_path):
+    complete_session_path = tmp_path / "monkey1" / "session"
+    stream_path = complete_session_path / "stream"
+    (stream_path / "suite2p").mkdir(parents=True)
+    (stream_path / "Image_001_001.raw").touch()
+    (stream_path / "M22D20210127R0Data2P20201001.mat").touch()
+    incomplete_session_path = tmp_path / "monkey2" / "session"
+    (incomplete_session_path / "stream").mkdir(parents=True)
+
+    manifest_path = tmp_path / "manifest.txt"
+    manifest_path.write_text(f"# Sessions\n{complete_session_path}\n\n{incomplete_session_path}\n")
+
+    assert find_sessions(root_path=tmp_path) == [complete_session_path]
+    assert find_sessions(manifest_path=manifest_path) == [complete_session_path]
+    assert find_sessions(root_path=tmp_path, manifest_path=manifest_path, complete_only=False) == [
+        complete_session_path,
+        incomplete_session_path,
+    ]
+
+
+def test_read_event_sample_only_decodes_the_first_rows_of_the_mat_table(tmp_path):
+    shutil.copy(data_path / "events_table_mcos_v4.mat", tmp_path / "session_Data2P.mat")
+    session_loader = Embargo22ASessionLoader(session_path=tmp_path, cache_folder_path=tmp_path / "cache")
+    assert session_loader.events_source == "mat"
+
+    event_columns = read_event_sample(session_loader, num_rows=3)
+    expected_events = pd.read_csv(data_path / "events.csv", nrows=3)
+    for column in expected_events.columns:
+        np.testing.assert_array_equal(event_columns[column], expected_events[column].to_numpy())
+    assert not (session_loader.mat_cache_path / session_loader.part_file_names["events"]).exists()